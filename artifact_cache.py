@@ -0,0 +1,206 @@
+"""ARTIFACT_CACHE MODULE
+
+Cache of the files derived from cube files (voxels, isomeshes, downsampled fields). Each file is
+keyed on the contents of its source cube files together with every parameter that went into making
+it, so changing an isovalue or an emission option makes a new file instead of quietly reusing an
+old one. A small index file records the size and last use of every artifact, and the least
+recently used artifacts are removed once the cache grows past its disk budget.
+
+Several processes (e.g. batch workers) can share one cache: artifacts are written under a
+temporary name and moved into place, and the index is only changed while holding a file lock.
+
+Author: Matthew Truscott
+"""
+import contextlib
+import hashlib
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking (windows), processes sharing a cache may then lose index updates
+    fcntl = None
+
+import field_cache as fc
+
+VERSION = 1
+
+# disk budget of the cache in bytes
+DEFAULT_BUDGET = 8 << 30
+
+
+class Artifact():
+    """a derived file in the cache, as returned by ArtifactCache.request. If it does not exist yet
+    it is written to tmppath and then committed, which moves it to path.
+    """
+    def __init__(self, cache, key, path, entry, exists):
+        self.cache = cache
+        self.key = key
+        self.path = path
+        self.entry = entry
+        self.exists = exists
+        base, ext = os.path.splitext(path)
+        self.tmppath = '{}.tmp{}{}'.format(base, os.getpid(), ext)
+
+    def commit(self):
+        """moves the written file into place and records it in the index
+
+        Returns:
+            path -- the path of the artifact
+        """
+        self.cache.commit(self)
+        self.exists = True
+        return self.path
+
+
+class ArtifactCache():
+    """content addressed store of derived files, with an LRU disk budget
+    """
+    def __init__(self, directory=None, budget=None):
+        if directory is None:
+            directory = os.path.join(fc.default_dir(), 'artifacts')
+        self.directory = directory
+        self.budget = DEFAULT_BUDGET if budget is None else budget
+        self.indexpath = os.path.join(directory, 'index.json')
+        # paths of the artifacts found in the cache by this object
+        self.hits = set()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """holds the lock of the cache, yields the index which is saved on exit
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as f_lock:
+            if fcntl is not None:
+                fcntl.flock(f_lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.indexpath, 'r') as f_read:
+                index = json.load(f_read)
+            if index.get('version') == VERSION:
+                return index
+            print('artifact index is out of date, starting a new one')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as err:
+            print('artifact index is corrupt ({}), starting a new one'.format(err))
+        return {'version': VERSION, 'artifacts': {}, 'digests': {}}
+
+    def _write_index(self, index):
+        tmppath = '{}.tmp{}'.format(self.indexpath, os.getpid())
+        with open(tmppath, 'w') as f_write:
+            json.dump(index, f_write, indent=1)
+        os.replace(tmppath, self.indexpath)
+
+    def source_digests(self, sources):
+        """content hashes of source files, remembered in the index by path, size and modification
+        time so that each file is only hashed once. Hashing is done without holding the lock.
+
+        Returns:
+            tuple -- (list of digests, dict of the digests that are new to the index)
+        """
+        paths = [os.path.abspath(source) for source in sources]
+        stats = [os.stat(path) for path in paths]
+        with self.locked() as index:
+            known = [index['digests'].get(path) for path in paths]
+        digests = []
+        new = {}
+        for path, stat, memo in zip(paths, stats, known):
+            if memo and memo['size'] == stat.st_size and memo['mtime'] == stat.st_mtime:
+                digests.append(memo['digest'])
+                continue
+            # the field cache may have hashed it already
+            digest = fc.cached_digest(path)
+            if digest is None:
+                digest = fc.file_digest(path)
+            digests.append(digest)
+            new[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest}
+        return digests, new
+
+    def request(self, sources, name, params, update=False):
+        """looks up an artifact, nothing but the index is read (and the sources hashed, the first
+        time they are seen)
+
+        Arguments:
+            sources {list} -- paths of the cube files the artifact is made from
+            name {string} -- readable file name, the key is added to it
+            params {dict} -- every option that changes the artifact, json serializable
+
+        Keyword Arguments:
+            update {bool} -- treat the artifact as missing, so that it is made again
+            (default: {False})
+
+        Returns:
+            Artifact -- the artifact, with exists set if it is in the cache
+        """
+        digests, new = self.source_digests(sources)
+        with self.locked() as index:
+            index['digests'].update(new)
+            key = hashlib.sha1(json.dumps({'version': VERSION, 'sources': digests,
+                                           'params': params}, sort_keys=True).encode()).hexdigest()
+            stem, ext = os.path.splitext(os.path.basename(name))
+            path = os.path.join(self.directory, '{}_{}{}'.format(stem, key[:12], ext))
+            entry = {'file': os.path.basename(path), 'sources': [os.path.abspath(source)
+                                                                 for source in sources],
+                     'params': params, 'size': 0, 'used': time.time()}
+            exists = not update and key in index['artifacts'] and os.path.isfile(path)
+            if exists:
+                index['artifacts'][key]['used'] = entry['used']
+                self.hits.add(path)
+            else:
+                index['artifacts'].pop(key, None)
+        return Artifact(self, key, path, entry, exists)
+
+    def commit(self, artifact):
+        """moves a written artifact into place, records it and evicts old artifacts if the cache
+        has grown past its budget
+        """
+        os.replace(artifact.tmppath, artifact.path)
+        artifact.entry['size'] = os.path.getsize(artifact.path)
+        artifact.entry['used'] = time.time()
+        with self.locked() as index:
+            index['artifacts'][artifact.key] = artifact.entry
+            self._evict(index, keep=artifact.key)
+
+    def evict(self, budget=None):
+        """removes the least recently used artifacts until the cache fits in the budget
+
+        Keyword Arguments:
+            budget {int} -- budget in bytes (default: {the budget of the cache})
+        """
+        with self.locked() as index:
+            self._evict(index, budget=budget)
+
+    def _evict(self, index, budget=None, keep=None):
+        if budget is None:
+            budget = self.budget
+        artifacts = index['artifacts']
+        total = sum(entry['size'] for entry in artifacts.values())
+        for key in sorted(artifacts, key=lambda key: artifacts[key]['used']):
+            if total <= budget:
+                break
+            if key == keep:
+                continue
+            entry = artifacts.pop(key)
+            total -= entry['size']
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except FileNotFoundError:
+                pass
+            print('evicted {} from the artifact cache'.format(entry['file']))
+
+    def size(self):
+        """total size in bytes of the artifacts in the cache
+        """
+        with self.locked() as index:
+            return sum(entry['size'] for entry in index['artifacts'].values())
@@ -0,0 +1,213 @@
+"""BATCH
+
+Runs the cube pipeline (header, body, color/emission voxels and isomeshes) over many cube files at
+once, e.g. every frame of a simulation:
+
+    python batch.py 'cube/*.cube' --isovalues 0.5 0.6 --workers 8 --memory 32
+
+Files are processed on a pool of processes that share the artifact cache, outputs already made
+from the same cube contents with the same options are skipped, and a manifest of the outputs and
+timings of every file is written to the dat folder.
+
+Author: Matthew Truscott
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import cube_reader as cr
+import field_cache as fc
+
+# the field and one normalized slab-sized temporary can be alive at once (rolling is done in
+# place), with some headroom for the voxel writers
+MEMORY_FACTOR = 2
+
+
+class BatchOptions():
+    """options shared by every file in a batch
+    """
+    def __init__(self):
+        self.color = True
+        self.emission = True
+        self.isovalues = []
+        self.roll = False
+        self.cache = False
+        self.dtype = 'float64'
+        self.parse_workers = 1
+        self.force = False
+        self.budget = None
+
+
+def find_cubes(patterns):
+    """expands glob patterns and directories into a sorted list of cube files
+
+    Arguments:
+        patterns {list} -- glob patterns, cube files or directories
+
+    Returns:
+        list -- absolute paths of the cube files
+    """
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.cube')
+        for path in glob.glob(pattern):
+            if os.path.isfile(path):
+                files.add(os.path.abspath(path))
+    return sorted(files)
+
+
+def estimate_memory(cube, parse_workers=1):
+    """rough peak memory needed to process a cube, in bytes. Parse workers split one text body and
+    write into one shared field, so together they add about one copy of the text and of the
+    parsed values on top, however many there are.
+
+    Arguments:
+        cube {Cube} -- the cube, with its header loaded
+
+    Keyword Arguments:
+        parse_workers {int} -- processes used to parse the field (default: {1})
+    """
+    fieldsize = int(np.prod(cube.field.gridsize)) * cube.field.dtype.itemsize
+    memory = fieldsize * MEMORY_FACTOR
+    if parse_workers > 1:
+        memory += os.path.getsize(cube.file) - cube.field.bodyoffset + fieldsize
+    return memory
+
+
+def total_memory():
+    """physical memory of this machine in bytes, or 4GB if it cannot be found
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 4 << 30
+
+
+def process_cube(path, options):
+    """runs the pipeline on a single cube file, outputs found in the artifact cache are not made
+    again and the field is only loaded if something needs making
+
+    Arguments:
+        path {string} -- path of the cube file
+        options {BatchOptions} -- what to make
+
+    Returns:
+        dict -- manifest entry with the outputs and the time taken by each step
+    """
+    entry = {'cube': path, 'outputs': {}, 'skipped': [], 'timings': {}}
+    start = time.time()
+    cube = cr.Cube(options.dtype)
+    cube.load_header(path)
+    cube.field_settings(roll=options.roll, cache=options.cache, workers=options.parse_workers,
+                        budget=options.budget)
+    entry['timings']['header'] = time.time() - start
+
+    outputs = entry['outputs']
+    start = time.time()
+    if options.color and options.emission:
+        # both voxels from a single pass over the field
+        outputs['color'], outputs['emission'] = cube.make_volume_voxels(update=options.force)
+        entry['timings']['voxels'] = time.time() - start
+    elif options.color:
+        outputs['color'] = cube.make_color_voxel(update=options.force)
+        entry['timings']['color'] = time.time() - start
+    elif options.emission:
+        outputs['emission'] = cube.make_emission_voxel(update=options.force)
+        entry['timings']['emission'] = time.time() - start
+
+    for val in options.isovalues:
+        kind = 'iso{}'.format(val)
+        start = time.time()
+        outputs[kind] = cube.make_isomesh(val, update=options.force)
+        entry['timings'][kind] = time.time() - start
+    entry['skipped'] = [kind for kind, opath in outputs.items() if opath in cube.artifacts.hits]
+    return entry
+
+
+def run_batch(files, options, workers=1, memory=None, manifest=None):
+    """processes a list of cube files on a pool of processes. The number of processes is capped so
+    that the largest cubes in the batch still fit in memory when processed side by side.
+
+    Arguments:
+        files {list} -- paths of the cube files
+        options {BatchOptions} -- what to make
+
+    Keyword Arguments:
+        workers {int} -- largest number of processes (default: {1})
+        memory {int} -- memory budget in bytes (default: {half of the physical memory})
+        manifest {string} -- path of the manifest file (default: {dat/manifest.json})
+
+    Returns:
+        list -- manifest entries, one per file
+    """
+    if memory is None:
+        memory = total_memory() // 2
+    if manifest is None:
+        manifest = os.path.join(fc.default_dir(), 'manifest.json')
+
+    # headers are cheap, read them all up front to size the pool
+    largest = 0
+    for path in files:
+        cube = cr.Cube(options.dtype)
+        cube.load_header(path)
+        largest = max(largest, estimate_memory(cube, options.parse_workers))
+    if largest:
+        workers = max(1, min(workers, memory // largest))
+    print('processing {} cube files with {} workers'.format(len(files), workers))
+
+    start = time.time()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(process_cube, files, [options] * len(files)))
+    else:
+        entries = [process_cube(path, options) for path in files]
+
+    os.makedirs(os.path.dirname(os.path.abspath(manifest)), exist_ok=True)
+    with open(manifest, 'w') as f_write:
+        json.dump({'elapsed': time.time() - start, 'workers': workers, 'files': entries},
+                  f_write, indent=1)
+    print('batch complete, time elapsed = {}s, manifest written to {}'.format(
+        time.time() - start, manifest))
+    return entries
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='run the cube pipeline over many cube files')
+    PARSER.add_argument('inputs', nargs='+', help='cube files, glob patterns or directories')
+    PARSER.add_argument('--isovalues', type=float, nargs='*', default=[],
+                        help='relative isovalues (between 0 and 1) to make isomeshes for')
+    PARSER.add_argument('--no-color', action='store_true', help='skip the color voxels')
+    PARSER.add_argument('--no-emission', action='store_true', help='skip the emission voxels')
+    PARSER.add_argument('--roll', action='store_true', help='roll the fields')
+    PARSER.add_argument('--cache', action='store_true', help='cache the parsed fields')
+    PARSER.add_argument('--dtype', default='float64', help='precision of the fields')
+    PARSER.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='largest number of files processed at once')
+    PARSER.add_argument('--parse-workers', type=int, default=1,
+                        help='processes used to parse each field')
+    PARSER.add_argument('--memory', type=float, default=None,
+                        help='memory budget in GB (default: half of the physical memory)')
+    PARSER.add_argument('--manifest', default=None, help='path of the manifest file')
+    PARSER.add_argument('--force', action='store_true', help='remake outputs that are up to date')
+    PARSER.add_argument('--cache-budget', type=float, default=None,
+                        help='disk budget of the artifact cache in GB (default: 8)')
+    ARGS = PARSER.parse_args()
+
+    OPTIONS = BatchOptions()
+    OPTIONS.color = not ARGS.no_color
+    OPTIONS.emission = not ARGS.no_emission
+    OPTIONS.isovalues = ARGS.isovalues
+    OPTIONS.roll = ARGS.roll
+    OPTIONS.cache = ARGS.cache
+    OPTIONS.dtype = ARGS.dtype
+    OPTIONS.parse_workers = ARGS.parse_workers
+    OPTIONS.force = ARGS.force
+    OPTIONS.budget = None if ARGS.cache_budget is None else int(ARGS.cache_budget * (1 << 30))
+    MEMORY = None if ARGS.memory is None else int(ARGS.memory * (1 << 30))
+    run_batch(find_cubes(ARGS.inputs), OPTIONS, ARGS.workers, MEMORY, ARGS.manifest)
@@ -0,0 +1,524 @@
+"""BENCHMARK
+
+Timing runs for the expensive parts of the cube pipeline, run on a real cube file or on synthetic
+densities, e.g.
+
+    python benchmark.py cube/3.cube --workers 32
+    python benchmark.py --blockindex 256
+    python benchmark.py --bonds 100000
+
+The suite writes synthetic cube files (gaussian blobs around a cluster of atoms, optionally with
+NaN points and a non-orthogonal cell) and times each stage of the pipeline on them. Results of a
+run can be saved as JSON and compared against an earlier run, e.g. of another commit
+
+    python benchmark.py --suite 32 64 128 256 --json before.json
+    python benchmark.py --suite 32 64 128 256 --json after.json --compare before.json
+
+Author: Matthew Truscott
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import mcubes
+import numpy as np
+
+import artifact_cache as ac
+import cube_reader as cr
+import mesh_io as mio
+import mesh_ops as mo
+import molecule
+import scalar_field as sf
+
+# version of the JSON written by save_results
+RESULTS_VERSION = 1
+
+# step vectors of the synthetic cells for a grid spacing of 1, as rows
+CELLS = {
+    'orthogonal': np.eye(3),
+    'monoclinic': np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0],
+                            [np.cos(np.radians(105.0)), 0.0, np.sin(np.radians(105.0))]]),
+    'hexagonal': np.array([[1.0, 0.0, 0.0], [-0.5, np.sqrt(3.0) / 2.0, 0.0], [0.0, 0.0, 1.0]]),
+}
+
+# stages timed by the suite, in the order they are run
+STAGES = ('header', 'body', 'roll', 'voxel', 'isosurface', 'bonds')
+
+
+def gaussian_blobs(shape, count=4, width=3.0, seed=0):
+    """a sparse density made of a few gaussian blobs, like an isolated molecule in a large cell
+
+    Arguments:
+        shape {tuple} -- gridsize
+
+    Keyword Arguments:
+        count {int} -- number of blobs (default: {4})
+        width {float} -- standard deviation of each blob, in grid points (default: {3.0})
+        seed {int} -- random seed for the blob centres (default: {0})
+
+    Returns:
+        np array -- the density
+    """
+    rng = np.random.default_rng(seed)
+    gauss = blob_profiles(shape, rng.random((count, 3)) * np.array(shape), width)
+    field = np.zeros(shape)
+    for blob in range(count):
+        field += (gauss[0][blob][:, None, None] * gauss[1][blob][None, :, None]
+                  * gauss[2][blob][None, None, :])
+    return field
+
+
+def blob_profiles(shape, centres, width):
+    """gaussian blobs are separable, so each is given by one 1D gaussian per axis
+
+    Arguments:
+        shape {tuple} -- gridsize
+        centres {np array} -- (count, 3) centres of the blobs, in grid points
+        width {float} -- standard deviation of each blob, in grid points
+
+    Returns:
+        list -- per axis, (count, n) gaussians
+    """
+    return [np.exp(-(np.arange(n, dtype=float)[None, :] - np.asarray(centres)[:, axis, None]) ** 2
+                   / (2.0 * width * width)) for axis, n in enumerate(shape)]
+
+
+def write_cube(path, shape, atoms=16, nan_fraction=0.0, cell='orthogonal', spacing=0.2,
+               seed=0):
+    """writes a synthetic cube file: a cluster of atoms in the middle of the cell (at about the
+    density of liquid water, so that they bond) with a gaussian blob of density on each atom. The
+    field is written plane by plane, so large grids do not have to fit in memory.
+
+    Arguments:
+        path {string} -- path of the cube file
+        shape {tuple} -- gridsize
+
+    Keyword Arguments:
+        atoms {int} -- number of atoms (default: {16})
+        nan_fraction {float} -- fraction of the points written as NaN (default: {0.0})
+        cell {string} -- shape of the cell, see CELLS (default: {'orthogonal'})
+        spacing {float} -- length of the step vectors, in bohr (default: {0.2})
+        seed {int} -- random seed for the atoms and NaN points (default: {0})
+    """
+    rng = np.random.default_rng(seed)
+    shape = np.asarray(shape, dtype=int)
+    steps = CELLS[cell] * spacing
+    inverse = np.linalg.inv(steps)
+
+    # atoms in a ball around the centre of the cell, up to the size of the cell
+    radius = (3.0 * atoms / (4.0 * np.pi * 0.015)) ** (1.0 / 3.0)
+    radius = min(radius, 0.4 * np.min(shape * np.linalg.norm(steps, axis=1)))
+    directions = rng.normal(size=(atoms, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    positions = (directions * radius * rng.random((atoms, 1)) ** (1.0 / 3.0)
+                 + (shape / 2.0).dot(steps))
+    species = rng.choice([1, 1, 6, 7, 8], atoms)
+    # blobs about the size of an atom, but at least a couple of grid points wide
+    gauss = blob_profiles(shape, positions.dot(inverse), max(2.0, 1.0 / spacing))
+
+    values = ' %12.5E' * 6 + '\n'
+    row = values * (shape[2] // 6)
+    if shape[2] % 6:
+        row += ' %12.5E' * (shape[2] % 6) + '\n'
+    plane_format = row * shape[1]
+    with open(path, 'w') as f_write:
+        f_write.write(' synthetic cube file\n {} atoms, {} cell\n'.format(atoms, cell))
+        f_write.write('{:5d} {:11.6f} {:11.6f} {:11.6f}\n'.format(atoms, 0.0, 0.0, 0.0))
+        for size, step in zip(shape, steps):
+            f_write.write('{:5d} {:11.6f} {:11.6f} {:11.6f}\n'.format(size, *step))
+        for number, position in zip(species, positions):
+            f_write.write('{:5d} {:11.6f} {:11.6f} {:11.6f} {:11.6f}\n'.format(
+                number, float(number), *position))
+        for x in range(shape[0]):
+            plane = np.einsum('b,bj,bk->jk', gauss[0][:, x], gauss[1], gauss[2])
+            if nan_fraction > 0:
+                plane[rng.random(plane.shape) < nan_fraction] = np.nan
+            f_write.write(plane_format % tuple(plane.ravel()))
+
+
+def bench_workers(path, max_workers, repeat=1):
+    """times the body parse for 1 up to max_workers processes (doubling each time)
+
+    Arguments:
+        path {string} -- path of the cube file
+        max_workers {int} -- largest number of processes to try
+
+    Keyword Arguments:
+        repeat {int} -- number of runs per worker count, the fastest is kept (default: {1})
+
+    Returns:
+        list -- (workers, seconds) for each worker count
+    """
+    counts = []
+    workers = 1
+    while workers < max_workers:
+        counts.append(workers)
+        workers *= 2
+    counts.append(max_workers)
+
+    results = []
+    for workers in counts:
+        best = None
+        for _ in range(repeat):
+            cube = cr.Cube()
+            cube.load_header(path)
+            start = time.perf_counter()
+            cube.load_body(workers=workers)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((workers, best))
+
+    base = results[0][1]
+    print('workers   time (s)   speedup')
+    for workers, elapsed in results:
+        print('{:7d} {:10.3f} {:9.2f}'.format(workers, elapsed, base / elapsed))
+    return results
+
+
+def bench_blockindex(size, isovalue=0.3, brick=8, blobs=4):
+    """compares full grid marching cubes against extraction on the active blocks of the block
+    index, for a sparse density
+
+    Arguments:
+        size {int} -- edge length of the (cubic) grid
+
+    Keyword Arguments:
+        isovalue {float} -- absolute isovalue, the blobs peak at about 1 (default: {0.3})
+        brick {int} -- brick size of the block index (default: {8})
+        blobs {int} -- number of blobs in the density (default: {4})
+
+    Returns:
+        dict -- timings in seconds and triangle counts
+    """
+    field = sf.ScalarField()
+    field.gridsize = np.array((size, size, size))
+    field.set_field(gaussian_blobs(field.gridsize, blobs))
+
+    start = time.perf_counter()
+    _, triangles = mcubes.marching_cubes(field.field, isovalue)
+    results = {'full': time.perf_counter() - start, 'triangles': len(triangles)}
+    start = time.perf_counter()
+    field.build_blockindex(brick)
+    results['index'] = time.perf_counter() - start
+
+    print('grid {}^3, {} triangles'.format(size, len(triangles)))
+    print('full grid        {:10.3f}s'.format(results['full']))
+    print('index build      {:10.3f}s'.format(results['index']))
+    for level in range(min(3, len(field.blockindex))):
+        start = time.perf_counter()
+        blocks = field.active_blocks(isovalue, level)
+        _, triangles = cr.marching_cubes(field.field, isovalue, blocks)
+        elapsed = time.perf_counter() - start
+        results['level{}'.format(level)] = elapsed
+        print('blocks of {:<4d}   {:10.3f}s  ({} active, {} triangles)'.format(
+            field.block_size(level), elapsed, len(blocks), len(triangles)))
+    return results
+
+
+def bench_mesh_formats(size, isovalue=0.3, blobs=16):
+    """compares write time, file size and reload time of the isomesh formats
+
+    Arguments:
+        size {int} -- edge length of the (cubic) grid the mesh is extracted from
+
+    Keyword Arguments:
+        isovalue {float} -- absolute isovalue (default: {0.3})
+        blobs {int} -- number of blobs in the density, more blobs make a bigger mesh (default: {16})
+
+    Returns:
+        dict -- per format: write and reload times in seconds, size in bytes
+    """
+    vertices, triangles = mcubes.marching_cubes(gaussian_blobs((size, size, size), blobs), isovalue)
+    print('mesh of {} vertices, {} triangles'.format(len(vertices), len(triangles)))
+    print('format   write (s)   size (MB)   reload (s)')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for fmt in mio.FORMATS:
+            path = os.path.join(tmpdir, 'mesh.' + fmt)
+            start = time.perf_counter()
+            mio.save_mesh(path, vertices, triangles)
+            write = time.perf_counter() - start
+            start = time.perf_counter()
+            if fmt == 'dae':
+                # blender parses the xml, pycollada is the closest stand in outside of blender
+                import collada
+                collada.Collada(path)
+            else:
+                loaded, faces, _ = mio.load_mesh(path)
+                # touch the data, memory mapped arrays are otherwise not read at all
+                float(np.sum(loaded)) + int(np.sum(faces))
+            reload = time.perf_counter() - start
+            results[fmt] = {'write': write, 'size': os.path.getsize(path), 'reload': reload}
+            print('{:6} {:11.3f} {:11.2f} {:12.3f}'.format(fmt, write, results[fmt]['size'] / 1e6,
+                                                          reload))
+    return results
+
+
+def bench_decimate(size, budgets=(100000, 20000, 5000), isovalue=0.3, blobs=16):
+    """times welding and decimation of a marching cubes mesh to a series of triangle budgets
+
+    Arguments:
+        size {int} -- edge length of the (cubic) grid the mesh is extracted from
+
+    Keyword Arguments:
+        budgets {tuple} -- triangle budgets, the first for the main mesh and the rest as levels of
+        detail (default: {(100000, 20000, 5000)})
+        isovalue {float} -- absolute isovalue (default: {0.3})
+        blobs {int} -- number of blobs in the density (default: {16})
+
+    Returns:
+        list -- report of each step, see mesh_ops.postprocess
+    """
+    vertices, triangles = mcubes.marching_cubes(gaussian_blobs((size, size, size), blobs), isovalue)
+    print('mesh of {} vertices, {} triangles'.format(len(vertices), len(triangles)))
+    _, _, report = mo.postprocess(vertices, triangles, budgets[0], list(budgets[1:]))
+    return report
+
+
+def bench_bonds(max_atoms, density=0.015, periodic=True, seed=0):
+    """times bond detection on random atoms at about the density of liquid water, for 1000 up to
+    max_atoms atoms (doubling each time)
+
+    Arguments:
+        max_atoms {int} -- largest number of atoms
+
+    Keyword Arguments:
+        density {float} -- atoms per cubic bohr (default: {0.015})
+        periodic {bool} -- also find bonds across the cell boundaries (default: {True})
+        seed {int} -- random seed for the atoms (default: {0})
+
+    Returns:
+        list -- (atoms, bonds, seconds) for each atom count
+    """
+    counts = []
+    atoms = 1000
+    while atoms < max_atoms:
+        counts.append(atoms)
+        atoms *= 2
+    counts.append(max_atoms)
+
+    rng = np.random.default_rng(seed)
+    table = molecule.bond_table()
+    results = []
+    print('atoms      bonds   time (s)')
+    for atoms in counts:
+        cell = np.eye(3) * (atoms / density) ** (1.0 / 3.0)
+        positions = rng.random((atoms, 3)).dot(cell)
+        species = rng.choice([1, 1, 6, 7, 8], atoms)
+        start = time.perf_counter()
+        bonds = molecule.find_bonds(positions, species, table, cell if periodic else None)
+        elapsed = time.perf_counter() - start
+        results.append((atoms, len(bonds), elapsed))
+        print('{:7d} {:8d} {:10.3f}'.format(atoms, len(bonds), elapsed))
+    return results
+
+
+def run_suite(sizes, atoms=16, nan_fraction=0.0, cell='orthogonal', isovalue=0.3, repeat=1,
+              directory=None):
+    """times every stage of the pipeline (see STAGES) on synthetic cube files of each grid size,
+    see write_cube. Files and artifacts go to a temporary directory unless one is given, in which
+    case cube files already there are reused.
+
+    Arguments:
+        sizes {list} -- edge lengths of the (cubic) grids, e.g. 32 up to 512
+
+    Keyword Arguments:
+        atoms {int} -- number of atoms (default: {16})
+        nan_fraction {float} -- fraction of the points written as NaN (default: {0.0})
+        cell {string} -- shape of the cell, see CELLS (default: {'orthogonal'})
+        isovalue {float} -- absolute isovalue of the isosurface, the blobs peak at about 1
+        (default: {0.3})
+        repeat {int} -- number of runs per size, the fastest time of each stage is kept
+        (default: {1})
+        directory {string} -- folder for the cube files and artifacts (default: {None})
+
+    Returns:
+        list -- one dict per size and stage, with the time in seconds and what was made
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if directory is None:
+            directory = tmpdir
+        os.makedirs(directory, exist_ok=True)
+        artifacts = ac.ArtifactCache(os.path.join(directory, 'artifacts'))
+        records = []
+        for size in sizes:
+            # no dots before the extension, the cube is named after the file
+            path = os.path.join(directory, 'synthetic{}_{}_{}_{}.cube'.format(
+                size, atoms, '{:g}'.format(nan_fraction).replace('.', 'p'), cell))
+            if not os.path.isfile(path):
+                start = time.perf_counter()
+                write_cube(path, (size, size, size), atoms, nan_fraction, cell)
+                print('{}^3 cube written ({:.1f} MB), time elapsed = {}s'.format(
+                    size, os.path.getsize(path) / 1e6, time.perf_counter() - start))
+            # hash the file once up front, so that the voxel timings do not include it
+            artifacts.source_digests([path])
+
+            best = {}
+            counts = {}
+            for _ in range(repeat):
+                cube = cr.Cube()
+                cube.artifacts = artifacts
+                timings = {}
+                start = time.perf_counter()
+                cube.load_header(path)
+                timings['header'] = time.perf_counter() - start
+                start = time.perf_counter()
+                cube.load_body()
+                timings['body'] = time.perf_counter() - start
+                start = time.perf_counter()
+                cube.recentre()
+                timings['roll'] = time.perf_counter() - start
+                start = time.perf_counter()
+                cube.make_volume_voxels(update=True)
+                timings['voxel'] = time.perf_counter() - start
+                start = time.perf_counter()
+                _, triangles, _ = cube.isomesh(isovalue, absolute=True)
+                timings['isosurface'] = time.perf_counter() - start
+                counts['isosurface'] = {'triangles': len(triangles)}
+                start = time.perf_counter()
+                cube.molecule.create_bonds()
+                timings['bonds'] = time.perf_counter() - start
+                counts['bonds'] = {'bonds': len(cube.molecule.bondlist)}
+                for stage, elapsed in timings.items():
+                    best[stage] = min(best.get(stage, elapsed), elapsed)
+
+            print('{}^3 grid, {} atoms, {} cell'.format(size, atoms, cell))
+            for stage in STAGES:
+                record = {'size': size, 'atoms': atoms, 'nan_fraction': nan_fraction,
+                          'cell': cell, 'stage': stage, 'seconds': best[stage]}
+                record.update(counts.get(stage, {}))
+                records.append(record)
+                print('    {:12} {:10.3f}s'.format(stage, best[stage]))
+    return records
+
+
+def machine_info():
+    """the commit and machine a run was made on, so that results of different runs can be told
+    apart
+
+    Returns:
+        dict -- commit, whether the tree had changes, platform and package versions
+    """
+    directory = os.path.dirname(os.path.realpath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=directory, check=True,
+                                capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    cwd=directory, check=True, capture_output=True,
+                                    text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {'commit': commit, 'dirty': dirty, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def save_results(path, results):
+    """writes the results of a run to a JSON file, together with machine_info
+
+    Arguments:
+        path {string} -- path of the JSON file
+        results {dict} -- results of each benchmark, keyed by name
+    """
+    document = {'version': RESULTS_VERSION,
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'machine': machine_info(), 'results': results}
+    with open(path, 'w') as f_write:
+        json.dump(document, f_write, indent=1, default=_json_default)
+
+
+def compare(old, new, tolerance=0.1, floor=0.01):
+    """compares the suite timings of two runs (see save_results), matching stages by size, atoms,
+    NaN fraction and cell
+
+    Arguments:
+        old {dict} -- the earlier run, as read from its JSON file
+        new {dict} -- the later run
+
+    Keyword Arguments:
+        tolerance {float} -- relative slowdown reported as a regression (default: {0.1})
+        floor {float} -- slowdowns of less than this many seconds are left out as noise
+        (default: {0.01})
+
+    Returns:
+        list -- the records of new that are slower than in old, with the old time added
+    """
+    def key(record):
+        return (record['size'], record['atoms'], record['nan_fraction'], record['cell'],
+                record['stage'])
+    before = {key(record): record for record in old['results'].get('suite', [])}
+    print('comparing against {} ({})'.format(old['machine']['commit'], old['date']))
+    print('size   stage         before (s)   after (s)   ratio')
+    regressions = []
+    for record in new['results'].get('suite', []):
+        match = before.get(key(record))
+        if match is None:
+            continue
+        ratio = record['seconds'] / max(match['seconds'], 1e-9)
+        flag = ''
+        if ratio > 1.0 + tolerance and record['seconds'] - match['seconds'] > floor:
+            flag = '  slower'
+            regressions.append(dict(record, before=match['seconds']))
+        print('{:4d}   {:12} {:11.3f} {:11.3f} {:7.2f}{}'.format(
+            record['size'], record['stage'], match['seconds'], record['seconds'], ratio, flag))
+    return regressions
+
+
+def _json_default(value):
+    # numpy scalars and arrays, e.g. in the mesh reports
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='benchmark the cube pipeline')
+    PARSER.add_argument('cube', nargs='?', help='cube file to benchmark on')
+    PARSER.add_argument('--workers', type=int, default=1, help='largest number of parse processes')
+    PARSER.add_argument('--repeat', type=int, default=1, help='runs per measurement')
+    PARSER.add_argument('--blockindex', type=int, default=0,
+                        help='grid size for the block index benchmark on a sparse density')
+    PARSER.add_argument('--meshformats', type=int, default=0,
+                        help='grid size for the mesh format benchmark')
+    PARSER.add_argument('--decimate', type=int, default=0,
+                        help='grid size for the mesh decimation benchmark')
+    PARSER.add_argument('--bonds', type=int, default=0,
+                        help='largest number of atoms for the bond detection benchmark')
+    PARSER.add_argument('--suite', type=int, nargs='+', default=[],
+                        help='grid sizes for the pipeline benchmark on synthetic cubes, e.g. 32 64')
+    PARSER.add_argument('--atoms', type=int, default=16, help='atoms in the synthetic cubes')
+    PARSER.add_argument('--nan', type=float, default=0.0,
+                        help='fraction of NaN points in the synthetic cubes')
+    PARSER.add_argument('--cell', choices=sorted(CELLS), default='orthogonal',
+                        help='cell of the synthetic cubes')
+    PARSER.add_argument('--dir', help='keep the synthetic cubes in this folder, to reuse them')
+    PARSER.add_argument('--json', help='write the results to this JSON file')
+    PARSER.add_argument('--compare', help='JSON file of an earlier run to compare the suite with')
+    ARGS = PARSER.parse_args()
+    RESULTS = {}
+    if ARGS.cube:
+        RESULTS['workers'] = bench_workers(ARGS.cube, ARGS.workers, ARGS.repeat)
+    if ARGS.blockindex:
+        RESULTS['blockindex'] = bench_blockindex(ARGS.blockindex)
+    if ARGS.meshformats:
+        RESULTS['meshformats'] = bench_mesh_formats(ARGS.meshformats)
+    if ARGS.decimate:
+        RESULTS['decimate'] = bench_decimate(ARGS.decimate)
+    if ARGS.bonds:
+        RESULTS['bonds'] = bench_bonds(ARGS.bonds)
+    if ARGS.suite:
+        RESULTS['suite'] = run_suite(ARGS.suite, ARGS.atoms, ARGS.nan, ARGS.cell,
+                                     repeat=ARGS.repeat, directory=ARGS.dir)
+    if ARGS.json:
+        save_results(ARGS.json, RESULTS)
+    if ARGS.compare:
+        with open(ARGS.compare, 'r') as f_read:
+            OLD = json.load(f_read)
+        compare(OLD, {'results': RESULTS})
@@ -20,7 +20,8 @@ def create_scene():
 	cube = cr.Cube()
 	# load the molecule
 	cube.load_header('cube/3.cube')
-	#cube.field_settings(roll=True)
+	cube.field_settings(cache=True)
+	#cube.field_settings(roll=True, cache=True)
 
 	# clean up
 	ub.removeAll()
@@ -37,10 +38,9 @@ def create_scene():
 	# TODO make volume a class so that one can successively render objects with persistence
 	#vol = uv.add_volume(cube, update=False)
 	#uv.set_volume_color(vol)
-	#iso = uv.add_isosurface(cube, 0.5, update=True)
-	#iso = uv.add_isosurface(cube, 0.6, update=True)
-	# for the above (more than one call) need to have smarter filenaming, and
-	# need to change the max allowed reflections for reasonable transparency
+	#isos = uv.add_isosurfaces(cube, [0.5, 0.6], update=True)
+	# for the above (more than one surface) need to change the max allowed reflections for
+	# reasonable transparency
 
 	# update molecule in order to get pointers to names of rendered objects, for future editing
 	cube = um.draw_molecule(cube, bonds=True)
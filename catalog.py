@@ -0,0 +1,200 @@
+"""CATALOG
+
+Index of the headers of a collection of cube files, kept in a SQLite database in the dat folder.
+Each file is read once, later updates only re-read files whose size or modification time have
+changed, and queries return Cube objects with their headers restored from the index, e.g. all
+frames with at least 300 points along each axis that contain nitrogen:
+
+    python catalog.py 'cube/*.cube' --min-grid 300 --species 7
+
+Author: Matthew Truscott
+"""
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import batch
+import cube_reader as cr
+import field_cache as fc
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cubes (
+    path TEXT PRIMARY KEY,
+    name TEXT,
+    size INTEGER,
+    mtime REAL,
+    nx INTEGER,
+    ny INTEGER,
+    nz INTEGER,
+    atomcount INTEGER,
+    bodyoffset INTEGER,
+    header TEXT
+);
+CREATE TABLE IF NOT EXISTS species (
+    path TEXT,
+    species INTEGER,
+    count INTEGER
+);
+CREATE INDEX IF NOT EXISTS species_index ON species (species, path);
+"""
+
+
+class Catalog():
+    """header index of many cube files
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(fc.default_dir(), 'catalog.sqlite')
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """connection to the database, changes are committed on exit
+        """
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def update(self, patterns):
+        """adds new and changed cube files to the catalog, and drops files that no longer exist
+
+        Arguments:
+            patterns {list} -- glob patterns, cube files or directories, see batch.find_cubes
+
+        Returns:
+            int -- number of headers read
+        """
+        start = time.time()
+        with self.connect() as conn:
+            known = {path: (size, mtime) for path, size, mtime in
+                     conn.execute('SELECT path, size, mtime FROM cubes')}
+        cubes = []
+        for path in batch.find_cubes(patterns):
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_size, stat.st_mtime):
+                continue
+            cube = cr.Cube()
+            cube.load_header(path)
+            cubes.append((cube, stat))
+        removed = [path for path in known if not os.path.isfile(path)]
+
+        with self.connect() as conn:
+            for path in removed:
+                conn.execute('DELETE FROM cubes WHERE path = ?', (path,))
+                conn.execute('DELETE FROM species WHERE path = ?', (path,))
+            for cube, stat in cubes:
+                _insert(conn, cube, stat)
+        unchanged = len(known) - len(removed) - sum(cube.file in known for cube, _ in cubes)
+        print('catalog updated, {} read, {} unchanged, {} removed, time elapsed = {}s'.format(
+            len(cubes), unchanged, len(removed), time.time() - start))
+        return len(cubes)
+
+    def query(self, min_grid=None, max_grid=None, species=None, min_atoms=None, max_atoms=None,
+              name=None, dtype=float):
+        """cube files in the catalog that match all the given conditions, with their headers
+        restored from the catalog. Files changed since the last update have their headers read
+        again.
+
+        Keyword Arguments:
+            min_grid {int} -- least number of grid points along every axis (default: {None})
+            max_grid {int} -- most number of grid points along every axis (default: {None})
+            species {list} -- atomic numbers that must all be present (default: {None})
+            min_atoms {int} -- least number of atoms (default: {None})
+            max_atoms {int} -- most number of atoms (default: {None})
+            name {str} -- glob pattern on the cube name, e.g. 'frame_*' (default: {None})
+            dtype {np.dtype} -- precision of the fields of the returned cubes (default: {float})
+
+        Returns:
+            list -- Cube objects, sorted by path
+        """
+        conditions = []
+        args = []
+        if min_grid is not None:
+            conditions.append('MIN(nx, ny, nz) >= ?')
+            args.append(min_grid)
+        if max_grid is not None:
+            conditions.append('MAX(nx, ny, nz) <= ?')
+            args.append(max_grid)
+        for element in (species or []):
+            conditions.append('path IN (SELECT path FROM species WHERE species = ?)')
+            args.append(int(element))
+        if min_atoms is not None:
+            conditions.append('atomcount >= ?')
+            args.append(min_atoms)
+        if max_atoms is not None:
+            conditions.append('atomcount <= ?')
+            args.append(max_atoms)
+        if name is not None:
+            conditions.append('name GLOB ?')
+            args.append(name)
+        sql = 'SELECT path, size, mtime, header FROM cubes'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        with self.connect() as conn:
+            rows = conn.execute(sql + ' ORDER BY path', args).fetchall()
+
+        cubes = []
+        for path, size, mtime, header in rows:
+            cube = cr.Cube(dtype)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                print('{} no longer exists, skipping'.format(path))
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                print('{} has changed since it was cataloged, reading its header'.format(path))
+                cube.load_header(path)
+                with self.connect() as conn:
+                    _insert(conn, cube, stat)
+            else:
+                cube.set_header(json.loads(header))
+            cubes.append(cube)
+        return cubes
+
+
+def _insert(conn, cube, stat):
+    # add or replace the catalog entry of a cube
+    header = cube.get_header()
+    conn.execute('INSERT OR REPLACE INTO cubes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (cube.file, cube.name, stat.st_size, stat.st_mtime) + tuple(header['gridsize'])
+                 + (header['atomcount'], header['bodyoffset'], json.dumps(header)))
+    conn.execute('DELETE FROM species WHERE path = ?', (cube.file,))
+    elements, counts = np.unique(cube.molecule.a_species, return_counts=True)
+    conn.executemany('INSERT INTO species VALUES (?, ?, ?)',
+                     [(cube.file, int(element), int(count))
+                      for element, count in zip(elements, counts)])
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='index and query the headers of cube files')
+    PARSER.add_argument('inputs', nargs='*', help='cube files, glob patterns or directories to add')
+    PARSER.add_argument('--catalog', default=None, help='path of the catalog database')
+    PARSER.add_argument('--min-grid', type=int, default=None,
+                        help='least number of grid points along every axis')
+    PARSER.add_argument('--max-grid', type=int, default=None,
+                        help='most number of grid points along every axis')
+    PARSER.add_argument('--species', type=int, nargs='*', default=None,
+                        help='atomic numbers that must all be present')
+    PARSER.add_argument('--min-atoms', type=int, default=None, help='least number of atoms')
+    PARSER.add_argument('--max-atoms', type=int, default=None, help='most number of atoms')
+    PARSER.add_argument('--name', default=None, help='glob pattern on the cube names')
+    ARGS = PARSER.parse_args()
+
+    CATALOG = Catalog(ARGS.catalog)
+    if ARGS.inputs:
+        CATALOG.update(ARGS.inputs)
+    for CUBE in CATALOG.query(ARGS.min_grid, ARGS.max_grid, ARGS.species, ARGS.min_atoms,
+                              ARGS.max_atoms, ARGS.name):
+        print('{}  grid {}  {} atoms'.format(CUBE.file, CUBE.field.gridsize.tolist(),
+                                            CUBE.molecule.atomcount))
@@ -8,6 +8,8 @@ Author: Matthew Truscott
 import os
 import time
 import sys
+import multiprocessing
+from multiprocessing import shared_memory
 
 # required packages
 import mcubes
@@ -17,12 +19,20 @@ import numpy as np
 # local imports
 import scalar_field as sf
 import molecule as mol
+import field_cache as fc
+import mesh_io as mio
+import mesh_ops as mo
+import transfer as tf
+import artifact_cache as ac
 
 class CubeSettings():
     """cube reading settings container
     """
     def __init__(self):
         self.roll = False
+        self.cache = False
+        self.stream = False
+        self.workers = 1
 
 class Cube():
     """.cube object container
@@ -30,12 +40,16 @@ class Cube():
     that is, for large objects, loading is done lazily
     """
 
-    def __init__(self):
+    def __init__(self, dtype=float):
         # all information relating to the field is stored here
-        self.field = sf.ScalarField()
+        self.field = sf.ScalarField(dtype)
         # all atomic information is stored here
         self.molecule = mol.Molecule()
         self.settings = CubeSettings()
+        # derived files (voxels, isomeshes, downsampled fields) are kept here
+        self.artifacts = ac.ArtifactCache()
+        # byte offset of each x plane in the body, see slab_index
+        self.slabindex = None
         self.file = None
         self.name = None
 
@@ -57,9 +71,15 @@ class Cube():
         self.field.load_file(abspath)
         self.molecule.load_file(abspath)
 
-        with open(file, 'r') as f_read:
+        with open(file, 'rb') as f_read:
             atomcount = 0
+            offset = 0
             for idx, line in enumerate(f_read):
+                if idx > (5 + atomcount):
+                    break
+                # keep track of where the header ends so that the body can be read directly
+                offset += len(line)
+                line = line.decode()
                 if idx < 2:
                     # This is currently the expected output from Quantum ESPRESSO with Environ
                     # There may be more or less text here, so TODO generalize
@@ -83,55 +103,581 @@ class Cube():
                     line_elements = re.split(r'\s+', line.strip())
                     self.molecule.add_atom(idx-6, line_elements)
                     continue
-                if idx > (5 + atomcount):
-                    break
 
+        self.field.set_bodyoffset(offset)
         self.field.add_scaling()
         self.molecule.transform(self.field.transform)
 
 
-    def field_settings(self, roll=False):
+    def get_header(self):
+        """header details in a json friendly form, enough to restore the cube without reading the
+        header again
+
+        Returns:
+            dict -- the header details
+        """
+        return {
+            'file': self.file,
+            'name': self.name,
+            'gridsize': self.field.gridsize.tolist(),
+            'transform': self.field.transform.tolist(),
+            'meshtransform': self.field.meshtransform.tolist(),
+            'bodyoffset': self.field.bodyoffset,
+            'atomcount': self.molecule.atomcount,
+            'species': self.molecule.a_species.tolist(),
+            'charges': self.molecule.a_charges.tolist(),
+            'positions': self.molecule.m_positions.tolist(),
+        }
+
+
+    def set_header(self, header):
+        """restores the header details saved by get_header, without reading the cube file
+
+        Arguments:
+            header {dict} -- the header details, see get_header
+        """
+        self.file = header['file']
+        self.name = header['name']
+        self.field.load_file(self.file)
+        self.molecule.load_file(self.file)
+        self.field.gridsize = np.array(header['gridsize'], dtype=int)
+        self.field.transform = np.array(header['transform'], dtype=float)
+        self.field.meshtransform = np.array(header['meshtransform'], dtype=float)
+        self.field.set_bodyoffset(header['bodyoffset'])
+        self.molecule.load_empty(header['atomcount'])
+        self.molecule.a_species[:] = header['species']
+        self.molecule.a_charges[:] = header['charges']
+        self.molecule.m_positions[:] = np.reshape(header['positions'], (-1, 3))
+
+
+    def field_settings(self, roll=None, cache=None, stream=None, workers=None, dtype=None,
+                       budget=None):
         """Settings for the field container
         
         Keyword Arguments:
             roll {bool} -- Roll the field in order to correctly display isolated
-            molecules that are defined across cell edges (default: {False})
+            molecules that are defined across cell edges, True shifts by half the cell, or give
+            the shift in grid points along each axis, see recentre. False undoes any shift
+            (default: {None, unchanged})
+            cache {bool} -- Keep a binary copy of the parsed field in the dat folder, so
+            that later loads memory map it instead of parsing the cube again (default: {None,
+            unchanged, off for a new cube})
+            stream {bool} -- Never hold the full field in memory, voxel files are built from
+            x-slabs read straight from the cube file (default: {None, unchanged, off for a new
+            cube})
+            workers {int} -- Number of processes used to parse the field (default: {None,
+            unchanged, 1 for a new cube})
+            dtype {np.dtype} -- Precision the field is stored in, float32 halves the memory
+            needed and is carried through to the voxel files (default: {None, unchanged})
+            budget {int} -- Disk budget of the artifact cache in bytes, the least recently used
+            voxels and meshes are removed beyond it (default: {None, unchanged})
+        """
+        if roll is not None:
+            self.settings.roll = roll
+            if isinstance(roll, (bool, np.bool_)):
+                shift = self.field.roll_shift() if roll else np.zeros((3,), dtype=int)
+            else:
+                shift = np.asarray(roll, dtype=int)
+            # relative to the shift already applied, so that the settings can be changed any time
+            self.recentre(shift - self.field.shift)
+        if cache is not None:
+            self.settings.cache = cache
+        if stream is not None:
+            self.settings.stream = stream
+        if workers is not None:
+            self.settings.workers = workers
+        if dtype is not None:
+            self.field.set_dtype(dtype)
+        if budget is not None:
+            self.artifacts.budget = budget
+
+
+    def recentre(self, shift=None):
+        """Moves the field periodically, grid point i goes to i + shift, e.g. to bring a molecule
+        that is split across the cell edges back together. A loaded field is moved in place,
+        otherwise the shift is applied as the field is loaded or streamed. The atoms are moved
+        along, wrapped into the cell, and the total shift is kept in field.shift, which the
+        isomeshes and voxels are keyed on.
+
+        Keyword Arguments:
+            shift {np array} -- shift in grid points along each axis (default: {half the cell})
+        """
+        if shift is None:
+            shift = self.field.roll_shift()
+        shift = np.asarray(shift, dtype=int) % self.field.gridsize
+        if not np.any(shift):
+            return
+        self.field.roll(shift)
+        # molecule positions are centred on the cell, see Molecule.transform
+        steps = self.field.meshtransform[0:3, 0:3]
+        offset = self.field.transform.diagonal()[0:3] / 2.0 - self.field.meshtransform[3, 0:3]
+        points = (self.molecule.m_positions + offset).dot(np.linalg.inv(steps))
+        points = (points + shift) % self.field.gridsize
+        self.molecule.m_positions = points.dot(steps) - offset
+
+
+    def centre_on_atom(self, index):
+        """Moves the field (see recentre) so that an atom sits at the centre of the cell, to the
+        nearest grid point
+
+        Arguments:
+            index {int} -- index of the atom
         """
-        self.settings.roll = roll
+        # molecule positions are centred on the cell, see Molecule.transform
+        steps = self.field.meshtransform[0:3, 0:3]
+        offset = self.field.transform.diagonal()[0:3] / 2.0 - self.field.meshtransform[3, 0:3]
+        point = (self.molecule.m_positions[index] + offset).dot(np.linalg.inv(steps))
+        self.recentre(np.round(self.field.gridsize / 2.0 - point).astype(int))
 
 
-    def load_body(self):
+    def load_cached(self):
+        """Memory maps the cached field, if caching is enabled and the cache is valid
+
+        Returns:
+            tuple -- (field, metadata), or (None, None) if there is no usable cache
+        """
+        if not self.settings.cache:
+            return None, None
+        field, meta = fc.load(self.file, dtype=self.field.dtype)
+        if field is not None and meta['header']['gridsize'] != self.field.gridsize.tolist():
+            print('field cache header does not match {}, rebuilding'.format(self.file))
+            return None, None
+        return field, meta
+
+
+    def load_body(self, workers=None):
         """Reads in the field
+
+        Keyword Arguments:
+            workers {int} -- Number of processes used to parse the field, see field_settings
+            (default: {None})
         """
         start = time.time()
-        print('reading field...')
-        self.field.init_field()
-        with open(self.file, 'r') as f_read:
-            f_x = 0
-            f_y = 0
-            f_z = 0
-            for idx, line in enumerate(f_read):
-                if idx < (6 + self.molecule.atomcount):
-                    continue
-                line_elements = re.split(r'\s+', line.strip())
-                for element in line_elements:
-                    if element is None or element == '':
-                        continue
-                    elif element == 'NaN':
-                        self.field.field[f_x, f_y, f_z] = 0.0
-                    else:
-                        self.field.field[f_x, f_y, f_z] = element
-                    f_x, f_y, f_z = self.field.increment_idx(f_x, f_y, f_z)
-                    if f_x < 0:
-                        break
-
-        if self.settings.roll:
-            self.field.roll()
+        if workers is None:
+            workers = self.settings.workers
+        # the field is read as it is in the file, then moved by the recorded shift
+        shift = self.field.shift
+        self.field.shift = np.zeros((3,), dtype=int)
+        field, meta = self.load_cached()
+        if field is not None:
+            print('reading cached field...')
+            self.field.set_field(field, meta['stats'])
+        else:
+            if not (workers > 1 and self.load_body_parallel(workers)):
+                print('reading field...')
+                with open(self.file, 'rb') as f_read:
+                    # skip the header and parse every value in a single pass, values are stored
+                    # with z varying fastest so the flat array maps directly onto the grid
+                    f_read.seek(self.field.bodyoffset)
+                    values = np.fromfile(f_read, sep=' ', count=np.prod(self.field.gridsize),
+                                         dtype=self.field.dtype)
+                self.field.set_values(values)
+            # after a parallel parse the field stays backed by field.shm, the sidecar is a copy
+            if self.settings.cache:
+                fc.save(self.file, self.field.field, self.get_header(), self.field.compute_stats())
+
+        self.field.roll(shift)
 
         end = time.time()
         print('field loading complete, time elapsed = {}s'.format(end-start))
 
 
+    def load_body_parallel(self, workers):
+        """Parses the field with several processes, straight into shared memory. The body is split
+        into byte ranges on line boundaries, and the flat index each range starts at is worked out
+        from the number of values on each line.
+
+        Arguments:
+            workers {int} -- number of processes
+
+        Returns:
+            bool -- False if the layout of the body is not understood, nothing is loaded in that
+            case and the caller should fall back to the serial parser
+        """
+        n_x, n_y, n_z = self.field.gridsize
+        with open(self.file, 'rb') as f_read:
+            f_read.seek(0, os.SEEK_END)
+            end = f_read.tell()
+            f_read.seek(self.field.bodyoffset)
+            perline = len(f_read.readline().split())
+            # ignore trailing whitespace, so that the last line is counted properly
+            f_read.seek(max(self.field.bodyoffset, end - 4096))
+            tail = f_read.read()
+            end -= len(tail) - len(tail.rstrip())
+        if perline == 0 or end <= self.field.bodyoffset:
+            return False
+
+        # cut the body into byte ranges, on line boundaries
+        bounds = [self.field.bodyoffset]
+        with open(self.file, 'rb') as f_read:
+            for i in range(1, workers):
+                f_read.seek(self.field.bodyoffset + i * (end - self.field.bodyoffset) // workers)
+                f_read.readline()
+                bounds.append(max(bounds[-1], min(f_read.tell(), end)))
+        bounds.append(end)
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+
+        with multiprocessing.Pool(workers) as pool:
+            linecounts = pool.starmap(_count_lines, [(self.file, b, e) for b, e in ranges])
+        # the last line has no newline after it (trailing whitespace was dropped)
+        lines = sum(linecounts) + 1
+        linestarts = np.concatenate(([0], np.cumsum(linecounts)[:-1]))
+        rowlines = -(-n_z // perline)
+        if lines == n_x * n_y * rowlines:
+            # each z row starts on a new line, which is the standard cube layout
+            starts = (linestarts // rowlines) * n_z + (linestarts % rowlines) * perline
+        elif lines == -(-n_x * n_y * n_z // perline):
+            # values run on continuously from row to row
+            starts = linestarts * perline
+        else:
+            print('field layout not recognized, falling back to a serial read')
+            return False
+
+        print('reading field with {} workers...'.format(workers))
+        name = self.field.init_shared_field()
+        try:
+            with multiprocessing.Pool(workers) as pool:
+                pool.starmap(_parse_range, [(self.file, b, e, int(i), name, n_x * n_y * n_z,
+                                             self.field.dtype.str)
+                                            for (b, e), i in zip(ranges, starts)])
+        finally:
+            self.field.shm.unlink()
+        return True
+
+
+    def slab_index(self, update=False):
+        """Byte offset of the line each x plane of the body starts on, with the number of values
+        on that line that come before the plane (only ever nonzero when values run on from row to
+        row). Building it takes one pass over the file, after that it is kept in the artifact cache.
+
+        Keyword Arguments:
+            update {bool} -- build the index again (default: {False})
+
+        Returns:
+            np array -- (2, n_x) offsets and values to skip, offsets are -1 for planes missing from
+            a truncated body
+        """
+        if self.slabindex is not None and not update:
+            return self.slabindex
+        artifact = self.request_artifact('slabindex', '{}_slabs.npy'.format(self.name), {}, update,
+                                         load=False)
+        if artifact.exists:
+            self.slabindex = np.load(artifact.path)
+            return self.slabindex
+
+        print('indexing slabs...')
+        start = time.time()
+        n_x, n_y, n_z = self.field.gridsize
+        with open(self.file, 'rb') as f_read:
+            f_read.seek(self.field.bodyoffset)
+            perline = max(1, len(f_read.readline().split()))
+            rowlines = -(-n_z // perline)
+            for _ in range(rowlines - 2):
+                f_read.readline()
+            # each z row starts on a new line (the standard layout) if the first row ends part way
+            # along a line, otherwise values may run on from row to row
+            rows = rowlines < 2 or len(f_read.readline().split()) == n_z - (rowlines-1) * perline
+        planes = np.arange(n_x, dtype=np.int64)
+        if rows:
+            index = np.stack((planes * n_y * rowlines, np.zeros(n_x, dtype=np.int64)))
+        else:
+            lines = planes * n_y * n_z // perline
+            index = np.stack((lines, planes * n_y * n_z - lines * perline))
+        # line each plane starts on, to byte offsets
+        index[0], _ = _line_starts(self.file, self.field.bodyoffset, index[0])
+        np.save(artifact.tmppath, index)
+        artifact.commit()
+        self.slabindex = index
+        end = time.time()
+        print('slab index built, time elapsed = {}s'.format(end-start))
+        return index
+
+
+    def read_planes(self, planes):
+        """Parses some x planes of the field straight from the cube file, seeking to each run of
+        consecutive planes with the slab index, see slab_index
+
+        Arguments:
+            planes {np array} -- x indices of the planes, in the order wanted
+
+        Returns:
+            np array -- (len(planes), n_y, n_z) field values, unrolled
+        """
+        index = self.slab_index()
+        _, n_y, n_z = self.field.gridsize
+        planes = np.asarray(planes, dtype=np.int64)
+        out = np.zeros((len(planes), n_y, n_z), dtype=self.field.dtype)
+        breaks = np.flatnonzero(np.diff(planes) != 1) + 1
+        first = 0
+        with open(self.file, 'rb') as f_read:
+            for run in np.split(planes, breaks):
+                offset, skip = index[:, run[0]]
+                if offset >= 0:
+                    f_read.seek(offset)
+                    count = len(run) * n_y * n_z
+                    values = np.fromfile(f_read, sep=' ', count=count + skip,
+                                         dtype=self.field.dtype)[skip:]
+                    out[first:first+len(run)].reshape(-1)[:values.size] = values
+                first += len(run)
+        return out
+
+
+    def load_region(self, xrange, yrange, zrange):
+        """Loads a box of the field, reading only the x planes it covers (unless the whole field
+        is already in memory or cached). Ranges may run past either end of the cell, the field
+        wraps around periodically. The region knows where it sits in the cell, so isomeshes and
+        voxels made from it line up with the molecule, e.g. set cube.field to the region before
+        adding an isosurface.
+
+        Arguments:
+            xrange {tuple} -- (start, stop) grid indices along x, stop excluded
+            yrange {tuple} -- (start, stop) grid indices along y
+            zrange {tuple} -- (start, stop) grid indices along z
+
+        Returns:
+            ScalarField -- the region, its origin moved to the first point of the box
+        """
+        start = time.time()
+        ranges = np.array([xrange, yrange, zrange], dtype=np.int64)
+        shape = ranges[:, 1] - ranges[:, 0]
+        if np.any(shape <= 0):
+            raise ValueError('empty region {}'.format(ranges.tolist()))
+        gridsize = self.field.gridsize
+        indices = [np.arange(lower, upper) % size for (lower, upper), size in zip(ranges, gridsize)]
+
+        field, _ = self.load_cached()
+        if field is None and self.field.field is not None:
+            field = self.field.field
+            indices = [(index + s) % size for index, s, size in zip(indices, self.field.shift,
+                                                                     gridsize)]
+        if field is not None:
+            values = field[np.ix_(*indices)]
+        else:
+            values = self.read_planes(indices[0])[:, indices[1]][:, :, indices[2]]
+
+        region = sf.ScalarField(self.field.dtype)
+        region.load_file(self.file)
+        region.gridsize = shape
+        region.meshtransform = self.field.meshtransform.copy()
+        region.meshtransform[3, 0:3] += ranges[:, 0].dot(self.field.meshtransform[0:3, 0:3])
+        scale = np.zeros((4,), dtype=int)
+        scale[0:3] = shape
+        region.transform = region.meshtransform * scale[:, np.newaxis]
+        # drawn where the box sits in the field as it is shifted, the same as the atoms, which are
+        # wrapped into the cell once the field has been shifted
+        first = np.where(self.field.shift != 0, (ranges[:, 0] + self.field.shift) % gridsize,
+                         ranges[:, 0])
+        region.region = {'start': first.tolist(), 'gridsize': gridsize.tolist()}
+        region.set_values(values)
+        end = time.time()
+        print('region of {} points loaded, time elapsed = {}s'.format(shape.tolist(), end-start))
+        return region
+
+
+    def load_around_atoms(self, indices, padding=5.0):
+        """Loads the smallest box of the field (see load_region) around some atoms, e.g. an
+        adsorbate. Atoms on both sides of a periodic boundary are kept together.
+
+        Arguments:
+            indices {list} -- indices of the atoms
+
+        Keyword Arguments:
+            padding {float} -- distance kept around the atoms, in bohr (default: {5.0})
+
+        Returns:
+            ScalarField -- the region
+        """
+        steps = self.field.meshtransform[0:3, 0:3]
+        # molecule positions are centred on the cell, see Molecule.transform
+        centre = self.field.transform.diagonal()[0:3] / 2.0 - self.field.meshtransform[3, 0:3]
+        positions = self.molecule.m_positions[np.asarray(indices)] + centre
+        # atoms move along with a rolled field, the ranges are grid points of the file
+        points = positions.dot(np.linalg.inv(steps)) - self.field.shift
+        pad = np.ceil(padding / np.linalg.norm(steps, axis=1))
+        ranges = []
+        for axis, size in enumerate(self.field.gridsize):
+            # start after the largest gap between the atoms, going round the cell
+            coords = np.sort(points[:, axis] % size)
+            gaps = np.diff(np.append(coords, coords[0] + size))
+            largest = np.argmax(gaps)
+            lower = coords[(largest + 1) % len(coords)]
+            upper = lower + size - gaps[largest]
+            lower = int(np.floor(lower - pad[axis]))
+            upper = int(np.ceil(upper + pad[axis])) + 1
+            if upper - lower >= size:
+                lower, upper = 0, size
+            ranges.append((lower, upper))
+        return self.load_region(*ranges)
+
+
+    def level_field(self, level, mode='mean'):
+        """The field downsampled by 2**level along each axis (see ScalarField.get_level), the full
+        field is loaded first if needed, even when streaming. With caching enabled the levels are
+        also kept in the artifact cache, so later runs memory map them without loading the field.
+
+        Arguments:
+            level {int} -- level of the pyramid, 0 is the full field
+
+        Keyword Arguments:
+            mode {str} -- 'mean' or 'max' of each block (default: {'mean'})
+        """
+        if level and (level, mode) not in self.field.pyramid and self.settings.cache:
+            artifact = self.request_artifact('level',
+                                             '{}_L{}_{}.npy'.format(self.name, level, mode),
+                                             {'level': level, 'mode': mode})
+            if artifact.exists:
+                self.field.pyramid[(level, mode)] = np.load(artifact.path, mmap_mode='r')
+                return self.field.pyramid[(level, mode)]
+            if self.field.field is None:
+                self.load_body()
+            np.save(artifact.tmppath, self.field.get_level(level, mode))
+            artifact.commit()
+        if self.field.field is None:
+            self.load_body()
+        return self.field.get_level(level, mode)
+
+
+    def iter_slabs(self, size=None, level=0):
+        """Yields the field as slabs along x, moved by the shift of the field (see recentre). If the
+        field is loaded (or cached) the slabs are views into it, otherwise they are parsed straight
+        from the cube file, so that only one slab is ever in memory.
+
+        Keyword Arguments:
+            size {int} -- number of x planes per slab (default: {about 4M values per slab})
+            level {int} -- slabs of a downsampled level of the field instead, see level_field
+            (default: {0})
+
+        Yields:
+            tuple -- (x index of the first plane, slab of shape (n, gridsize[1], gridsize[2]))
+        """
+        n_x, n_y, n_z = self.field.level_shape(level)
+        if size is None:
+            size = max(1, (1 << 22) // (n_y * n_z))
+        if level:
+            field = self.level_field(level)
+            for x_0 in range(0, n_x, size):
+                yield x_0, field[x_0:x_0+size]
+            return
+        field = self.field.field
+        if field is None:
+            field, _ = self.load_cached()
+            shift = self.field.shift
+        else:
+            # the loaded field has already been moved
+            shift = np.zeros((3,), dtype=int)
+
+        if field is not None:
+            for x_0 in range(0, n_x, size):
+                for x_r, slab in self.field.roll_slab(field[x_0:x_0+size], x_0, shift):
+                    yield x_r, slab
+            return
+
+        with open(self.file, 'rb') as f_read:
+            f_read.seek(self.field.bodyoffset)
+            for x_0 in range(0, n_x, size):
+                count = min(size, n_x - x_0) * n_y * n_z
+                values = np.fromfile(f_read, sep=' ', count=count, dtype=self.field.dtype)
+                values[np.isnan(values)] = 0.0
+                if values.size < count:
+                    # truncated body, leave the remaining points empty
+                    values = np.concatenate((values, np.zeros((count - values.size,),
+                                                              dtype=values.dtype)))
+                slab = values.reshape((-1, n_y, n_z))
+                for x_r, rslab in self.field.roll_slab(slab, x_0, shift):
+                    yield x_r, rslab
+
+
+    def iter_gradient(self, size=None, level=0):
+        """Yields the real space gradient of the field slab by slab, by central differences with
+        periodic boundaries and the grid spacing of the cell. Each slab is taken with a neighbouring
+        plane on either side, so no full size copies are made and streamed fields stay streamed.
+        The slab holding the first plane is yielded last, once its lower neighbour is known.
+
+        Keyword Arguments:
+            size {int} -- number of x planes per slab, see iter_slabs (default: {None})
+            level {int} -- use a downsampled level of the field, see level_field (default: {0})
+
+        Yields:
+            tuple -- (x index of the first plane, slab, gradient of shape slab.shape + (3,))
+        """
+        transform = self.field.gradient_transform(level)
+        for x_0, block in _halo_slabs(self.iter_slabs(size, level)):
+            if len(block) > 2:
+                block = block.astype(self.field.work_dtype(), copy=False)
+                yield x_0, block[1:-1], sf.slab_gradient(block, transform)
+
+
+    def gradient_max(self, level=0):
+        """largest gradient magnitude of the field. Finding it takes a pass over the field, so it
+        is kept in the field stats (and the field cache sidecar, if caching) by level, and later
+        calls are free. If the range of the field is not known yet either, it is found in the same
+        pass, see get_range.
+
+        Keyword Arguments:
+            level {int} -- use a downsampled level of the field, see level_field (default: {0})
+
+        Returns:
+            float -- the largest magnitude
+        """
+        key = str(level)
+        if self.field.stats is None and self.field.field is None:
+            _, meta = self.load_cached()
+            if meta is not None:
+                self.field.stats = meta['stats']
+        if self.field.stats is not None and key in self.field.stats.get('gradient', {}):
+            return self.field.stats['gradient'][key]
+
+        # the range of the full field can be found from the same slabs
+        scan = self.field.stats is None and self.field.field is None and level == 0
+        if scan:
+            print('scanning field range and gradient...')
+        field_min = np.inf
+        field_max = -np.inf
+        total = 0.0
+        largest = 0.0
+        for _, slab, gradient in self.iter_gradient(level=level):
+            largest = max(largest, float(np.amax(np.linalg.norm(gradient, axis=-1))))
+            if scan:
+                field_min = min(field_min, float(np.amin(slab)))
+                field_max = max(field_max, float(np.amax(slab)))
+                total += float(np.sum(slab, dtype=np.float64))
+        if scan:
+            self.field.stats = {'min': field_min, 'max': field_max,
+                                'mean': total / np.prod(self.field.gridsize)}
+        else:
+            self.get_range()
+        self.field.stats.setdefault('gradient', {})[key] = largest
+        if self.settings.cache:
+            fc.update_stats(self.file, self.field.stats, dtype=self.field.dtype)
+        return largest
+
+
+    def get_range(self):
+        """min and max of the field, without loading the full field if it is not already in memory
+
+        Returns:
+            tuple -- (min, max)
+        """
+        if self.field.field is not None or self.field.stats is not None:
+            return self.field.get_range()
+        field, meta = self.load_cached()
+        if field is not None:
+            self.field.stats = meta['stats']
+            return self.field.get_range()
+        # first pass over the file just to find the range
+        print('scanning field range...')
+        field_min = np.inf
+        field_max = -np.inf
+        total = 0.0
+        for _, slab in self.iter_slabs():
+            field_min = min(field_min, float(np.amin(slab)))
+            field_max = max(field_max, float(np.amax(slab)))
+            total += float(np.sum(slab, dtype=np.float64))
+        self.field.stats = {'min': field_min, 'max': field_max,
+                            'mean': total / np.prod(self.field.gridsize)}
+        return self.field.get_range()
+
+
     def save_voxel(self, path, voxeldata):
         """saves the data to a voxel file
         
@@ -146,36 +692,102 @@ class Cube():
 
         with open(path, 'wb') as binfile:
             header.astype('<i4').tofile(binfile)
-            voxeldata.astype('<f4').tofile(binfile)
+            np.asarray(voxeldata, dtype='<f4').tofile(binfile)
 
 
-    def check_file(self, name, update):
-        """Checks that the file exists, making this data file is expensive and
-        the file is large, so avoid if possible!
+    def request_artifact(self, kind, name, params, update=False, load=True):
+        """Looks up a derived file of this cube in the artifact cache, without loading the field.
+        The file is keyed on the contents of the cube file and on params, together with the kind of
+        file, the precision of the field and how it is shifted, so a file made with different
+        options is never reused. If the file is missing the field is loaded, ready to make it
+        (unless streaming, or working on a downsampled level).
 
         Arguments:
-            name {string} -- name of the file to be checked
-            update {bool} -- update if exists?
+            kind {str} -- kind of file, e.g. 'color' or 'isomesh'
+            name {str} -- readable name of the file, the cache adds the key to it
+            params {dict} -- every other option that changes the file
+
+        Keyword Arguments:
+            update {bool} -- make the file again even if it is cached (default: {False})
+            load {bool} -- load the field if the file is missing (default: {True})
 
         Returns:
-            path -- the path of the file
-        """
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        # if dat folder doesn't exist, something is wrong but create it anyway
-        if not os.path.isdir(os.path.join(current_dir, 'dat')):
-            os.mkdir('dat')
-        # check dat folder for occurances
-        vpath = os.path.join(current_dir, 'dat', name)
-        if not update and os.path.isfile(vpath):
+            Artifact -- if it does not exist, write it to its tmppath and commit it, see
+            artifact_cache
+        """
+        params = dict(params, kind=kind, shift=self.field.shift.tolist(),
+                      dtype=self.field.dtype.str)
+        if self.field.region is not None:
+            # files made from a region of the field (see load_region)
+            params['region'] = self.field.region
+        artifact = self.artifacts.request([self.file], name, params, update)
+        if artifact.exists:
             print('{} already exists'.format(name))
-            return None # nothing needed to be done
-        print('{} does not exist'.format(vpath))
-        if self.field.field is None:
+            return artifact
+        print('{} does not exist'.format(name))
+        if (load and self.field.field is None and not self.settings.stream
+                and not params.get('level')):
             self.load_body()
-        return vpath
+        return artifact
+
+
+    def isomesh_artifacts(self, val, name, update=False, absolute=False, fmt='dae', budget=None,
+                          lods=None, level=0, normals=False):
+        """artifacts of an isomesh, see make_isomesh, the mesh itself followed by its levels of
+        detail
+        """
+        params = {'value': val, 'absolute': absolute, 'fmt': fmt, 'budget': budget,
+                  'lods': list(lods or []), 'level': level, 'normals': normals}
+        artifacts = [self.request_artifact('isomesh', name, params, update)]
+        base, ext = os.path.splitext(name)
+        for idx in range(len(lods or [])):
+            artifacts.append(self.request_artifact('isomesh', '{}_lod{}{}'.format(base, idx, ext),
+                                                   dict(params, lod=idx), update))
+        return artifacts
+
+
+    def isomesh_name(self, val, absolute=False, prefix="", fmt='dae', level=0):
+        """name of the isomesh file for a given level, unique for each level so that several
+        isosurfaces of the same cube can coexist
+
+        Arguments:
+            val {float} -- the level, see make_isomesh
+
+        Keyword Arguments:
+            absolute {bool} -- val is an absolute field value (default: {False})
+            prefix {str} -- start of the name (default: {name of the cube})
+            fmt {str} -- mesh format, one of mesh_io.FORMATS (default: {'dae'})
+            level {int} -- downsampling level of the field, see make_isomesh (default: {0})
+
+        Returns:
+            string -- the file name
+        """
+        if not prefix:
+            prefix = self.name
+        return '{}_{}{}{}.{}'.format(prefix, 'isoabs' if absolute else 'iso', val,
+                                     '_L{}'.format(level) if level else '', fmt)
+
+
+    def voxel_name(self, kind, name="", level=0):
+        """name of a voxel file, names already ending in .bvox are kept as they are
+
+        Arguments:
+            kind {str} -- 'color' or 'emission'
+
+        Keyword Arguments:
+            name {str} -- start of the name (default: {name of the cube})
+            level {int} -- downsampling level of the field, see make_color_voxel (default: {0})
+
+        Returns:
+            string -- the file name
+        """
+        if name.endswith('.bvox'):
+            return name
+        return '{}_{}{}.bvox'.format(name or self.name, kind, '_L{}'.format(level) if level else '')
 
 
-    def make_isomesh(self, val, name="", update=False):
+    def make_isomesh(self, val, name="", update=False, absolute=False, fmt='dae', budget=None,
+                     lods=None, level=0, normals=False):
         """makes a mesh based off the marching cubes algorithm, for given volume data
         
         Arguments:
@@ -186,93 +798,636 @@ class Cube():
         Keyword Arguments:
             name {str} -- given name for isomesh (default: {""})
             update {bool} -- update isomesh or not? (default: {False})
+            absolute {bool} -- val is an absolute field value instead (default: {False})
+            fmt {str} -- mesh format, 'dae' (collada), or the much smaller and faster binary 'ply'
+            or 'npz', see mesh_io (default: {'dae'})
+            budget {int} -- decimate the mesh to at most this many triangles (default: {None})
+            lods {list} -- triangle budgets of extra, coarser meshes saved next to the main one
+            with _lod0, _lod1... added to the name (default: {None})
+            level {int} -- extract from the field downsampled by 2**level along each axis, for
+            quick previews. The mesh is written in the grid coordinates of the full field, so it
+            lines up with full resolution meshes and the molecule (default: {0})
+            normals {bool} -- save vertex normals taken from the gradient of the field, in real
+            space, ignored by collada (default: {False})
+
+        Returns:
+            path -- the path of the mesh in the artifact cache
         """
         if not name:
-            name = self.name + '.dae'
-        elif not name.endswith('.dae'):
-            name = name + '.dae'
-        ipath = self.check_file(name, update)
-        if ipath is None:
-            return
+            name = self.isomesh_name(val, absolute, fmt=fmt, level=level)
+        elif os.path.splitext(name)[1][1:] not in mio.FORMATS:
+            name = name + '.' + fmt
+        fmt = mio.mesh_format(name)
+        artifacts = self.isomesh_artifacts(val, name, update, absolute, fmt, budget, lods, level,
+                                           normals)
+        if all(artifact.exists for artifact in artifacts):
+            return artifacts[0].path
         print('making isosurface...')
         start = time.time()
-        field_max = np.amax(self.field.field)
-        field_min = np.amin(self.field.field)
-        isoval = val * (field_max - field_min) + field_min
-        vertices, triangles = mcubes.marching_cubes(self.field.field, isoval)
-        mcubes.export_mesh(vertices, triangles, ipath, "Iso{}".format(val))
+        # relative levels are taken from the range of the full field, so that a preview surface
+        # approximates the full resolution one
+        isoval = self.isovalue(val, absolute)
+        # marching cubes works in single or double precision, never copy a float32 field
+        field = self.level_field(level).astype(self.field.work_dtype(), copy=False)
+        blocks = None if level else self.isomesh_blocks(isoval)
+        gradient = self.field.gradient_transform(level) if normals else None
+        _isomesh_job(field, isoval, [artifact.tmppath for artifact in artifacts],
+                     "Iso{}".format(val), blocks, budget, lods, level, gradient)
+        for artifact in artifacts:
+            artifact.commit()
         end = time.time()
         print('mesh created, time elapsed = {}s'.format(end-start))
+        return artifacts[0].path
 
-    # creating isosurfaces and voxel files are expensive. Save the files for repeat use.
-    def make_color_voxel(self, name="", update=False):
-        if not name:
-            name = self.name + '_color.bvox'
-        elif not name.endswith('.bvox'):
-            name = name + '_color.bvox'
-        vpath = self.check_file(name, update)
-        if vpath is None:
-            return
+
+    def isomesh(self, val, absolute=False, budget=None, level=0, normals=False):
+        """an isosurface in memory, for handing straight to blender. Nothing is written to disk
+        (unless levels are cached, see level_field), the field is loaded if needed.
+
+        Arguments:
+            val {float} -- the level, see make_isomesh
+
+        Keyword Arguments:
+            absolute {bool} -- val is an absolute field value instead (default: {False})
+            budget {int} -- decimate the mesh to at most this many triangles (default: {None})
+            level {int} -- downsampling level of the field, see make_isomesh (default: {0})
+            normals {bool} -- compute vertex normals from the gradient of the field (default:
+            {False})
+
+        Returns:
+            tuple -- (vertices, triangles, normals), vertices in the grid coordinates of the full
+            field and normals None unless asked for
+        """
+        print('making isosurface...')
+        start = time.time()
+        isoval = self.isovalue(val, absolute)
+        field = self.level_field(level).astype(self.field.work_dtype(), copy=False)
+        blocks = None if level else self.isomesh_blocks(isoval)
+        gradient = self.field.gradient_transform(level) if normals else None
+        mesh = extract_isomeshes(field, isoval, blocks, budget, None, level, gradient)[0]
+        end = time.time()
+        print('mesh created, time elapsed = {}s'.format(end-start))
+        return mesh
+
+
+    def isovalue(self, val, absolute=False):
+        """field value of a level, relative levels are scaled to the range of the field
+        """
+        if absolute:
+            return val
+        field_min, field_max = self.get_range()
+        return val * (field_max - field_min) + field_min
+
+
+    def isomesh_blocks(self, isoval, level=0):
+        """blocks of the field that the isosurface can pass through, if the field has a block
+        index (see ScalarField.build_blockindex), otherwise None for the whole field
+
+        Keyword Arguments:
+            level {int} -- level of the block index to extract on, coarser blocks mean fewer
+            marching cubes calls but more empty space (default: {0})
+        """
+        if self.field.blockindex is None:
+            return None
+        level = min(level, len(self.field.blockindex) - 1)
+        blocks = self.field.active_blocks(isoval, level)
+        print('{} active blocks of size {}'.format(len(blocks), self.field.block_size(level)))
+        return blocks
+
+
+    def make_isomeshes(self, vals, name="", update=False, absolute=False, workers=None,
+                       fmt='dae', budget=None, lods=None, level=0, normals=False):
+        """makes one isomesh per level, for several levels at once. The field range is found once
+        and the levels are extracted side by side on a pool of processes, which share the loaded
+        field rather than copying it where the platform allows.
+
+        Arguments:
+            vals {list} -- the levels, see make_isomesh
+
+        Keyword Arguments:
+            name {str} -- start of the isomesh names, see isomesh_name (default: {""})
+            update {bool} -- update existing isomeshes or not? (default: {False})
+            absolute {bool} -- vals are absolute field values (default: {False})
+            workers {int} -- number of processes (default: {one per level, up to the cpu count})
+            fmt {str} -- mesh format, see make_isomesh (default: {'dae'})
+            budget {int} -- triangle budget of each mesh, see make_isomesh (default: {None})
+            lods {list} -- triangle budgets of extra meshes, see make_isomesh (default: {None})
+            level {int} -- downsampling level of the field, see make_isomesh (default: {0})
+            normals {bool} -- save vertex normals, see make_isomesh (default: {False})
+
+        Returns:
+            list -- a dict per level with the level, isovalue, path (and paths of the levels of
+            detail), triangle count and time taken, cached is set if the isomesh was up to date
+        """
+        global _ISOFIELD
+        report = []
+        jobs = []
+        for val in vals:
+            artifacts = self.isomesh_artifacts(val, self.isomesh_name(val, absolute, name, fmt,
+                                                                      level),
+                                               update, absolute, fmt, budget, lods, level, normals)
+            cached = all(artifact.exists for artifact in artifacts)
+            report.append({'value': val, 'path': artifacts[0].path,
+                           'lods': [artifact.path for artifact in artifacts[1:]],
+                           'cached': cached, 'triangles': 0, 'time': 0.0})
+            if not cached:
+                jobs.append((report[-1], artifacts))
+        if not jobs:
+            return report
+        print('making {} isosurfaces...'.format(len(jobs)))
+        start = time.time()
+        for entry, _ in jobs:
+            entry['isovalue'] = self.isovalue(entry['value'], absolute)
+        field = self.level_field(level).astype(self.field.work_dtype(), copy=False)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(jobs)))
+        gradient = self.field.gradient_transform(level) if normals else None
+        args = [(entry['isovalue'], [artifact.tmppath for artifact in artifacts],
+                 "Iso{}".format(entry['value']),
+                 None if level else self.isomesh_blocks(entry['isovalue']), budget, lods, level,
+                 gradient) for entry, artifacts in jobs]
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            # forked workers see the field through copy-on-write memory, nothing is pickled
+            _ISOFIELD = field
+            try:
+                with multiprocessing.get_context('fork').Pool(workers) as pool:
+                    results = pool.starmap(_isomesh_worker, args)
+            finally:
+                _ISOFIELD = None
+        else:
+            results = [_isomesh_job(field, *arg) for arg in args]
+
+        for (entry, artifacts), (triangles, elapsed) in zip(jobs, results):
+            for artifact in artifacts:
+                artifact.commit()
+            entry['triangles'] = triangles
+            entry['time'] = elapsed
+        print('level       isovalue  triangles   time (s)')
+        for entry in report:
+            print('{:<10} {:10.4g} {:10d} {:10.3f}'.format(
+                str(entry['value']), entry.get('isovalue', np.nan), entry['triangles'],
+                entry['time']))
+        end = time.time()
+        print('meshes created, time elapsed = {}s'.format(end-start))
+        return report
+
+    # creating isosurfaces and voxel files are expensive. Save the files for repeat use, the
+    # make functions return the path of the file in the artifact cache.
+    def make_color_voxel(self, name="", update=False, level=0):
+        # level > 0 writes a preview of the field downsampled by 2**level along each axis,
+        # normalized to the range of the full field so that colors match the full render
+        artifact = self.request_artifact('color', self.voxel_name('color', name, level),
+                                         {'level': level}, update)
+        if artifact.exists:
+            return artifact.path
         print('making color voxel...')
         start = time.time()
-        vox = self.field.field.flatten()
-        # normalize
-        vox -= np.min(vox)
-        vox /= np.max(vox)
-        # flip
-        #vox = 1.0 - vox
-        # save
-        self.save_voxel(vpath, vox)
+        field_min, field_max = self.get_range()
+        writer = VoxelWriter(artifact.tmppath, self.field.level_shape(level))
+        for x_0, slab in self.iter_slabs(level=level):
+            # normalize, staying in the precision of the field
+            vox = np.subtract(slab, field_min, dtype=self.field.work_dtype())
+            vox /= field_max - field_min
+            # flip
+            #vox = 1.0 - vox
+            # save
+            writer.write(x_0, vox)
+        writer.close()
+        artifact.commit()
         end = time.time()
         print('color voxel created, time elapsed = {}s'.format(end-start))
+        return artifact.path
 
     def make_emission_voxel(self, name="", update=False, truncA=-1e20, truncB=1e20,
-                            max_emission=0.5, tol=0.1, modifier='SIGMOID'):
-        if not name:
-            name = self.name + '_emission.bvox'
-        elif not name.endswith('.bvox'):
-            name = name + '_emission.bvox'
-        vpath = self.check_file(name, update)
-        if vpath is None:
-            return
+                            max_emission=0.5, tol=0.1, modifier='SIGMOID', level=0):
+        artifact = self.request_artifact('emission', self.voxel_name('emission', name, level),
+                                         {'truncA': truncA, 'truncB': truncB,
+                                          'max_emission': max_emission, 'tol': tol,
+                                          'modifier': modifier, 'level': level}, update)
+        if artifact.exists:
+            return artifact.path
         print('making emission voxel...')
         start = time.time()
-        field = self.field.field
-        # clip if desirable
-        np.clip(field, truncA, truncB)
-        # normalize
-        field -= np.min(field)
-        field /= np.max(field)
-        # flip
-        field = 1.0 - field
-        if modifier == 'SIGMOID':
-            # convert to sigmoid input
-            field -= 0.5
-            field *= 8.0
-            # apply sigmoid function
-            field = np.exp(field)
-            field /= (field + 1)
-            field = np.clip(field, 0, max_emission)
-            field[field < tol] = 0.0
-        elif modifier == 'GRADIENT':
-            print('non-standard gradient modifier chosen')
-            # to save computation time, just do a rough finite forward difference on the three adjacent
-            # cells (x, y, z)
-            finite_x = (np.roll(field, 1, axis=0) + np.roll(field, 1, axis=1) + np.roll(field, 1, axis=2)
-                        - (3 * field)) / 3.0
-            field = np.clip(field, 0, max_emission)
-        else:
-            # not recognized, just do nothing and hope for the best...
-            print('warning: modifier option not recognized')
-        # save
-        vox = field.flatten()
-        self.save_voxel(vpath, vox)
+        if tf.uses_gradient(modifier):
+            # finds the range too if it is not known, saving a pass over the field
+            self.gradient_max(level)
+        field_min, field_max = self.get_range()
+        writer = VoxelWriter(artifact.tmppath, self.field.level_shape(level))
+        for x_0, _, vox in self.emission_slabs(field_min, field_max, modifier, level,
+                                               truncA=truncA, truncB=truncB,
+                                               max_emission=max_emission, tol=tol):
+            writer.write(x_0, vox)
+        writer.close()
+        artifact.commit()
         end = time.time()
         print('emission voxel created, time elapsed = {}s'.format(end-start))
+        return artifact.path
+
+
+    def make_volume_voxels(self, name="", update=False, truncA=-1e20, truncB=1e20,
+                           max_emission=0.5, tol=0.1, modifier='SIGMOID', level=0):
+        """makes the color and emission voxels together, in a single pass over the field. The range
+        is found once and both files are written slab by slab from the same read of the field,
+        into two reused buffers. If only one of the files needs making, only that one is made.
+        Modifiers that use the gradient (e.g. GRADIENT, the default of add_volume) also need its
+        largest magnitude, which takes one more pass the first time for each cube (together with
+        the range, if that is not known either) and is kept in the field stats afterwards, see
+        gradient_max.
+
+        Keyword Arguments:
+            name {str} -- start of the voxel names, see voxel_name (default: {""})
+            update {bool} -- update the voxel files or not? (default: {False})
+            truncA, truncB, max_emission, tol, modifier -- emission options, as for
+            make_emission_voxel
+            level {int} -- downsampling level of the field, see make_color_voxel (default: {0})
+
+        Returns:
+            tuple -- paths of the color and emission voxels
+        """
+        emission = {'truncA': truncA, 'truncB': truncB, 'max_emission': max_emission, 'tol': tol,
+                    'modifier': modifier, 'level': level}
+        cartifact = self.request_artifact('color', self.voxel_name('color', name, level),
+                                          {'level': level}, update)
+        eartifact = self.request_artifact('emission', self.voxel_name('emission', name, level),
+                                          emission, update)
+        if cartifact.exists and eartifact.exists:
+            return cartifact.path, eartifact.path
+        if eartifact.exists:
+            return self.make_color_voxel(name, update, level), eartifact.path
+        if cartifact.exists:
+            return cartifact.path, self.make_emission_voxel(name, update, **emission)
+        print('making color and emission voxels...')
+        start = time.time()
+        if tf.uses_gradient(modifier):
+            # finds the range too if it is not known, saving a pass over the field
+            self.gradient_max(level)
+        field_min, field_max = self.get_range()
+        shape = self.field.level_shape(level)
+        cwriter = VoxelWriter(cartifact.tmppath, shape)
+        ewriter = VoxelWriter(eartifact.tmppath, shape)
+        buffer = None
+        for x_0, slab, vox in self.emission_slabs(field_min, field_max, **emission):
+            if buffer is None or len(buffer) < len(slab):
+                buffer = np.empty(slab.shape, dtype=self.field.work_dtype())
+            # normalize, as for make_color_voxel
+            color = buffer[:len(slab)]
+            np.subtract(slab, field_min, out=color)
+            color /= field_max - field_min
+            cwriter.write(x_0, color)
+            ewriter.write(x_0, vox)
+        cwriter.close()
+        ewriter.close()
+        end = time.time()
+        print('color and emission voxels created, time elapsed = {}s'.format(end-start))
+        return cartifact.commit(), eartifact.commit()
+
+    def emission_slabs(self, field_min, field_max, modifier='SIGMOID', level=0, **options):
+        """Yields emission voxel values slab by slab, see transfer.evaluate. Modifiers that use the
+        gradient are given its magnitude, normalized to the largest magnitude in the field, which
+        takes an extra pass over the field the first time, see gradient_max. The values are written
+        to one buffer that is reused for every slab, so each slab must be used before asking for
+        the next.
+
+        Arguments:
+            field_min {float} -- minimum of the full field
+            field_max {float} -- maximum of the full field
+
+        Keyword Arguments:
+            modifier {str} -- name of a registered modifier (default: {'SIGMOID'})
+            level {int} -- use a downsampled level of the field, see level_field (default: {0})
+            options -- passed on to transfer.evaluate, e.g. truncA, truncB, max_emission and tol
+
+        Yields:
+            tuple -- (x index of the first plane, slab of the field, emission values)
+        """
+        if tf.uses_gradient(modifier):
+            largest = self.gradient_max(level) or 1.0
+            slabs = ((x_0, slab, np.linalg.norm(gradient, axis=-1) / largest)
+                     for x_0, slab, gradient in self.iter_gradient(level=level))
+        else:
+            slabs = ((x_0, slab, None) for x_0, slab in self.iter_slabs(level=level))
+        buffer = None
+        for x_0, slab, gradient in slabs:
+            if buffer is None or len(buffer) < len(slab):
+                buffer = np.empty(slab.shape, dtype=self.field.work_dtype())
+            yield x_0, slab, tf.evaluate(slab, field_min, field_max, modifier, buffer[:len(slab)],
+                                         gradient=gradient, **options)
+
+
+class VoxelWriter():
+    """incremental writer for blender voxel (.bvox) files, the field can be written in x-slabs in
+    any order so that the full field never needs to be in memory. Animated files are written one
+    frame at a time, the frame count in the header is fixed up on close.
+    """
+
+    def __init__(self, path, gridsize):
+        self.gridsize = np.array(gridsize, dtype=int)
+        self.slabsize = int(self.gridsize[1] * self.gridsize[2])
+        self.framesize = int(self.gridsize[0]) * self.slabsize
+        self.frames = 1
+        # create header
+        header = np.zeros((4,), dtype=int)
+        header[0:3] = self.gridsize
+        header[3] = 1 # for still frame
+        self.binfile = open(path, 'wb')
+        header.astype('<i4').tofile(self.binfile)
+        self.offset = self.binfile.tell()
+
+    def write(self, x_0, slab):
+        """writes a slab of the current frame
+
+        Arguments:
+            x_0 {int} -- x index of the first plane in the slab
+            slab {np array} -- field values with shape (n, gridsize[1], gridsize[2])
+        """
+        start = (self.frames - 1) * self.framesize + x_0 * self.slabsize
+        self.binfile.seek(self.offset + 4 * start)
+        np.asarray(slab, dtype='<f4').tofile(self.binfile)
+
+    def next_frame(self):
+        """moves on to the next frame, later writes go to the new frame
+        """
+        self.frames += 1
+
+    def close(self):
+        # fix up the frame count
+        self.binfile.seek(12)
+        np.array([self.frames], dtype='<i4').tofile(self.binfile)
+        self.binfile.close()
+
+
+def make_animated_voxel(cubes, name="", update=False, kind='color', normalize='global', **kwargs):
+    """writes a sequence of cubes (e.g. the frames of a trajectory) to a single animated voxel file.
+    Frames are streamed one at a time, a field is only loaded if it is already in memory or cached,
+    so at most one frame is ever held.
+
+    Arguments:
+        cubes {list} -- Cube objects with their headers loaded, all with the same gridsize
+
+    Keyword Arguments:
+        name {str} -- given name for the voxel file (default: {""})
+        update {bool} -- update the voxel file or not? (default: {False})
+        kind {str} -- 'color' or 'emission' voxel values (default: {'color'})
+        normalize {str} -- 'global' normalizes every frame to the range of the whole sequence,
+        'frame' normalizes each frame to its own range (default: {'global'})
+        kwargs -- options for the emission values, as for Cube.make_emission_voxel
+
+    Returns:
+        path -- the path of the voxel file in the artifact cache
+    """
+    if not cubes:
+        return None
+    gridsize = cubes[0].field.gridsize
+    for cube in cubes:
+        if not np.array_equal(cube.field.gridsize, gridsize):
+            raise ValueError('{} has gridsize {}, expected {}'.format(
+                cube.file, cube.field.gridsize, gridsize))
+    if not name:
+        name = '{}_{}_anim.bvox'.format(cubes[0].name, kind)
+    elif not name.endswith('.bvox'):
+        name = name + '.bvox'
+    emission = {'max_emission': 0.5, 'tol': 0.1, 'modifier': 'SIGMOID'}
+    emission.update(kwargs)
+    params = {'kind': 'animated', 'voxel': kind, 'normalize': normalize,
+              'shift': [cube.field.shift.tolist() for cube in cubes],
+              'dtype': [cube.field.dtype.str for cube in cubes],
+              'emission': emission if kind == 'emission' else None}
+    artifact = cubes[0].artifacts.request([cube.file for cube in cubes], name, params, update)
+    if artifact.exists:
+        print('{} already exists'.format(name))
+        return artifact.path
+
+    print('making animated {} voxel of {} frames...'.format(kind, len(cubes)))
+    start = time.time()
+    if normalize == 'global':
+        ranges = [cube.get_range() for cube in cubes]
+        field_min = min(r[0] for r in ranges)
+        field_max = max(r[1] for r in ranges)
+
+    writer = VoxelWriter(artifact.tmppath, gridsize)
+    for idx, cube in enumerate(cubes):
+        if idx > 0:
+            writer.next_frame()
+        if normalize != 'global':
+            field_min, field_max = cube.get_range()
+        if kind == 'emission':
+            for x_0, _, vox in cube.emission_slabs(field_min, field_max, **emission):
+                writer.write(x_0, vox)
+            continue
+        for x_0, slab in cube.iter_slabs():
+            vox = np.subtract(slab, field_min, dtype=np.promote_types(slab.dtype, np.float32))
+            vox /= field_max - field_min
+            writer.write(x_0, vox)
+    writer.close()
+    artifact.commit()
+    end = time.time()
+    print('animated voxel created, time elapsed = {}s'.format(end-start))
+    return artifact.path
+
+
+# field shared with forked isomesh workers
+_ISOFIELD = None
+
+
+def marching_cubes(field, isoval, blocks=None):
+    """isosurface of a field, optionally only over some blocks of cells
+
+    Arguments:
+        field {np array} -- the field
+        isoval {float} -- field value of the isosurface
+
+    Keyword Arguments:
+        blocks {list} -- (lower, upper) grid point bounds of the blocks to extract, see
+        ScalarField.active_blocks (default: {None, the whole field})
+
+    Returns:
+        tuple -- (vertices, triangles)
+    """
+    if blocks is None:
+        return mcubes.marching_cubes(field, isoval)
+    vertices = []
+    triangles = []
+    count = 0
+    for lower, upper in blocks:
+        bverts, btris = mcubes.marching_cubes(
+            field[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]], isoval)
+        if len(btris) == 0:
+            continue
+        vertices.append(bverts + lower)
+        triangles.append(btris + count)
+        count += len(bverts)
+    if not vertices:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.uint64)
+    # stitch the blocks together, vertices on a shared face come from the same cell edge on both
+    # sides, so they only differ by rounding
+    vertices = np.concatenate(vertices)
+    _, first, inverse = np.unique(np.round(vertices, 6), axis=0, return_index=True,
+                                  return_inverse=True)
+    vertices = vertices[first]
+    triangles = inverse.reshape(-1)[np.concatenate(triangles)]
+    return vertices, triangles.astype(np.uint64)
+
+
+def vertex_normals(field, vertices, transform):
+    """unit normals of an isosurface at its vertices, from the gradient of the field, pointing
+    towards lower field values
+
+    Arguments:
+        field {np array} -- the field the isosurface was extracted from
+        vertices {np array} -- (n, 3) vertex positions in the grid coordinates of field
+        transform {np array} -- gradient_transform of the field
+
+    Returns:
+        np array -- (n, 3) normals in real space
+    """
+    normals = -sf.gradient_at(field, vertices, transform)
+    length = np.linalg.norm(normals, axis=1)
+    length[length == 0] = 1.0
+    return normals / length[:, np.newaxis]
+
+
+def extract_isomeshes(field, isoval, blocks=None, budget=None, lods=None, level=0, gradient=None):
+    """an isosurface of a field and its levels of detail, in memory
+
+    Arguments:
+        field {np array} -- the field, or a downsampled level of it
+        isoval {float} -- field value of the isosurface
+
+    Keyword Arguments:
+        blocks {list} -- blocks to extract on, see marching_cubes (default: {None})
+        budget {int} -- decimate the mesh to at most this many triangles (default: {None})
+        lods {list} -- triangle budgets of extra, coarser meshes (default: {None})
+        level {int} -- downsampling level of field, vertices are moved to the grid coordinates of
+        the full field (default: {0})
+        gradient {np array} -- gradient transform of field, vertex normals are only computed if
+        given (default: {None})
+
+    Returns:
+        list -- (vertices, triangles, normals) of the mesh followed by those of its levels of
+        detail, normals are None without gradient
+    """
+    vertices, triangles = marching_cubes(field, isoval, blocks)
+    meshes = []
+    if budget is not None or lods:
+        (vertices, triangles), meshes, _ = mo.postprocess(vertices, triangles, budget, lods)
+    result = []
+    for mverts, mtris in [(vertices, triangles)] + meshes:
+        normals = None if gradient is None else vertex_normals(field, mverts, gradient)
+        result.append((sf.level_to_grid(mverts, level), mtris, normals))
+    return result
+
+
+def _isomesh_job(field, isoval, paths, meshname, blocks=None, budget=None, lods=None, level=0,
+                 gradient=None):
+    # extract and save a single isosurface to paths[0] and its levels of detail to the rest of
+    # paths, returns the triangle count and the time taken
+    start = time.time()
+    meshes = extract_isomeshes(field, isoval, blocks, budget, lods, level, gradient)
+    names = [meshname] + ['{}_lod{}'.format(meshname, idx) for idx in range(len(meshes) - 1)]
+    for mpath, mname, (mverts, mtris, normals) in zip(paths, names, meshes):
+        mio.save_mesh(mpath, mverts, mtris, normals, mname)
+    return len(meshes[0][1]), time.time() - start
+
+
+def _isomesh_worker(isoval, paths, meshname, blocks, budget, lods, level, gradient):
+    return _isomesh_job(_ISOFIELD, isoval, paths, meshname, blocks, budget, lods, level, gradient)
+
+
+def _halo_slabs(slabs):
+    # joins slabs that come in order around the cell (as from Cube.iter_slabs) into blocks with one
+    # neighbouring plane on either side, yields (x of the first inner plane, block). The first
+    # plane of the cell needs the last one, so it is held back and yielded last.
+    first = None
+    after_first = None
+    block = None
+    x_block = 0
+    for x_0, slab in slabs:
+        if block is None:
+            first = (x_0, slab[:1].copy())
+            if len(slab) > 1:
+                after_first = slab[1:2].copy()
+            block = slab
+            x_block = x_0 + 1
+            continue
+        if after_first is None:
+            after_first = slab[:1].copy()
+        yield x_block, np.concatenate((block, slab[:1]))
+        block = np.concatenate((block[-1:], slab))
+        x_block = x_0
+    if block is None:
+        return
+    x_first, first_plane = first
+    if after_first is None:
+        # a single plane, its own neighbour on both sides
+        after_first = first_plane
+    else:
+        yield x_block, np.concatenate((block, first_plane))
+    yield x_first, np.concatenate((block[-1:], first_plane, after_first))
+
+
+def _line_starts(path, begin, lines, blocksize=1 << 24):
+    # byte offsets of the starts of some lines, numbered from the line at begin, found in a single
+    # pass over the newlines of the file. Returns the offsets (-1 past the end of the file) and the
+    # number of newlines
+    lines = np.asarray(lines, dtype=np.int64)
+    offsets = np.full(len(lines), -1, dtype=np.int64)
+    offsets[lines == 0] = begin
+    # a line starts right after the newline ending the line before it
+    wanted = lines - 1
+    count = 0
+    position = begin
+    with open(path, 'rb') as f_read:
+        f_read.seek(begin)
+        while True:
+            block = f_read.read(blocksize)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            found = (wanted >= count) & (wanted < count + len(newlines))
+            offsets[found] = position + newlines[wanted[found] - count] + 1
+            count += len(newlines)
+            position += len(block)
+    # a line starting at the very end of the file is no line at all
+    offsets[offsets >= position] = -1
+    return offsets, count
+
+
+def _count_lines(path, begin, end, blocksize=1 << 24):
+    # number of newlines in a byte range of a file
+    count = 0
+    with open(path, 'rb') as f_read:
+        f_read.seek(begin)
+        while begin < end:
+            block = f_read.read(min(blocksize, end - begin))
+            if not block:
+                break
+            count += block.count(b'\n')
+            begin += len(block)
+    return count
+
+
+def _parse_range(path, begin, end, index, name, size, dtype):
+    # parse a byte range of the cube body into the shared field, starting at a flat index
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        field = np.ndarray((size,), dtype=dtype, buffer=shm.buf)
+        with open(path, 'rb') as f_read:
+            f_read.seek(begin)
+            values = np.fromstring(f_read.read(end - begin), sep=' ', dtype=dtype)
+        values[np.isnan(values)] = 0.0
+        count = max(0, min(values.size, size - index))
+        field[index:index+count] = values[:count]
+        del field
+    finally:
+        shm.close()
+
 
 if __name__ == '__main__':
     CUBE = Cube()
     CUBE.load_header('test.cube')
+    CUBE.field_settings(cache=True)
     print(CUBE)
     CUBE.load_body()
     CUBE.make_color_voxel(update=True)
@@ -0,0 +1,191 @@
+"""FIELD_CACHE MODULE
+
+Binary sidecar cache for parsed cube fields. Parsing the text body of a large cube file is by far
+the most expensive step of the pipeline, so the parsed field is written once as a .npy file next to
+a small .json file holding the header, the source file details and the field statistics. Later
+loads memory map the .npy file, so no parsing or copying is done.
+
+Author: Matthew Truscott
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+VERSION = 1
+
+
+def default_dir():
+    """the dat folder next to this module, where all derived files live
+    """
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dat')
+
+
+def file_digest(path, blocksize=1 << 20):
+    """content hash of a file, read in blocks so that large files are never fully in memory
+
+    Arguments:
+        path {string} -- path of the file to hash
+
+    Returns:
+        string -- hex digest of the file contents
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f_read:
+        for block in iter(lambda: f_read.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sidecar_paths(source, directory=None):
+    """paths of the field and metadata sidecars for a given cube file. The name of the cube is kept
+    for readability, a hash of the absolute path avoids collisions between equally named cubes in
+    different folders.
+
+    Arguments:
+        source {string} -- path of the cube file
+
+    Keyword Arguments:
+        directory {string} -- folder that holds the sidecars (default: {dat folder})
+
+    Returns:
+        tuple -- (field path, metadata path)
+    """
+    if directory is None:
+        directory = default_dir()
+    abspath = os.path.abspath(source)
+    name = os.path.basename(abspath).split('.')[0]
+    key = hashlib.sha1(abspath.encode()).hexdigest()[:8]
+    base = os.path.join(directory, '{}_{}.field'.format(name, key))
+    return base + '.npy', base + '.json'
+
+
+def cached_digest(source, directory=None):
+    """content hash of a cube file as recorded by its sidecar, without reading the cube file
+
+    Returns:
+        string -- the digest, or None if there is no sidecar or the file has changed since
+    """
+    _, mpath = sidecar_paths(source, directory)
+    stat = os.stat(os.path.abspath(source))
+    try:
+        with open(mpath, 'r') as f_read:
+            meta = json.load(f_read)
+        if meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime:
+            return meta['digest']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _write_json(path, data):
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as f_write:
+        json.dump(data, f_write)
+    os.replace(tmppath, path)
+
+
+def load(source, directory=None, dtype=None):
+    """loads the cached field for a cube file, if a valid sidecar exists
+
+    Arguments:
+        source {string} -- path of the cube file
+
+    Keyword Arguments:
+        directory {string} -- folder that holds the sidecars (default: {dat folder})
+        dtype {np.dtype} -- required dtype of the field, a cache in any other dtype is stale
+        (default: {None})
+
+    Returns:
+        tuple -- (read-only memory mapped field, metadata dict), or (None, None) if the sidecar is
+        missing, stale or corrupt
+    """
+    fpath, mpath = sidecar_paths(source, directory)
+    if not (os.path.isfile(fpath) and os.path.isfile(mpath)):
+        return None, None
+    abspath = os.path.abspath(source)
+    stat = os.stat(abspath)
+    try:
+        with open(mpath, 'r') as f_read:
+            meta = json.load(f_read)
+        if meta['version'] != VERSION or meta['source'] != abspath or meta['size'] != stat.st_size:
+            print('field cache for {} is stale'.format(abspath))
+            return None, None
+        if meta['mtime'] != stat.st_mtime:
+            # file has been touched, only trust the cache if the contents are the same
+            if meta['digest'] != file_digest(abspath):
+                print('field cache for {} is stale'.format(abspath))
+                return None, None
+            meta['mtime'] = stat.st_mtime
+            _write_json(mpath, meta)
+        if dtype is not None and np.dtype(meta['dtype']) != np.dtype(dtype):
+            print('field cache for {} has a different dtype'.format(abspath))
+            return None, None
+        field = np.load(fpath, mmap_mode='r')
+        if (list(field.shape) != meta['header']['gridsize']
+                or field.dtype != np.dtype(meta['dtype'])):
+            raise ValueError('field does not match the cached header')
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        print('field cache for {} is corrupt ({}), rebuilding'.format(abspath, err))
+        return None, None
+    return field, meta
+
+
+def update_stats(source, stats, directory=None, dtype=None):
+    """replaces the field statistics recorded in the sidecar of a cube file, e.g. once the gradient
+    maximum is known. Nothing is done if there is no sidecar, or it holds another dtype.
+
+    Arguments:
+        source {string} -- path of the cube file
+        stats {dict} -- field statistics, see save
+
+    Keyword Arguments:
+        directory {string} -- folder that holds the sidecars (default: {dat folder})
+        dtype {np.dtype} -- dtype the statistics were found in (default: {None, any})
+    """
+    _, mpath = sidecar_paths(source, directory)
+    try:
+        with open(mpath, 'r') as f_read:
+            meta = json.load(f_read)
+        if dtype is not None and np.dtype(meta['dtype']) != np.dtype(dtype):
+            return
+    except (OSError, ValueError, KeyError, TypeError):
+        return
+    meta['stats'] = stats
+    _write_json(mpath, meta)
+
+
+def save(source, field, header, stats, directory=None):
+    """writes the field and metadata sidecars for a cube file. Files are written under a temporary
+    name and moved into place, so an interrupted write never leaves a valid looking sidecar.
+
+    Arguments:
+        source {string} -- path of the cube file
+        field {np array} -- the parsed field, before any rolling
+        header {dict} -- the header details, see Cube.get_header
+        stats {dict} -- precomputed field statistics (min, max, mean, and the gradient maximum
+        by level once known)
+
+    Keyword Arguments:
+        directory {string} -- folder that holds the sidecars (default: {dat folder})
+    """
+    fpath, mpath = sidecar_paths(source, directory)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    abspath = os.path.abspath(source)
+    stat = os.stat(abspath)
+    meta = {
+        'version': VERSION,
+        'source': abspath,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'digest': file_digest(abspath),
+        'dtype': np.dtype(field.dtype).str,
+        'header': header,
+        'stats': stats,
+    }
+    tmppath = fpath + '.tmp'
+    with open(tmppath, 'wb') as f_write:
+        np.save(f_write, field)
+    os.replace(tmppath, fpath)
+    _write_json(mpath, meta)
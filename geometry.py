@@ -0,0 +1,257 @@
+"""GEOMETRY MODULE
+
+Placement of the atom spheres and bond cylinders of a molecule, computed for all atoms and bonds at
+once in NumPy so that the drawing code only has to hand the arrays to blender. Each bond is drawn
+as two half cylinders, coloured after the atom at their end. Primitives are those of blender: a
+sphere of radius 1 and a cylinder of radius 1 and depth 2 along z, both centred on the origin.
+
+Author: Matthew Truscott
+"""
+import numpy as np
+
+import molecule as mol
+
+
+class Instances():
+    """transforms of a set of copies of one primitive, stacked along the first axis
+
+    Attributes:
+        locations {np array} -- (n, 3) centres
+        rotations {np array} -- (n, 3, 3) rotations, applied to the scaled primitive
+        scales {np array} -- (n, 3) scale along each axis of the primitive
+        species {np array} -- (n,) atomic number of the atom each copy belongs to, for colouring
+    """
+    def __init__(self, locations, rotations, scales, species):
+        self.locations = locations
+        self.rotations = rotations
+        self.scales = scales
+        self.species = species
+
+    def __len__(self):
+        return len(self.locations)
+
+    def subset(self, selection):
+        """the copies picked by a boolean mask or index array
+        """
+        return Instances(self.locations[selection], self.rotations[selection],
+                         self.scales[selection], self.species[selection])
+
+    def shapes(self):
+        """rotation and scale of each copy as one matrix, i.e. the matrix to transform the mesh
+        data of a primitive by
+
+        Returns:
+            np array -- (n, 4, 4) matrices without translation
+        """
+        matrices = np.zeros((len(self), 4, 4))
+        matrices[:, 0:3, 0:3] = self.rotations * self.scales[:, np.newaxis, :]
+        matrices[:, 3, 3] = 1.0
+        return matrices
+
+    def matrices(self):
+        """world matrices of the copies, translation included
+
+        Returns:
+            np array -- (n, 4, 4) matrices
+        """
+        matrices = self.shapes()
+        matrices[:, 0:3, 3] = self.locations
+        return matrices
+
+
+def uv_sphere(segments=64, rings=32):
+    """sphere of radius 1 made of rings of quads and triangle fans at the poles, like blender's
+    primitive_uv_sphere_add. Polygons are given as one flat array of vertex indices together with
+    the number of vertices of each polygon, and face outwards.
+
+    Keyword Arguments:
+        segments {int} -- vertices around each ring (default: {64})
+        rings {int} -- bands from pole to pole (default: {32})
+
+    Returns:
+        tuple -- (vertices, indices, sizes)
+    """
+    theta = np.pi * np.arange(1, rings) / rings
+    phi = 2.0 * np.pi * np.arange(segments) / segments
+    ring = np.stack((np.outer(np.sin(theta), np.cos(phi)), np.outer(np.sin(theta), np.sin(phi)),
+                     np.repeat(np.cos(theta)[:, np.newaxis], segments, axis=1)), axis=-1)
+    vertices = np.concatenate(([[0.0, 0.0, 1.0]], ring.reshape(-1, 3), [[0.0, 0.0, -1.0]]))
+
+    top = 0
+    bottom = len(vertices) - 1
+    current = np.arange(segments)
+    following = (current + 1) % segments
+    firsts = 1 + np.arange(rings - 2)[:, np.newaxis] * segments
+    quads = np.stack((firsts + current, firsts + segments + current,
+                      firsts + segments + following, firsts + following), axis=-1).reshape(-1, 4)
+    last = 1 + (rings - 2) * segments
+    fans = np.concatenate((np.stack((np.full(segments, top), 1 + current, 1 + following), axis=1),
+                           np.stack((np.full(segments, bottom), last + following, last + current),
+                                    axis=1)))
+    indices = np.concatenate((fans.ravel(), quads.ravel()))
+    sizes = np.concatenate((np.full(len(fans), 3), np.full(len(quads), 4)))
+    return vertices, indices, sizes
+
+
+def cylinder(segments=32):
+    """capped cylinder of radius 1 and depth 2 along z, like blender's primitive_cylinder_add, see
+    uv_sphere for the polygon layout
+
+    Keyword Arguments:
+        segments {int} -- vertices around each cap (default: {32})
+
+    Returns:
+        tuple -- (vertices, indices, sizes)
+    """
+    phi = 2.0 * np.pi * np.arange(segments) / segments
+    circle = np.stack((np.cos(phi), np.sin(phi)), axis=1)
+    vertices = np.concatenate((np.insert(circle, 2, -1.0, axis=1),
+                               np.insert(circle, 2, 1.0, axis=1)))
+    current = np.arange(segments)
+    following = (current + 1) % segments
+    sides = np.stack((current, following, segments + following, segments + current), axis=1)
+    indices = np.concatenate((sides.ravel(), current[::-1], segments + current))
+    sizes = np.concatenate((np.full(segments, 4), [segments, segments]))
+    return vertices, indices, sizes
+
+
+def instance_polygons(vertices, indices, sizes, instances):
+    """copies of a template mesh placed by each of the instances, merged into one mesh
+
+    Arguments:
+        vertices {np array} -- (n, 3) template vertices
+        indices {np array} -- flat vertex indices of the template polygons
+        sizes {np array} -- number of vertices of each template polygon
+        instances {Instances} -- placement of the copies
+
+    Returns:
+        tuple -- (vertices, indices, sizes) of the merged mesh
+    """
+    matrices = instances.matrices()
+    merged = np.einsum('kij,nj->kni', matrices[:, 0:3, 0:3], vertices)
+    merged += matrices[:, np.newaxis, 0:3, 3]
+    offsets = np.arange(len(instances)) * len(vertices)
+    return (merged.reshape(-1, 3), (offsets[:, np.newaxis] + indices).ravel(),
+            np.tile(sizes, len(instances)))
+
+
+def species_table(values, default=0.0):
+    """a dict keyed by atomic number (int or string, as in ions.json) as an array indexed by atomic
+    number
+
+    Arguments:
+        values {dict} -- e.g. radii
+
+    Keyword Arguments:
+        default {float} -- value of the atomic numbers missing from values (default: {0.0})
+
+    Returns:
+        np array -- (SPECIES_COUNT,) values
+    """
+    table = np.full(mol.SPECIES_COUNT, default, dtype=float)
+    for key, value in values.items():
+        table[int(key)] = float(value)
+    return table
+
+
+def rotations_to(directions):
+    """rotations that take the z axis onto each direction, by Rodrigues' formula
+    R = I + K + K^2 / (1 + cos), with K the cross product matrix of z x direction. 1 / (1 + cos) is
+    evaluated as (1 - cos) / sin^2 so that it stays accurate for directions close to -z, and -z
+    itself (where the axis is undefined) is a half turn about x.
+
+    Arguments:
+        directions {np array} -- (n, 3) unit vectors
+
+    Returns:
+        np array -- (n, 3, 3) rotation matrices
+    """
+    directions = np.asarray(directions, dtype=float)
+    count = len(directions)
+    cross = np.zeros((count, 3))
+    cross[:, 0] = -directions[:, 1]
+    cross[:, 1] = directions[:, 0]
+    cosine = directions[:, 2]
+    sine2 = cross[:, 0] ** 2 + cross[:, 1] ** 2
+
+    skew = np.zeros((count, 3, 3))
+    skew[:, 0, 1] = -cross[:, 2]
+    skew[:, 0, 2] = cross[:, 1]
+    skew[:, 1, 0] = cross[:, 2]
+    skew[:, 1, 2] = -cross[:, 0]
+    skew[:, 2, 0] = -cross[:, 1]
+    skew[:, 2, 1] = cross[:, 0]
+    factor = np.divide(1.0 - cosine, sine2, out=np.zeros(count), where=sine2 > 0)
+    rotations = np.eye(3) + skew + np.matmul(skew, skew) * factor[:, np.newaxis, np.newaxis]
+    rotations[(sine2 == 0) & (cosine < 0)] = np.diag((1.0, -1.0, -1.0))
+    return rotations
+
+
+def sphere_instances(positions, species, radii, atom_scale=0.24):
+    """one sphere per atom
+
+    Arguments:
+        positions {np array} -- (atomcount, 3) atom positions
+        species {np array} -- atomic numbers
+        radii {np array} -- radius of each species, see species_table
+
+    Keyword Arguments:
+        atom_scale {float} -- factor on the radii (default: {0.24})
+
+    Returns:
+        Instances -- the spheres
+    """
+    positions = np.asarray(positions, dtype=float)
+    species = np.asarray(species, dtype=int)
+    count = len(positions)
+    scales = np.repeat((radii[species] * atom_scale)[:, np.newaxis], 3, axis=1)
+    return Instances(positions.copy(), np.broadcast_to(np.eye(3), (count, 3, 3)).copy(), scales,
+                     species.copy())
+
+
+def cylinder_instances(positions, bondlist, species, bond_width=0.24):
+    """two half cylinders per bond, the first from the first atom to the middle of the bond and the
+    second from the middle to the second atom
+
+    Arguments:
+        positions {np array} -- (atomcount, 3) atom positions
+        bondlist {list} -- (i, j) atom index pairs
+        species {np array} -- atomic numbers
+
+    Keyword Arguments:
+        bond_width {float} -- radius of the cylinders (default: {0.24})
+
+    Returns:
+        Instances -- the half cylinders, those of the first atoms followed by those of the second
+    """
+    positions = np.asarray(positions, dtype=float)
+    species = np.asarray(species, dtype=int)
+    bonds = np.asarray(bondlist, dtype=int).reshape(-1, 2)
+    start = positions[bonds[:, 0]]
+    end = positions[bonds[:, 1]]
+    middle = (start + end) / 2.0
+
+    vectors = start - middle
+    lengths = np.linalg.norm(vectors, axis=1)
+    # atoms on top of each other give an empty cylinder along z
+    directions = np.divide(vectors, lengths[:, np.newaxis], out=np.zeros_like(vectors),
+                           where=lengths[:, np.newaxis] > 0)
+    directions[lengths == 0, 2] = 1.0
+    rotations = rotations_to(directions)
+    scales = np.empty((len(bonds), 3))
+    scales[:, 0:2] = bond_width
+    scales[:, 2] = lengths / 2.0
+
+    return Instances(np.concatenate(((start + middle) / 2.0, (middle + end) / 2.0)),
+                     np.concatenate((rotations, rotations)), np.concatenate((scales, scales)),
+                     np.concatenate((species[bonds[:, 0]], species[bonds[:, 1]])))
+
+
+def molecule_instances(positions, bondlist, species, radii, atom_scale=0.24, bond_width=0.24):
+    """spheres and half cylinders of a whole molecule, see sphere_instances and cylinder_instances
+
+    Returns:
+        tuple -- (spheres, cylinders) Instances
+    """
+    return (sphere_instances(positions, species, radii, atom_scale),
+            cylinder_instances(positions, bondlist, species, bond_width))
@@ -0,0 +1,131 @@
+"""MESH_IO MODULE
+
+Reading and writing of isosurface meshes. Collada (.dae) is kept for compatibility, the binary
+formats are much smaller and faster for large meshes:
+
+    .ply -- binary little endian PLY, memory mapped on load
+    .npz -- uncompressed numpy archive of vertices, triangles and (optionally) normals
+
+Author: Matthew Truscott
+"""
+import os
+
+import mcubes
+import numpy as np
+
+FORMATS = ('dae', 'ply', 'npz')
+
+# face records as written to binary PLY files, a vertex count followed by three indices
+PLY_FACE = np.dtype([('count', 'u1'), ('vertices', '<i4', (3,))])
+
+
+def mesh_format(path):
+    """format of a mesh file, from its extension
+    """
+    fmt = os.path.splitext(path)[1][1:].lower()
+    if fmt not in FORMATS:
+        raise ValueError('unknown mesh format .{}, expected one of {}'.format(fmt, FORMATS))
+    return fmt
+
+
+def save_mesh(path, vertices, triangles, normals=None, name='mesh'):
+    """saves a triangle mesh, in the format given by the extension of path
+
+    Arguments:
+        path {string} -- path of the mesh file
+        vertices {np array} -- (n, 3) vertex positions
+        triangles {np array} -- (m, 3) vertex indices of each triangle
+
+    Keyword Arguments:
+        normals {np array} -- (n, 3) vertex normals, ignored by collada (default: {None})
+        name {str} -- name of the mesh, only used by collada (default: {'mesh'})
+    """
+    fmt = mesh_format(path)
+    if fmt == 'dae':
+        mcubes.export_mesh(vertices, triangles, path, name)
+    elif fmt == 'npz':
+        arrays = {'vertices': np.asarray(vertices, dtype='<f4'),
+                  'triangles': np.asarray(triangles, dtype='<i4')}
+        if normals is not None:
+            arrays['normals'] = np.asarray(normals, dtype='<f4')
+        with open(path, 'wb') as f_write:
+            np.savez(f_write, **arrays)
+    else:
+        _save_ply(path, vertices, triangles, normals)
+
+
+def _save_ply(path, vertices, triangles, normals):
+    fields = [('co', '<f4', (3,))]
+    properties = ['property float x', 'property float y', 'property float z']
+    if normals is not None:
+        fields.append(('no', '<f4', (3,)))
+        properties += ['property float nx', 'property float ny', 'property float nz']
+    vdata = np.empty((len(vertices),), dtype=fields)
+    vdata['co'] = vertices
+    if normals is not None:
+        vdata['no'] = normals
+    fdata = np.empty((len(triangles),), dtype=PLY_FACE)
+    fdata['count'] = 3
+    fdata['vertices'] = triangles
+
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex {}'.format(len(vertices))]
+    header += properties
+    header += ['element face {}'.format(len(triangles)),
+               'property list uchar int vertex_indices', 'end_header']
+    with open(path, 'wb') as f_write:
+        f_write.write(('\n'.join(header) + '\n').encode('ascii'))
+        vdata.tofile(f_write)
+        fdata.tofile(f_write)
+
+
+def load_mesh(path):
+    """loads a mesh saved by save_mesh. PLY files are memory mapped, so the arrays returned are
+    read-only views into the file.
+
+    Arguments:
+        path {string} -- path of a .ply or .npz mesh file
+
+    Returns:
+        tuple -- (vertices, triangles, normals), normals is None if the file has none
+    """
+    fmt = mesh_format(path)
+    if fmt == 'npz':
+        with np.load(path) as data:
+            normals = data['normals'] if 'normals' in data.files else None
+            return data['vertices'], data['triangles'], normals
+    if fmt == 'dae':
+        raise ValueError('collada meshes are imported by blender, not loaded here')
+    return _load_ply(path)
+
+
+def _load_ply(path):
+    with open(path, 'rb') as f_read:
+        header = []
+        while True:
+            line = f_read.readline()
+            if not line:
+                raise ValueError('{} has no PLY header'.format(path))
+            line = line.decode('ascii').strip()
+            header.append(line)
+            if line == 'end_header':
+                break
+        offset = f_read.tell()
+    if 'format binary_little_endian 1.0' not in header:
+        raise ValueError('{} is not a binary little endian PLY file'.format(path))
+    counts = {}
+    for line in header:
+        if line.startswith('element'):
+            _, element, count = line.split()
+            counts[element] = int(count)
+    fields = [('co', '<f4', (3,))]
+    has_normals = 'property float nx' in header
+    if has_normals:
+        fields.append(('no', '<f4', (3,)))
+    if counts['vertex'] == 0 or counts['face'] == 0:
+        # nothing to map
+        normals = np.zeros((0, 3), dtype='<f4') if has_normals else None
+        return np.zeros((0, 3), dtype='<f4'), np.zeros((0, 3), dtype='<i4'), normals
+    vdata = np.memmap(path, dtype=fields, mode='r', offset=offset, shape=(counts['vertex'],))
+    offset += vdata.nbytes
+    fdata = np.memmap(path, dtype=PLY_FACE, mode='r', offset=offset, shape=(counts['face'],))
+    return vdata['co'], fdata['vertices'], vdata['no'] if has_normals else None
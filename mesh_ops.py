@@ -0,0 +1,175 @@
+"""MESH_OPS MODULE
+
+Post-processing of isosurface meshes in NumPy, between marching cubes and export: vertex welding,
+decimation to a triangle budget and levels of detail. Decimation is done by vertex clustering, each
+cluster is collapsed to the point that best fits the planes of its triangles (the quadric error of
+Lindstrom's out-of-core simplification), which keeps the surface in place far better than the plain
+cluster average.
+
+Author: Matthew Truscott
+"""
+import time
+
+import numpy as np
+
+
+def weld_vertices(vertices, triangles, tol=1e-6):
+    """merges vertices closer than tol (on a grid of that spacing) and drops the triangles that
+    collapse as a result
+
+    Arguments:
+        vertices {np array} -- (n, 3) vertex positions
+        triangles {np array} -- (m, 3) vertex indices
+
+    Keyword Arguments:
+        tol {float} -- welding distance (default: {1e-6})
+
+    Returns:
+        tuple -- (vertices, triangles)
+    """
+    keys = np.round(np.asarray(vertices) / tol).astype(np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    triangles = inverse.reshape(-1)[np.asarray(triangles, dtype=np.int64)]
+    return np.asarray(vertices)[first], clean_triangles(triangles)
+
+
+def clean_triangles(triangles):
+    """drops degenerate triangles (repeated vertices) and duplicates of the same triangle, the first
+    copy of each triangle keeps its winding
+    """
+    triangles = triangles[(triangles[:, 0] != triangles[:, 1])
+                          & (triangles[:, 1] != triangles[:, 2])
+                          & (triangles[:, 0] != triangles[:, 2])]
+    _, first = np.unique(np.sort(triangles, axis=1), axis=0, return_index=True)
+    return triangles[np.sort(first)]
+
+
+def surface_area(vertices, triangles):
+    """total area of a triangle mesh
+    """
+    corners = vertices[triangles]
+    return 0.5 * float(np.sum(np.linalg.norm(
+        np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)))
+
+
+def cluster_vertices(vertices, triangles, cellsize):
+    """collapses all vertices in each cube of a grid of the given spacing to a single vertex,
+    placed where it best fits the triangles around it
+
+    Returns:
+        tuple -- (vertices, triangles)
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    keys = np.floor(vertices / cellsize).astype(np.int64)
+    _, cluster = np.unique(keys, axis=0, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    nclusters = int(cluster.max()) + 1 if len(cluster) else 0
+
+    # centroid of each cluster, the fallback position
+    counts = np.bincount(cluster, minlength=nclusters).astype(float)
+    centroid = np.stack([np.bincount(cluster, vertices[:, i], nclusters) for i in range(3)], axis=1)
+    centroid /= counts[:, None]
+
+    # area weighted plane quadrics of the triangles, summed per cluster over their corners
+    corners = vertices[triangles]
+    normal = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    area = np.linalg.norm(normal, axis=1)
+    valid = area > 0
+    normal[valid] /= area[valid, None]
+    offset = -np.einsum('ij,ij->i', normal, corners[:, 0])
+    quad_a = area[:, None, None] * normal[:, :, None] * normal[:, None, :]
+    quad_b = (area * offset)[:, None] * normal
+    mat_a = np.zeros((nclusters, 3, 3))
+    vec_b = np.zeros((nclusters, 3))
+    for corner in range(3):
+        np.add.at(mat_a, cluster[triangles[:, corner]], quad_a)
+        np.add.at(vec_b, cluster[triangles[:, corner]], quad_b)
+
+    # minimise the quadric error relative to the centroid, truncating small singular values so
+    # that flat and edge-like clusters stay near the centroid along their free directions
+    scale = np.maximum(np.trace(mat_a, axis1=1, axis2=2), 1e-300)[:, None, None]
+    residual = -vec_b - np.einsum('kij,kj->ki', mat_a, centroid)
+    shift = np.einsum('kij,kj->ki', np.linalg.pinv(mat_a / scale, rcond=1e-3),
+                      residual / scale[:, :, 0])
+    # never move a vertex out of its own grid cell
+    shift = np.clip(shift, -cellsize, cellsize)
+    newvertices = centroid + shift
+
+    newtriangles = clean_triangles(cluster[triangles])
+    # drop clusters that are no longer used by any triangle
+    used, newtriangles = np.unique(newtriangles, return_inverse=True)
+    return newvertices[used], newtriangles.reshape(-1, 3)
+
+
+def decimate(vertices, triangles, budget, iterations=8):
+    """reduces a mesh to at most budget triangles by vertex clustering, the cluster size is grown
+    until the budget is met
+
+    Arguments:
+        vertices {np array} -- (n, 3) vertex positions
+        triangles {np array} -- (m, 3) vertex indices
+        budget {int} -- largest number of triangles wanted
+
+    Keyword Arguments:
+        iterations {int} -- most attempts at finding a cluster size (default: {8})
+
+    Returns:
+        tuple -- (vertices, triangles)
+    """
+    if len(triangles) <= budget:
+        return vertices, triangles
+    # a closed surface of area A meshed with cells of size h has about 2A/h^2 triangles
+    cellsize = np.sqrt(2.0 * surface_area(vertices, triangles) / budget)
+    best = None
+    for _ in range(iterations):
+        newvertices, newtriangles = cluster_vertices(vertices, triangles, cellsize)
+        if len(newtriangles) <= budget:
+            return newvertices, newtriangles
+        best = (newvertices, newtriangles)
+        cellsize *= 1.05 * np.sqrt(len(newtriangles) / budget)
+    print('warning: budget of {} triangles not reached, {} left'.format(budget, len(best[1])))
+    return best
+
+
+def postprocess(vertices, triangles, budget=None, lods=None):
+    """welds a marching cubes mesh and decimates it to the given budgets
+
+    Arguments:
+        vertices {np array} -- (n, 3) vertex positions
+        triangles {np array} -- (m, 3) vertex indices
+
+    Keyword Arguments:
+        budget {int} -- triangle budget of the main mesh (default: {None, no decimation})
+        lods {list} -- triangle budgets of extra levels of detail (default: {None})
+
+    Returns:
+        tuple -- (main mesh, list of lod meshes, report), meshes are (vertices, triangles) and the
+        report lists the budget, triangle count and time taken of each step
+    """
+    report = []
+    start = time.time()
+    count = len(triangles)
+    vertices, triangles = weld_vertices(vertices, triangles)
+    report.append({'step': 'weld', 'budget': None, 'triangles': len(triangles),
+                   'time': time.time() - start})
+
+    if budget is not None:
+        start = time.time()
+        vertices, triangles = decimate(vertices, triangles, budget)
+        report.append({'step': 'decimate', 'budget': budget, 'triangles': len(triangles),
+                       'time': time.time() - start})
+
+    meshes = []
+    for lod in (lods or []):
+        start = time.time()
+        meshes.append(decimate(vertices, triangles, lod))
+        report.append({'step': 'lod', 'budget': lod, 'triangles': len(meshes[-1][1]),
+                       'time': time.time() - start})
+
+    print('step       budget   triangles   reduction   time (s)')
+    for step in report:
+        print('{:8} {:>8} {:11d} {:10.1f}x {:10.3f}'.format(
+            step['step'], str(step['budget'] or '-'), step['triangles'],
+            count / max(step['triangles'], 1), step['time']))
+    return (vertices, triangles), meshes, report
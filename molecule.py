@@ -1,7 +1,24 @@
 #!/home/mat/.pyenv/shims/python python3
 
+import itertools
+import time
+
 import numpy as np
 
+# conversion from bohr (cube file units) to pm
+BOHR_TO_PM = 52.91772083
+
+# atomic numbers up to 118
+SPECIES_COUNT = 119
+
+# bond lengths for common bonding atoms, keyed by atomic number, each entry is a tuple of min/max in
+# pm, see bond_table for how the pairs are looked up
+BOND_LENGTHS = {
+	6: {1: (106, 112), 6: (120, 154), 7: (116, 210), 8: (113, 215)},
+	7: {1: (90, 110), 7: (120, 155)},
+	8: {1: (90, 100), 6: (120, 154)},
+}
+
 class Molecule():
 	"""
 	molecule contains all the molecular information along with functions that can be called to aid with
@@ -60,61 +77,178 @@ class Molecule():
 		sdy = (vecx[1] - vecy[1]) ** 2
 		sdz = (vecx[2] - vecy[2]) ** 2
 		dist = (sdx + sdy + sdz) ** 0.5
-		pmdist = dist * 52.91772083
+		pmdist = dist * BOHR_TO_PM
 		return pmdist
 
-	def create_bonds(self):
-		# have lists for the atomic positions and the atomlist. 
-		# Now, connect the atoms using expected bond lengths
-		# Each atom has a valence, may want to figure this out 
+	def create_bonds(self, cell=None, bond_lengths=None):
+		# connect the atoms using expected bond lengths, see find_bonds
+		# Each atom has a valence, may want to figure this out
 		# in the future (but this isn't a general rule because
 		# ions
-		# Instead just loop through entire list each time
-
-		# bond lists for common bonding atoms, index is equivalent to atomic mass, each entry should be a tuple of
-		# min/max in pm
-		bond_dict = {}
-		bond_dict[6] = {}
-		bond_dict[6][1] = (106, 112)
-		bond_dict[6][6] = (120, 154)
-		bond_dict[6][7] = (116, 210)
-		bond_dict[6][8] = (113, 215)
-		bond_dict[7] = {}
-		bond_dict[7][1] = (90, 110)
-		bond_dict[7][7] = (120, 155)
-		bond_dict[8] = {}
-		bond_dict[8][1] = (90, 100)
-		bond_dict[8][6] = (120, 154)
-
-		self.bondlist = []
-		atomcheck = set(range(self.atomcount))
-		# iterate through the list of positions, get distance between atoms and compare with dicts
-		for i, ival in enumerate(self.a_species):
-			for j, jval in enumerate(self.a_species):
-				# skip repeats
-				if j <= i:
-					continue
-				min_length = 0
-				max_length = 0
-				if ival in bond_dict:
-					if jval in bond_dict[ival]:
-						min_length, max_length = bond_dict[ival][jval]
-				elif jval in bond_dict:
-					if ival in bond_dict[jval]:
-						min_length, max_length = bond_dict[jval][ival]
-				distance = self.get_distance(self.m_positions[i], self.m_positions[j])
-				#print('distance between {} and {} is {}'.format(i, j, distance))
-				if distance > min_length and distance < max_length:
-					self.bondlist.append((i, j))
-					#print('bonded {} with {}'.format(i, j))
-					if i in atomcheck:
-						atomcheck.remove(i)
-					if j in atomcheck:
-						atomcheck.remove(j)
-
-		print('bonding complete: {}'.format(self.bondlist))
-		if atomcheck:
-			print('the following indices are unattached: {}'.format(atomcheck))
+		start = time.time()
+		if bond_lengths is None:
+			bond_lengths = BOND_LENGTHS
+		pairs = find_bonds(self.m_positions, self.a_species, bond_table(bond_lengths), cell)
+		self.bondlist = [(int(i), int(j)) for i, j in pairs]
+
+		print('bonding complete: {} bonds, time elapsed = {}s'.format(
+			len(self.bondlist), time.time() - start))
+		attached = np.zeros(self.atomcount, dtype=bool)
+		attached[pairs.ravel()] = True
+		if not np.all(attached):
+			print('the following indices are unattached: {}'.format(np.flatnonzero(~attached)))
 
 	def add_rendered(self, atoms):
 		self.rendered = atoms
+
+
+def bond_table(bond_lengths=BOND_LENGTHS):
+	"""min/max bond lengths for every ordered pair of species, as an array. Entry [a, b] is used for
+	an atom of species a and a later atom (higher index) of species b. Lengths are looked up under
+	a first, and only if a has no entry at all under b, so the table is not symmetric, e.g. [7, 6]
+	is empty while [6, 7] is not. Pairs without lengths never bond.
+
+	Keyword Arguments:
+		bond_lengths {dict} -- nested dict of (min, max) in pm (default: {BOND_LENGTHS})
+
+	Returns:
+		np array -- (SPECIES_COUNT, SPECIES_COUNT, 2) lengths in pm
+	"""
+	table = np.zeros((SPECIES_COUNT, SPECIES_COUNT, 2), dtype=float)
+	for first, row in bond_lengths.items():
+		for second, lengths in row.items():
+			table[first, second] = lengths
+			if second not in bond_lengths:
+				table[second, first] = lengths
+	return table
+
+
+def find_bonds(positions, species, table, cell=None):
+	"""pairs of atoms whose distance lies strictly between the min/max bond lengths of their
+	species, see neighbour_pairs for how the pairs are found.
+
+	Arguments:
+		positions {np array} -- (atomcount, 3) positions in bohr
+		species {np array} -- atomic numbers
+		table {np array} -- bond lengths, see bond_table
+
+	Keyword Arguments:
+		cell {np array} -- cell vectors as rows, e.g. ScalarField.transform. Bonds are then also
+		found across the periodic boundaries, between nearest images (default: {None})
+
+	Returns:
+		np array -- (bondcount, 2) atom indices i < j, sorted
+	"""
+	pairs, distances = neighbour_pairs(positions, max_bond_length(table), cell)
+	return pairs[bonded(species, pairs, distances, table)]
+
+
+def max_bond_length(table):
+	"""longest bond in a bond table, in bohr, rounded up slightly so that no bond is lost to
+	rounding when converting from pm
+	"""
+	return table[:, :, 1].max() / BOHR_TO_PM * (1.0 + 1e-9)
+
+
+def bonded(species, pairs, distances, table):
+	"""which pairs of atoms are bonded, i.e. their distance lies strictly between the min/max
+	bond lengths of their species
+
+	Arguments:
+		species {np array} -- atomic numbers
+		pairs {np array} -- (n, 2) atom indices i < j
+		distances {np array} -- distance of each pair in bohr
+		table {np array} -- bond lengths, see bond_table
+
+	Returns:
+		np array -- boolean mask over pairs
+	"""
+	species = np.asarray(species, dtype=int)
+	distances = distances * BOHR_TO_PM
+	lengths = table[species[pairs[:, 0]], species[pairs[:, 1]]]
+	return (distances > lengths[:, 0]) & (distances < lengths[:, 1])
+
+
+def pair_distances(positions, pairs, cell=None):
+	"""distances between pairs of atoms, between nearest images if the cell is given
+
+	Returns:
+		np array -- distance of each pair in bohr
+	"""
+	delta = positions[pairs[:, 0]] - positions[pairs[:, 1]]
+	if cell is not None:
+		cell = np.asarray(cell, dtype=float)[0:3, 0:3]
+		delta = delta.dot(np.linalg.inv(cell))
+		delta -= np.round(delta)
+		delta = delta.dot(cell)
+	return (delta[:, 0] ** 2 + delta[:, 1] ** 2 + delta[:, 2] ** 2) ** 0.5
+
+
+def neighbour_pairs(positions, cutoff, cell=None):
+	"""all pairs of atoms no further apart than cutoff. Atoms are hashed into bins at least as wide
+	as the cutoff, so only atoms in neighbouring bins are compared.
+
+	Arguments:
+		positions {np array} -- (atomcount, 3) positions in bohr
+		cutoff {float} -- largest distance in bohr
+
+	Keyword Arguments:
+		cell {np array} -- cell vectors as rows, pairs are then also found across the periodic
+		boundaries, between nearest images (default: {None})
+
+	Returns:
+		tuple -- ((n, 2) atom indices i < j sorted, distance of each pair in bohr)
+	"""
+	positions = np.asarray(positions, dtype=float)
+	if len(positions) < 2 or cutoff <= 0:
+		return np.zeros((0, 2), dtype=int), np.zeros(0)
+
+	if cell is not None:
+		cell = np.asarray(cell, dtype=float)[0:3, 0:3]
+		frac = positions.dot(np.linalg.inv(cell))
+		frac -= np.floor(frac)
+		# distance between opposite faces of the cell, so that each bin is at least cutoff across
+		widths = abs(np.linalg.det(cell)) / np.linalg.norm(
+			np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]]), axis=1)
+		nbins = np.maximum(1, (widths // cutoff).astype(int))
+		bins = np.minimum((frac * nbins).astype(int), nbins - 1)
+		# neighbouring bins, wrapped, each one only once when there are less than three bins
+		offsets = [sorted(set(offset % n for offset in (-1, 0, 1))) for n in nbins]
+	else:
+		lower = positions.min(axis=0)
+		extent = positions.max(axis=0) - lower
+		# very sparse atoms get wider bins, so that bin ids stay in range
+		size = np.maximum(cutoff, extent / (1 << 20))
+		nbins = (extent // size).astype(int) + 1
+		bins = np.minimum(((positions - lower) // size).astype(int), nbins - 1)
+		offsets = [(-1, 0, 1)] * 3
+
+	ids = (bins[:, 0] * nbins[1] + bins[:, 1]) * nbins[2] + bins[:, 2]
+	order = np.argsort(ids, kind='stable')
+	sorted_ids = ids[order]
+
+	found = []
+	for offset in itertools.product(*offsets):
+		neighbours = bins + offset
+		if cell is not None:
+			atoms = np.arange(len(positions))
+			neighbours %= nbins
+		else:
+			atoms = np.flatnonzero(np.all((neighbours >= 0) & (neighbours < nbins), axis=1))
+			neighbours = neighbours[atoms]
+		nids = (neighbours[:, 0] * nbins[1] + neighbours[:, 1]) * nbins[2] + neighbours[:, 2]
+		starts = np.searchsorted(sorted_ids, nids, 'left')
+		counts = np.searchsorted(sorted_ids, nids, 'right') - starts
+		# every atom against every atom of the neighbouring bin
+		first = np.repeat(atoms, counts)
+		runs = np.repeat(starts - np.cumsum(counts) + counts, counts)
+		second = order[np.arange(len(first)) + runs]
+		pairs = np.stack((first, second), axis=1)[first < second]
+		distances = pair_distances(positions, pairs, cell)
+		close = distances <= cutoff
+		found.append((pairs[close], distances[close]))
+
+	pairs = np.concatenate([pair for pair, _ in found])
+	distances = np.concatenate([distance for _, distance in found])
+	order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+	return pairs[order], distances[order]
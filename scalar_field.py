@@ -1,5 +1,7 @@
 #!/home/mat/.pyenv/shims/python python3
 
+from multiprocessing import shared_memory
+
 import numpy as np
 
 class ScalarField():
@@ -11,13 +13,22 @@ class ScalarField():
 	pointer to the cube file is stored until the field needs to be read in).
 	"""
 
-	def __init__(self):
+	def __init__(self, dtype=float):
 		self.status = 0 # how much of the field is initialized
+		self.dtype = np.dtype(dtype) # precision the field is stored in
 		self.gridsize = np.zeros((3,), dtype=int)
 		self.field = None
 		self.transform = np.eye(4, dtype=float)
 		self.meshtransform = None
 		self.cubefile = None
+		self.bodyoffset = 0 # byte offset of the first field value in the cube file
+		self.stats = None # precomputed min, max and mean of the field
+		self.shm = None # shared memory block backing the field, if any
+		self.blockindex = None # min/max of blocks of the field, finest first, see build_blockindex
+		self.bricksize = 8
+		self.pyramid = {} # downsampled copies of the field by (level, mode), see get_level
+		self.region = None # start and gridsize of the full field, if this is a region of it
+		self.shift = np.zeros((3,), dtype=int) # periodic shift of the field from the file, see roll
 
 	def __str__(self):
 		ostr = '\tGRIDSIZE = {}'.format(self.gridsize) + '\n'
@@ -25,17 +36,254 @@ class ScalarField():
 		ostr += '\tTRANSFORM = \n{}'.format(self.transform) + '\n'
 		return ostr
 
-	def roll(self):
-		# roll the field
-		uroll = self.gridsize // 2
-		self.field = np.roll(self.field, uroll, axis=(0, 1, 2))
+	def roll_shift(self):
+		# default shift when rolling, half the cell, which brings a molecule split across the cell
+		# edges back together in the middle
+		return self.gridsize // 2
+
+	def roll(self, shift=None):
+		# move the field periodically by shift grid points, point i goes to i + shift, and add it to
+		# the recorded shift. Planes are moved along x in cycles through one spare plane, so no second
+		# copy of the field is made. Without a field only the shift is recorded, to be applied on load
+		if shift is None:
+			shift = self.roll_shift()
+		shift = np.asarray(shift, dtype=int) % self.gridsize
+		self.shift = (self.shift + shift) % self.gridsize
+		if self.field is None or not np.any(shift):
+			return
+		if not self.field.flags.writeable:
+			# memory mapped from the field cache, which is never changed
+			self.field = np.roll(self.field, shift, axis=(0, 1, 2))
+		else:
+			n_x = self.gridsize[0]
+			inplane = tuple(shift[1:])
+			for start in range(np.gcd(n_x, shift[0])):
+				spare = np.roll(self.field[start], inplane, axis=(0, 1))
+				idx = start
+				source = (idx - shift[0]) % n_x
+				while source != start:
+					if any(inplane):
+						self.field[idx] = np.roll(self.field[source], inplane, axis=(0, 1))
+					else:
+						self.field[idx] = self.field[source]
+					idx = source
+					source = (idx - shift[0]) % n_x
+				self.field[idx] = spare
+		self.blockindex = None
+		self.pyramid = {}
+
+	def roll_slab(self, slab, x_0, shift):
+		# roll a slab of planes starting at x_0, yields (x, slab) pieces that are contiguous in the
+		# rolled field, the slab is split in two where it wraps around the cell edge
+		if shift[1] or shift[2]:
+			slab = np.roll(slab, (shift[1], shift[2]), axis=(1, 2))
+		x_r = (x_0 + shift[0]) % self.gridsize[0]
+		split = self.gridsize[0] - x_r
+		yield x_r, slab[:split]
+		if split < slab.shape[0]:
+			yield 0, slab[split:]
 
 	def init_field(self):
-		self.field = np.zeros((self.gridsize), dtype=float)
+		self.field = np.zeros((self.gridsize), dtype=self.dtype)
+
+	def init_shared_field(self):
+		# allocate the field in shared memory so that worker processes can fill it in directly, the
+		# name is unlinked by the caller once the workers are done, the mapping stays valid for as
+		# long as self.shm is kept
+		nbytes = int(np.prod(self.gridsize)) * self.dtype.itemsize
+		self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+		self.field = np.ndarray(self.gridsize, dtype=self.dtype, buffer=self.shm.buf)
+		self.field[:] = 0.0
+		self.stats = None
+		self.blockindex = None
+		self.pyramid = {}
+		return self.shm.name
+
+	def set_dtype(self, dtype):
+		self.dtype = np.dtype(dtype)
+
+	def work_dtype(self):
+		# precision used for arithmetic on the field, half precision is only good for storage
+		return np.promote_types(self.dtype, np.float32)
+
+	def set_values(self, values):
+		# NaN entries are written for undefined points, treat them as empty
+		values = values.astype(self.dtype, copy=False)
+		values[np.isnan(values)] = 0.0
+		self.stats = None
+		self.blockindex = None
+		self.pyramid = {}
+		if values.size == np.prod(self.gridsize):
+			self.field = values.reshape(self.gridsize)
+		else:
+			# truncated body, leave the remaining points empty
+			self.init_field()
+			self.field.reshape(-1)[:values.size] = values
+
+	def set_field(self, field, stats=None):
+		self.field = field
+		self.stats = stats
+		self.blockindex = None
+		self.pyramid = {}
+
+	def compute_stats(self):
+		self.stats = {
+			'min': float(np.amin(self.field)),
+			'max': float(np.amax(self.field)),
+			'mean': float(np.mean(self.field, dtype=np.float64)),
+		}
+		return self.stats
+
+	def get_range(self):
+		# min and max of the field, only scanning the field if they are not yet known
+		if self.stats is None:
+			if self.blockindex is not None:
+				bmin, bmax = self.blockindex[-1]
+				return float(np.amin(bmin)), float(np.amax(bmax))
+			self.compute_stats()
+		return self.stats['min'], self.stats['max']
+
+	def build_blockindex(self, brick=8):
+		"""
+		builds a pyramid of block minima and maxima. The finest level holds the min/max of each
+		brick x brick x brick block of the field, each coarser level halves the number of blocks
+		along every axis, up to a single block for the whole field. This is used to skip blocks that
+		cannot contain an isosurface and to answer range queries without scanning the field.
+		"""
+		self.bricksize = brick
+		bmin = _block_reduce(self.field, brick, np.minimum)
+		bmax = _block_reduce(self.field, brick, np.maximum)
+		self.blockindex = [(bmin, bmax)]
+		while max(bmin.shape) > 1:
+			bmin = _block_reduce(bmin, 2, np.minimum)
+			bmax = _block_reduce(bmax, 2, np.maximum)
+			self.blockindex.append((bmin, bmax))
+		return self.blockindex
+
+	def block_size(self, level):
+		# edge length (in grid points) of the blocks in a level of the block index
+		return self.bricksize * 2 ** level
+
+	def region_range(self, lower, upper):
+		"""
+		exact min and max over the grid points lower <= idx < upper. Whole bricks inside the region
+		are read from the block index, only the partial bricks along the region edges are scanned.
+		"""
+		lower = np.maximum(np.array(lower, dtype=int), 0)
+		upper = np.minimum(np.array(upper, dtype=int), self.gridsize)
+		if np.any(upper <= lower):
+			raise ValueError('empty region {} to {}'.format(lower, upper))
+		if self.blockindex is None:
+			region = self.field[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+			return float(np.amin(region)), float(np.amax(region))
+
+		# bricks that are completely inside the region
+		brick = self.bricksize
+		b_lo = -(-lower // brick)
+		b_hi = np.where(upper == self.gridsize, -(-upper // brick), upper // brick)
+		if np.any(b_hi <= b_lo):
+			region = self.field[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+			return float(np.amin(region)), float(np.amax(region))
+		bmin, bmax = self.blockindex[0]
+		field_min = float(np.amin(bmin[b_lo[0]:b_hi[0], b_lo[1]:b_hi[1], b_lo[2]:b_hi[2]]))
+		field_max = float(np.amax(bmax[b_lo[0]:b_hi[0], b_lo[1]:b_hi[1], b_lo[2]:b_hi[2]]))
+
+		# scan what is left over, as slabs on either side of the inner box along each axis
+		inner_lo = b_lo * brick
+		inner_hi = np.minimum(b_hi * brick, self.gridsize)
+		box_lo = lower.copy()
+		box_hi = upper.copy()
+		for axis in range(3):
+			for start, stop in ((box_lo[axis], inner_lo[axis]), (inner_hi[axis], box_hi[axis])):
+				if start >= stop:
+					continue
+				index = [slice(box_lo[i], box_hi[i]) for i in range(3)]
+				index[axis] = slice(start, stop)
+				region = self.field[tuple(index)]
+				field_min = min(field_min, float(np.amin(region)))
+				field_max = max(field_max, float(np.amax(region)))
+			# the rest of the region along this axis is the inner box
+			box_lo[axis] = inner_lo[axis]
+			box_hi[axis] = inner_hi[axis]
+		return field_min, field_max
+
+	def active_blocks(self, isoval, level=0):
+		"""
+		blocks of cells that may be crossed by the isosurface at isoval, as (lower, upper) grid point
+		bounds. A block of cells also touches the first grid points of the next block along each
+		axis, so the block bounds are widened by their neighbours before testing.
+		"""
+		bmin, bmax = self.blockindex[level]
+		for axis in range(3):
+			bmin = np.minimum(bmin, _shift_down(bmin, axis))
+			bmax = np.maximum(bmax, _shift_down(bmax, axis))
+		size = self.block_size(level)
+		blocks = []
+		for block in np.argwhere((bmin <= isoval) & (bmax >= isoval)):
+			lower = block * size
+			# the last grid point along an axis has no cells of its own
+			if np.any(lower >= self.gridsize - 1):
+				continue
+			blocks.append((lower, np.minimum(lower + size + 1, self.gridsize)))
+		return blocks
+
+	def level_shape(self, level):
+		# gridsize of a level of the pyramid, odd sizes are padded to the next even size first
+		shape = np.array(self.gridsize, dtype=int)
+		for _ in range(level):
+			shape = -(-shape // 2)
+		return shape
+
+	def get_level(self, level, mode='mean'):
+		"""
+		the field downsampled by 2**level along each axis, for previews. Each point of a level is
+		the mean (or the max, for mode='max') of a 2 x 2 x 2 block of the level below. The cell is
+		periodic, so an odd number of points along an axis is padded with the first plane. Levels
+		are kept once made, level 0 is the field itself.
+		"""
+		if level <= 0:
+			return self.field
+		if mode not in ('mean', 'max'):
+			raise ValueError('unknown downsampling mode {}, expected mean or max'.format(mode))
+		key = (level, mode)
+		if key not in self.pyramid:
+			self.pyramid[key] = _downsample(self.get_level(level - 1, mode), mode)
+		return self.pyramid[key]
+
+	def build_pyramid(self, levels, mode='mean'):
+		# every level of the pyramid up to and including levels, finest first
+		return [self.get_level(level, mode) for level in range(levels + 1)]
+
+	def level_transform(self, level):
+		# cell covered by the points of a level, which is larger than the cell along axes that
+		# were padded
+		scale = np.ones((4,))
+		scale[0:3] = self.level_shape(level) * 2 ** level / self.gridsize
+		return self.transform * scale[:, np.newaxis]
+
+	def level_offset(self, level):
+		# shift of the centre of the cell covered by a level, in grid points
+		return (self.level_shape(level) * 2 ** level - self.gridsize) / 2.0
+
+	def get_centre(self):
+		# grid coordinates drawn at the origin, the centre of the cell unless the field is a region
+		# of a larger one (see Cube.load_region), which is then drawn where it sits in that cell
+		if self.region is None:
+			return self.gridsize / 2.0
+		return np.array(self.region['gridsize']) / 2.0 - np.array(self.region['start'])
+
+	def gradient_transform(self, level=0):
+		# matrix taking differences along the grid axes (per grid point) to the real space gradient,
+		# since the difference along axis k is a_k . gradient for the grid step vectors a_k
+		steps = self.meshtransform[0:3, 0:3] * 2 ** level
+		return np.linalg.inv(steps).T
 
 	def load_file(self, file):
 		self.cubefile = file
 
+	def set_bodyoffset(self, offset):
+		self.bodyoffset = offset
+
 	def set_translation(self, translate):
 		self.transform[3, 0:3] = translate
 
@@ -62,3 +310,78 @@ class ScalarField():
 				if x >= self.gridsize[0]:
 					return -1, -1, -1
 		return x, y, z
+
+
+def level_to_grid(points, level):
+	# grid coordinates of points given in the grid of a level, each point of a level sits at the
+	# centre of the block it was made from
+	factor = 2 ** level
+	return points * factor + 0.5 * (factor - 1)
+
+
+def slab_gradient(block, transform):
+	"""
+	real space gradient of the inner x planes of a block, by central differences. The first and
+	last planes of the block are only used as neighbours, differences along y and z are periodic.
+	transform is the gradient_transform of the field, the result has shape (n - 2, ny, nz, 3).
+	"""
+	inner = block[1:-1]
+	diff = np.empty(inner.shape + (3,), dtype=np.promote_types(block.dtype, np.float32))
+	np.subtract(block[2:], block[:-2], out=diff[..., 0])
+	for axis in (1, 2):
+		np.subtract(np.roll(inner, -1, axis=axis), np.roll(inner, 1, axis=axis), out=diff[..., axis])
+	diff *= 0.5
+	return np.matmul(diff, transform.astype(diff.dtype))
+
+
+def gradient_at(field, points, transform):
+	"""
+	real space gradient of a field at points given in grid coordinates, interpolated trilinearly
+	between the central differences at the surrounding grid points. The field is periodic, only
+	the grid points around the given points are read.
+	"""
+	points = np.asarray(points, dtype=float)
+	shape = np.array(field.shape)
+	base = np.floor(points).astype(np.int64)
+	frac = points - base
+	gradient = np.zeros(points.shape)
+	diff = np.empty(points.shape)
+	for corner in np.ndindex(2, 2, 2):
+		weight = np.prod(np.where(corner, frac, 1.0 - frac), axis=1)
+		for axis in range(3):
+			upper = base + corner
+			lower = base + corner
+			upper[:, axis] += 1
+			lower[:, axis] -= 1
+			diff[:, axis] = field[tuple((upper % shape).T)] - field[tuple((lower % shape).T)]
+		gradient += weight[:, np.newaxis] * diff
+	return 0.5 * gradient.dot(transform)
+
+
+def _downsample(array, mode):
+	# halve a field along every axis, wrapping around the cell where an axis has an odd length
+	pad = [(0, n % 2) for n in array.shape]
+	if any(after for _, after in pad):
+		array = np.pad(array, pad, mode='wrap')
+	n_x, n_y, n_z = (n // 2 for n in array.shape)
+	blocks = array.reshape((n_x, 2, n_y, 2, n_z, 2))
+	if mode == 'max':
+		return blocks.max(axis=(1, 3, 5))
+	work = np.promote_types(array.dtype, np.float32)
+	return blocks.mean(axis=(1, 3, 5), dtype=work).astype(array.dtype, copy=False)
+
+
+def _block_reduce(array, size, ufunc):
+	# reduce blocks of size x size x size elements, the last block along an axis may be smaller
+	for axis in range(3):
+		array = ufunc.reduceat(array, np.arange(0, array.shape[axis], size), axis=axis)
+	return array
+
+
+def _shift_down(array, axis):
+	# each element replaced by its successor along an axis, the last element is kept
+	index = [slice(None)] * 3
+	index[axis] = slice(1, None)
+	last = [slice(None)] * 3
+	last[axis] = slice(-1, None)
+	return np.concatenate((array[tuple(index)], array[tuple(last)]), axis=axis)
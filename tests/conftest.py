@@ -0,0 +1,5 @@
+"""the modules of the repo are imported from its top folder, as the scripts do"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
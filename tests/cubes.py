@@ -0,0 +1,32 @@
+"""small synthetic cube files for the tests"""
+import numpy as np
+
+HEADER = ''' synthetic cube file
+ for the tests
+{:5d}    0.100000    0.200000    0.300000
+{:5d}    0.200000    0.000000    0.000000
+{:5d}    0.050000    0.210000    0.000000
+{:5d}    0.000000    0.000000    0.190000
+'''
+
+
+def write_cube(path, shape, perline=6, continuous=False, nan_fraction=0.0, truncate=0, seed=0,
+               species=(6, 1)):
+    """writes a cube file of random values, z rows wrapped at perline values per line (or values
+    running on from row to row), with NaN tokens and the last lines cut off if asked for. The atoms
+    of the given species sit along the diagonal of the cell.
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=shape) * 10.0 ** rng.integers(-4, 4, size=shape)
+    tokens = np.array(['{:13.5E}'.format(value) for value in values.ravel()], dtype=object)
+    tokens[rng.random(tokens.size) < nan_fraction] = 'NaN'
+    rows = [tokens] if continuous else np.split(tokens, shape[0] * shape[1])
+    lines = [' '.join(row[i:i+perline]) for row in rows for i in range(0, len(row), perline)]
+    if truncate:
+        lines = lines[:-truncate]
+    with open(path, 'w') as f_write:
+        f_write.write(HEADER.format(len(species), *shape))
+        for idx, number in enumerate(species):
+            f_write.write('{:5d} {:11.6f} {:11.6f} {:11.6f} {:11.6f}\n'.format(
+                number, float(number), 1.0 + 0.5 * idx, 1.0 + 0.25 * idx, 1.0))
+        f_write.write('\n'.join(lines) + '\n')
@@ -0,0 +1 @@
+"""empty stand-in for blender's bmesh module, see bpy.py"""
@@ -0,0 +1,101 @@
+"""a lightweight stand-in for blender's bpy module, enough to run the drawing code outside of
+blender. It counts the datablocks that are created and the operators that are called, see COUNTS,
+and keeps what is created in the data collections for inspection."""
+import collections
+import types
+
+import numpy as np
+
+COUNTS = collections.Counter()
+
+
+class Sequence():
+    # vertices, loops and polygons of a mesh, filled in bulk
+    def __init__(self):
+        self.count = 0
+        self.data = {}
+
+    def add(self, count):
+        self.count += count
+
+    def foreach_set(self, attr, values):
+        self.data[attr] = np.array(values)
+
+
+class Mesh():
+    def __init__(self, name):
+        self.name = name
+        self.vertices = Sequence()
+        self.loops = Sequence()
+        self.polygons = Sequence()
+        self.materials = []
+
+    def update(self, calc_edges=False):
+        pass
+
+    def validate(self):
+        pass
+
+
+class Material():
+    def __init__(self, name):
+        self.name = name
+
+
+class Object():
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.location = None
+        self.scale = None
+
+
+class Collection():
+    # bpy.data.meshes and the like, new counts the datablock
+    def __init__(self, kind, cls):
+        self.kind = kind
+        self.cls = cls
+        self.items = []
+
+    def new(self, name, *args):
+        COUNTS[self.kind] += 1
+        item = self.cls(name, *args)
+        self.items.append(item)
+        return item
+
+    def remove(self, item):
+        COUNTS['removed ' + self.kind] += 1
+        self.items.remove(item)
+
+
+class Objects():
+    def link(self, obj):
+        COUNTS['linked'] += 1
+
+
+class Operators():
+    # any bpy.ops call is counted and does nothing
+    def __getattr__(self, name):
+        return Operators()
+
+    def __call__(self, *args, **kwargs):
+        COUNTS['ops'] += 1
+
+
+data = types.SimpleNamespace()
+context = types.SimpleNamespace()
+ops = Operators()
+app = types.SimpleNamespace(handlers=types.SimpleNamespace(frame_change_pre=[]))
+
+
+def reset():
+    """forgets every datablock and count"""
+    COUNTS.clear()
+    data.meshes = Collection('meshes', Mesh)
+    data.materials = Collection('materials', Material)
+    data.objects = Collection('objects', Object)
+    context.collection = types.SimpleNamespace(objects=Objects())
+    context.scene = types.SimpleNamespace(objects=Objects(), frame_current=1)
+
+
+reset()
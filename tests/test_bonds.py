@@ -0,0 +1,86 @@
+"""cell list bond detection against the original loop over every pair of atoms"""
+import numpy as np
+import pytest
+
+import molecule as mol
+
+# the bond lengths the original loop had built in
+BOND_DICT = {
+    6: {1: (106, 112), 6: (120, 154), 7: (116, 210), 8: (113, 215)},
+    7: {1: (90, 110), 7: (120, 155)},
+    8: {1: (90, 100), 6: (120, 154)},
+}
+
+
+def reference_bonds(positions, species, cell=None):
+    """the original create_bonds loop, with nearest images if a cell is given"""
+    bonds = []
+    for i, ival in enumerate(species):
+        for j, jval in enumerate(species):
+            if j <= i:
+                continue
+            min_length = 0
+            max_length = 0
+            if ival in BOND_DICT:
+                if jval in BOND_DICT[ival]:
+                    min_length, max_length = BOND_DICT[ival][jval]
+            elif jval in BOND_DICT:
+                if ival in BOND_DICT[jval]:
+                    min_length, max_length = BOND_DICT[jval][ival]
+            delta = positions[i] - positions[j]
+            if cell is not None:
+                frac = delta.dot(np.linalg.inv(cell))
+                delta = (frac - np.round(frac)).dot(cell)
+            distance = np.sqrt(np.sum(delta ** 2)) * mol.BOHR_TO_PM
+            if distance > min_length and distance < max_length:
+                bonds.append((i, j))
+    return bonds
+
+
+def random_atoms(count, size, seed):
+    rng = np.random.default_rng(seed)
+    return rng.random((count, 3)) * size, rng.choice([1, 6, 7, 8, 16], count)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_create_bonds_matches_original_loop(seed):
+    positions, species = random_atoms(120, 12.0, seed)
+    molecule = mol.Molecule()
+    molecule.load_empty(len(species))
+    molecule.a_species[:] = species
+    molecule.m_positions[:] = positions
+    molecule.create_bonds()
+    expected = reference_bonds(positions, species)
+    assert len(expected) > 20
+    assert molecule.bondlist == expected
+
+
+def test_asymmetric_pairs():
+    # 150 pm is a C-N bond, but N has lengths of its own, so a later C is never looked up
+    length = 150.0 / mol.BOHR_TO_PM
+    positions = np.array([[0.0, 0.0, 0.0], [length, 0.0, 0.0]])
+    table = mol.bond_table()
+    assert mol.find_bonds(positions, [6, 7], table).tolist() == [[0, 1]]
+    assert mol.find_bonds(positions, [7, 6], table).tolist() == []
+    assert reference_bonds(positions, [7, 6]) == []
+
+
+@pytest.mark.parametrize('cell', [np.diag([11.0, 12.0, 13.0]),
+                                  np.array([[12.0, 0.0, 0.0], [3.0, 11.0, 0.0],
+                                            [0.0, 2.0, 12.0]])])
+def test_periodic_bonds(cell):
+    positions, species = random_atoms(150, 1.0, 7)
+    positions = positions.dot(cell)
+    bonds = mol.find_bonds(positions, species, mol.bond_table(), cell)
+    expected = reference_bonds(positions, species, cell)
+    assert bonds.tolist() == [list(bond) for bond in expected]
+    # some bonds only exist across the cell boundary
+    assert len(expected) > len(reference_bonds(positions, species))
+
+
+def test_bond_across_boundary():
+    cell = np.eye(3) * 10.0
+    length = 140.0 / mol.BOHR_TO_PM
+    positions = np.array([[0.2, 5.0, 5.0], [10.2 - length, 5.0, 5.0]])
+    assert mol.find_bonds(positions, [6, 6], mol.bond_table()).tolist() == []
+    assert mol.find_bonds(positions, [6, 6], mol.bond_table(), cell).tolist() == [[0, 1]]
@@ -0,0 +1,89 @@
+"""the SQLite header catalog: inserting, incremental updates and queries"""
+import os
+
+import numpy as np
+import pytest
+
+import catalog
+import cube_reader as cr
+from cubes import write_cube
+
+FILES = {
+    'small_h2o': ((6, 5, 4), (8, 1, 1)),
+    'small_nh3': ((5, 6, 7), (7, 1, 1, 1)),
+    'large_ch4': ((12, 11, 10), (6, 1, 1, 1, 1)),
+    'large_cn': ((10, 12, 14), (6, 7)),
+}
+
+
+@pytest.fixture
+def collection(tmp_path):
+    folder = tmp_path / 'cubes'
+    folder.mkdir()
+    for name, (shape, species) in FILES.items():
+        write_cube(str(folder / (name + '.cube')), shape, species=species)
+    return folder, catalog.Catalog(str(tmp_path / 'catalog.sqlite'))
+
+
+def names(cubes):
+    return [cube.name for cube in cubes]
+
+
+def touch(path):
+    # a new modification time, whatever the resolution of the file system
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_insert_and_query(collection):
+    folder, index = collection
+    assert index.update([str(folder)]) == len(FILES)
+    assert names(index.query()) == sorted(FILES)
+    assert names(index.query(min_grid=10)) == ['large_ch4', 'large_cn']
+    assert names(index.query(max_grid=7)) == ['small_h2o', 'small_nh3']
+    assert names(index.query(species=[1])) == ['large_ch4', 'small_h2o', 'small_nh3']
+    assert names(index.query(species=[6, 7])) == ['large_cn']
+    assert names(index.query(min_atoms=4)) == ['large_ch4', 'small_nh3']
+    assert names(index.query(max_atoms=2)) == ['large_cn']
+    assert names(index.query(name='small_*', species=[8])) == ['small_h2o']
+
+
+def test_headers_are_restored(collection):
+    folder, index = collection
+    index.update([str(folder / '*.cube')])
+    for cube in index.query():
+        loaded = cr.Cube()
+        loaded.load_header(cube.file)
+        assert cube.get_header() == loaded.get_header()
+        np.testing.assert_array_equal(cube.molecule.m_positions, loaded.molecule.m_positions)
+        np.testing.assert_array_equal(cube.field.transform, loaded.field.transform)
+        # the body can be read from the restored header alone
+        cube.load_body()
+        loaded.load_body()
+        np.testing.assert_array_equal(cube.field.field, loaded.field.field)
+
+
+def test_update_only_reads_changed_files(collection):
+    folder, index = collection
+    index.update([str(folder)])
+    assert index.update([str(folder)]) == 0
+
+    path = str(folder / 'small_h2o.cube')
+    write_cube(path, (9, 9, 9), species=(8, 1, 1))
+    touch(path)
+    os.remove(str(folder / 'large_cn.cube'))
+    assert index.update([str(folder)]) == 1
+    assert names(index.query()) == ['large_ch4', 'small_h2o', 'small_nh3']
+    assert names(index.query(min_grid=9)) == ['large_ch4', 'small_h2o']
+
+
+def test_query_rereads_files_changed_since_update(collection):
+    folder, index = collection
+    index.update([str(folder)])
+    path = str(folder / 'small_nh3.cube')
+    write_cube(path, (8, 8, 8), species=(7, 1, 1, 1))
+    touch(path)
+    cubes = index.query(name='small_nh3')
+    assert cubes[0].field.gridsize.tolist() == [8, 8, 8]
+    # and the catalog has been brought up to date
+    assert names(index.query(min_grid=8)) == ['large_ch4', 'large_cn', 'small_nh3']
@@ -0,0 +1,55 @@
+"""draw_molecule against a stand-in for bpy (tests/fakebpy) that counts created datablocks"""
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+import molecule as mol
+
+FAKEBPY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fakebpy')
+
+
+@pytest.fixture
+def bpy(monkeypatch):
+    monkeypatch.syspath_prepend(FAKEBPY)
+    for name in ('bpy', 'bmesh', 'utils_blender', 'utils_molecule'):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    import bpy
+    bpy.reset()
+    return bpy
+
+
+def make_molecule(atomcount, seed=0):
+    rng = np.random.default_rng(seed)
+    molecule = mol.Molecule()
+    molecule.load_empty(atomcount)
+    molecule.a_species[:] = np.resize([6, 1, 8, 7], atomcount)
+    molecule.m_positions[:] = rng.random((atomcount, 3)) * 20.0
+    # every species at an end of some bond
+    molecule.bondlist = [(i, i + 1) for i in range(0, atomcount - 1, 2)]
+    return molecule
+
+
+@pytest.mark.parametrize('atomcount', [8, 400])
+def test_datablocks_per_species(bpy, atomcount):
+    import utils_molecule as um
+    molecule = make_molecule(atomcount)
+    um.draw_molecule(types.SimpleNamespace(molecule=molecule), bonds=True)
+    species = len(np.unique(molecule.a_species))
+
+    assert bpy.COUNTS['ops'] == 0
+    assert bpy.COUNTS['materials'] == species
+    # one sphere mesh and one bond mesh per species, however many atoms there are
+    names = [mesh.name for mesh in bpy.data.meshes.items]
+    assert bpy.COUNTS['meshes'] == 2 * species
+    assert sum(name.startswith('Atom') for name in names) == species
+    assert sum(name.startswith('Bonds') for name in names) == species
+    # an object per atom sharing the mesh of its species, and one per bond mesh
+    assert bpy.COUNTS['objects'] == atomcount + species
+    assert bpy.COUNTS['linked'] == atomcount + species
+    for number in np.unique(molecule.a_species):
+        meshes = {id(obj.data) for obj, atom in zip(molecule.rendered, molecule.a_species)
+                  if atom == number}
+        assert len(meshes) == 1
@@ -0,0 +1,76 @@
+"""placement of the atom spheres and bond half cylinders, see geometry.py"""
+import numpy as np
+import pytest
+
+import geometry as geo
+
+Z = np.array([0.0, 0.0, 1.0])
+
+
+def unit(vectors):
+    vectors = np.asarray(vectors, dtype=float)
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+DIRECTIONS = unit(np.concatenate((
+    np.random.default_rng(0).normal(size=(200, 3)),
+    [[0, 0, 1], [0, 0, -1], [1, 0, 0], [0, 1, 0], [1e-9, 0, -1], [0, 1e-12, -1], [1e-9, 1e-9, 1]],
+)))
+
+
+def test_rotations_are_proper():
+    rotations = geo.rotations_to(DIRECTIONS)
+    products = np.matmul(rotations, np.transpose(rotations, (0, 2, 1)))
+    np.testing.assert_allclose(products, np.broadcast_to(np.eye(3), products.shape), atol=1e-12)
+    np.testing.assert_allclose(np.linalg.det(rotations), 1.0, atol=1e-12)
+
+
+def test_rotations_take_z_onto_direction():
+    rotations = geo.rotations_to(DIRECTIONS)
+    np.testing.assert_allclose(rotations.dot(Z), DIRECTIONS, atol=1e-12)
+
+
+@pytest.mark.parametrize('direction', [[0, 0, -1], [1e-9, 0, -1], [0, -1e-9, -1]])
+def test_antiparallel(direction):
+    rotation = geo.rotations_to(unit([direction]))[0]
+    assert np.all(np.isfinite(rotation))
+    np.testing.assert_allclose(rotation.dot(Z), unit(direction), atol=1e-9)
+    np.testing.assert_allclose(np.linalg.det(rotation), 1.0, atol=1e-12)
+
+
+def test_half_cylinders():
+    positions = np.array([[0.0, 0.0, 0.0], [1.0, 2.0, 2.0], [1.0, 2.0, -1.0], [4.0, 0.0, 0.0]])
+    species = np.array([6, 1, 8, 7])
+    bonds = [(0, 1), (1, 2), (0, 3)]
+    cylinders = geo.cylinder_instances(positions, bonds, species, bond_width=0.3)
+    start = positions[[a for a, _ in bonds]]
+    end = positions[[b for _, b in bonds]]
+    lengths = np.linalg.norm(end - start, axis=1)
+    count = len(bonds)
+
+    assert len(cylinders) == 2 * count
+    np.testing.assert_allclose(cylinders.locations[:count], (3 * start + end) / 4)
+    np.testing.assert_allclose(cylinders.locations[count:], (start + 3 * end) / 4)
+    # the primitive is 2 deep, so a half of length |A - B| / 2 is scaled by |A - B| / 4
+    np.testing.assert_allclose(cylinders.scales[:, 2], np.tile(lengths / 4, 2))
+    np.testing.assert_allclose(cylinders.scales[:, 0:2], 0.3)
+    assert cylinders.species.tolist() == [6, 1, 6, 1, 8, 7]
+
+    # the ends of the placed primitive are the atom and the middle of the bond
+    matrices = cylinders.matrices()
+    tops = np.einsum('nij,j->ni', matrices, [0.0, 0.0, 1.0, 1.0])[:, 0:3]
+    bottoms = np.einsum('nij,j->ni', matrices, [0.0, 0.0, -1.0, 1.0])[:, 0:3]
+    middle = (start + end) / 2
+    np.testing.assert_allclose(tops[:count], start, atol=1e-12)
+    np.testing.assert_allclose(bottoms[:count], middle, atol=1e-12)
+    np.testing.assert_allclose(bottoms[count:], end, atol=1e-12)
+    np.testing.assert_allclose(tops[count:], middle, atol=1e-12)
+
+
+def test_spheres():
+    positions = np.array([[1.0, 2.0, 3.0], [0.0, 0.0, 0.0]])
+    radii = geo.species_table({'1': 0.5, 6: 1.5})
+    spheres = geo.sphere_instances(positions, [6, 1], radii, atom_scale=0.5)
+    np.testing.assert_allclose(spheres.locations, positions)
+    np.testing.assert_allclose(spheres.scales, [[0.75] * 3, [0.25] * 3])
+    np.testing.assert_allclose(spheres.rotations, np.broadcast_to(np.eye(3), (2, 3, 3)))
@@ -0,0 +1,50 @@
+"""load_body against the original parser, which split every line with a regex and stored the
+values one at a time, on small synthetic cube files"""
+import numpy as np
+import pytest
+import regex as re
+
+import cube_reader as cr
+from cubes import write_cube
+
+
+def reference_body(cube):
+    """the field as the original load_body parsed it"""
+    field = np.zeros(cube.field.gridsize)
+    f_x, f_y, f_z = 0, 0, 0
+    with open(cube.file, 'r') as f_read:
+        for idx, line in enumerate(f_read):
+            if idx < 6 + cube.molecule.atomcount:
+                continue
+            for element in re.split(r'\s+', line.strip()):
+                if element is None or element == '':
+                    continue
+                elif element == 'NaN':
+                    field[f_x, f_y, f_z] = 0.0
+                else:
+                    field[f_x, f_y, f_z] = element
+                f_x, f_y, f_z = cube.field.increment_idx(f_x, f_y, f_z)
+                if f_x < 0:
+                    break
+    return field
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+@pytest.mark.parametrize('shape, options', [
+    ((4, 5, 6), {}),
+    # short trailing line on every z row
+    ((5, 4, 13), {}),
+    ((3, 7, 8), {'perline': 5}),
+    ((4, 3, 10), {'continuous': True}),
+    ((6, 5, 9), {'nan_fraction': 0.2}),
+    ((5, 6, 11), {'nan_fraction': 0.05, 'truncate': 7}),
+    ((4, 4, 12), {'continuous': True, 'truncate': 3}),
+])
+def test_load_body_matches_original_parser(tmp_path, shape, options, workers):
+    path = str(tmp_path / 'field.cube')
+    write_cube(path, shape, **options)
+    cube = cr.Cube()
+    cube.load_header(path)
+    cube.load_body(workers=workers)
+    assert cube.field.field.shape == shape
+    np.testing.assert_array_equal(cube.field.field, reference_body(cube))
@@ -0,0 +1,28 @@
+"""isosurfaces of fields stored in reduced precision against the double precision result"""
+import numpy as np
+import pytest
+
+import benchmark
+import cube_reader as cr
+
+
+def isomesh(path, dtype):
+    cube = cr.Cube(dtype)
+    cube.load_header(path)
+    cube.load_body()
+    assert cube.field.field.dtype == np.dtype(dtype)
+    vertices, triangles, _ = cube.isomesh(0.3, absolute=True)
+    return vertices, triangles
+
+
+# largest vertex error allowed, in grid points
+@pytest.mark.parametrize('dtype, tolerance', [(np.float32, 1e-5), (np.float16, 0.05)])
+def test_isosurface_vertices(tmp_path, dtype, tolerance):
+    path = str(tmp_path / 'blobs.cube')
+    benchmark.write_cube(path, (30, 28, 26), atoms=6)
+    reference, reftriangles = isomesh(path, np.float64)
+    vertices, triangles = isomesh(path, dtype)
+    assert len(reftriangles) > 0
+    # the surface is smooth enough for the rounding to never change which cells it crosses
+    np.testing.assert_array_equal(triangles, reftriangles)
+    assert np.max(np.abs(vertices - reference)) <= tolerance
@@ -0,0 +1,129 @@
+"""periodic recentring of the field, and of the atoms and regions along with it"""
+import numpy as np
+import pytest
+
+import cube_reader as cr
+import scalar_field as sf
+from cubes import write_cube
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / 'field.cube')
+    write_cube(path, (10, 9, 8))
+    return path
+
+
+def drawn(field, index):
+    # grid coordinates a point of a field is drawn at, see ScalarField.get_centre
+    return np.asarray(index) - field.get_centre()
+
+
+@pytest.mark.parametrize('roll', [False, True, (3, -2, 5)])
+def test_region_lines_up_with_rolled_field(path, roll):
+    cube = cr.Cube()
+    cube.load_header(path)
+    cube.field_settings(roll=roll)
+    cube.load_body()
+    xrange, yrange, zrange = (2, 7), (-3, 4), (5, 11)
+    region = cube.load_region(xrange, yrange, zrange)
+    for corner in [(0, 0, 0), (4, 6, 5), (1, 3, 2)]:
+        # the same point of the file in the shifted full field
+        index = ((np.array([xrange[0], yrange[0], zrange[0]]) + corner + cube.field.shift)
+                 % cube.field.gridsize)
+        assert region.field[corner] == cube.field.field[tuple(index)]
+        if np.all(cube.field.shift == 0):
+            continue
+        # the box is drawn in one piece, so points past the edge of the cell are drawn at the
+        # periodic image of where they are in the full field
+        offset = drawn(region, corner) - drawn(cube.field, index)
+        assert np.allclose(offset, np.round(offset / cube.field.gridsize) * cube.field.gridsize)
+        if corner == (0, 0, 0):
+            assert np.allclose(offset, 0.0)
+
+
+def test_field_settings_keeps_what_is_not_given(path):
+    cube = cr.Cube()
+    cube.load_header(path)
+    cube.field_settings(cache=True, stream=True, workers=4, dtype=np.float32)
+    cube.centre_on_atom(0)
+    shift = cube.field.shift.copy()
+    cube.field_settings(roll=None)
+    cube.field_settings(workers=2)
+    assert cube.settings.cache and cube.settings.stream
+    assert cube.settings.workers == 2
+    assert cube.field.dtype == np.float32
+    assert np.array_equal(cube.field.shift, shift)
+
+
+@pytest.fixture
+def cachedir(tmp_path, monkeypatch):
+    # keep the field cache and artifacts out of the dat folder
+    import field_cache as fc
+    monkeypatch.setattr(fc, 'default_dir', lambda: str(tmp_path / 'dat'))
+    return tmp_path / 'dat'
+
+
+@pytest.mark.parametrize('shape, shift', [
+    ((12, 10, 9), (8, 4, 6)),   # shares factors with every axis, several cycles of planes
+    ((12, 10, 9), (6, 5, 3)),
+    ((7, 5, 4), (3, 0, 0)),     # coprime, a single cycle
+    ((8, 8, 8), (0, 3, 5)),     # in plane only
+    ((9, 6, 5), (-2, -7, 11)),
+    ((6, 4, 3), (0, 0, 0)),
+])
+def test_roll_in_place(shape, shift):
+    field = sf.ScalarField()
+    field.gridsize = np.array(shape)
+    values = np.random.default_rng(0).random(shape)
+    field.set_field(values.copy())
+    buffer = field.field
+    field.roll(shift)
+    assert field.field is buffer
+    np.testing.assert_array_equal(field.field, np.roll(values, shift, axis=(0, 1, 2)))
+    assert field.shift.tolist() == (np.array(shift) % shape).tolist()
+
+
+def test_roll_read_only_memmap(tmp_path):
+    values = np.random.default_rng(1).random((6, 4, 5))
+    np.save(str(tmp_path / 'field.npy'), values)
+    field = sf.ScalarField()
+    field.gridsize = np.array(values.shape)
+    field.set_field(np.load(str(tmp_path / 'field.npy'), mmap_mode='r'))
+    field.roll((4, 2, 0))
+    np.testing.assert_array_equal(field.field, np.roll(values, (4, 2, 0), axis=(0, 1, 2)))
+    # the file is never written to
+    np.testing.assert_array_equal(np.load(str(tmp_path / 'field.npy')), values)
+
+
+@pytest.mark.parametrize('options', [{}, {'stream': True}, {'cache': True}, {'workers': 3}])
+def test_load_rolled(path, cachedir, options):
+    reference = cr.Cube()
+    reference.load_header(path)
+    reference.load_body()
+    expected = np.roll(reference.field.field, (5, 4, 4), axis=(0, 1, 2))
+    for _ in range(2):
+        # the second time round the field cache is used, if enabled
+        cube = cr.Cube()
+        cube.load_header(path)
+        cube.field_settings(roll=True, **options)
+        if options.get('stream'):
+            slabs = sorted(cube.iter_slabs(size=3), key=lambda slab: slab[0])
+            field = np.concatenate([slab for _, slab in slabs])
+        else:
+            cube.load_body()
+            field = cube.field.field
+        np.testing.assert_array_equal(field, expected)
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_centre_on_atom(path, index):
+    # the cube has a nonzero origin, see tests/cubes.py
+    cube = cr.Cube()
+    cube.load_header(path)
+    cube.load_body()
+    cube.centre_on_atom(index)
+    steps = cube.field.meshtransform[0:3, 0:3]
+    offset = cube.field.transform.diagonal()[0:3] / 2.0 - cube.field.meshtransform[3, 0:3]
+    point = (cube.molecule.m_positions[index] + offset).dot(np.linalg.inv(steps))
+    assert np.all(np.abs(point - cube.field.gridsize / 2.0) <= 0.5)
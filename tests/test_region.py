@@ -0,0 +1,84 @@
+"""boxes of the field read through the slab index against slices of the full field"""
+import numpy as np
+import pytest
+
+import cube_reader as cr
+from cubes import write_cube
+
+LAYOUTS = {
+    'rows': {},
+    # every z row ends on a short line
+    'short rows': {'perline': 5},
+    # values run on from row to row, the last line of the body is short
+    'run on': {'continuous': True, 'perline': 7},
+    # the last line of the body is missing
+    'truncated': {'truncate': 1},
+    'run on truncated': {'continuous': True, 'truncate': 2},
+}
+
+RANGES = [
+    ((0, 10), (0, 9), (0, 8)),
+    ((2, 5), (3, 4), (1, 7)),
+    # past either end of the cell, wrapping round
+    ((-3, 4), (6, 12), (-2, 9)),
+]
+
+
+def load(path, **settings):
+    cube = cr.Cube()
+    cube.load_header(path)
+    cube.field_settings(**settings)
+    return cube
+
+
+def box(field, ranges):
+    indices = [np.arange(lower, upper) % size for (lower, upper), size in zip(ranges, field.shape)]
+    return field[np.ix_(*indices)]
+
+
+@pytest.fixture(params=sorted(LAYOUTS))
+def path(request, tmp_path, monkeypatch):
+    # keep the slab index and field cache out of the dat folder
+    import field_cache as fc
+    monkeypatch.setattr(fc, 'default_dir', lambda: str(tmp_path / 'dat'))
+    path = str(tmp_path / 'field.cube')
+    write_cube(path, (10, 9, 8), nan_fraction=0.05, **LAYOUTS[request.param])
+    return path
+
+
+@pytest.mark.parametrize('ranges', RANGES)
+@pytest.mark.parametrize('source', ['file', 'loaded', 'cached'])
+def test_load_region(path, ranges, source):
+    full = load(path)
+    full.load_body()
+    cube = load(path, cache=source == 'cached')
+    if source == 'loaded':
+        cube.load_body()
+    elif source == 'cached':
+        # writes the field cache, then reads from it
+        load(path, cache=True).load_body()
+    for _ in range(2):
+        # the second time round from the slab index saved by the first
+        region = cube.load_region(*ranges)
+        np.testing.assert_array_equal(region.field, box(full.field.field, ranges))
+        assert region.gridsize.tolist() == [upper - lower for lower, upper in ranges]
+
+
+@pytest.mark.parametrize('padding', [0.1, 0.3, 5.0])
+def test_load_around_atoms(path, padding):
+    full = load(path)
+    full.load_body()
+    cube = load(path)
+    region = cube.load_around_atoms([0, 1], padding)
+    start = np.array(region.region['start'])
+    ranges = list(zip(start, start + region.gridsize))
+    np.testing.assert_array_equal(region.field, box(full.field.field, ranges))
+
+    # the atoms are inside the box, at least padding from its faces unless it is the whole cell
+    steps = full.field.meshtransform[0:3, 0:3]
+    offset = full.field.transform.diagonal()[0:3] / 2.0 - full.field.meshtransform[3, 0:3]
+    points = (full.molecule.m_positions[0:2] + offset).dot(np.linalg.inv(steps))
+    pad = padding / np.linalg.norm(steps, axis=1)
+    whole = region.gridsize >= full.field.gridsize
+    inside = (points >= start + pad - 1e-9) & (points <= start + region.gridsize - 1 - pad + 1e-9)
+    assert np.all(inside | whole)
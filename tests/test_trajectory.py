@@ -0,0 +1,68 @@
+"""bonds of a trajectory from the Verlet neighbour list against find_bonds on every frame"""
+import numpy as np
+import pytest
+
+import molecule as mol
+import trajectory
+from cubes import write_cube
+
+
+def random_walk(frames=40, atoms=200, step=0.15, seed=0):
+    # atoms at about the density of liquid water, moving a little each frame
+    rng = np.random.default_rng(seed)
+    size = (atoms / 0.015) ** (1.0 / 3.0)
+    positions = np.empty((frames, atoms, 3))
+    positions[0] = rng.random((atoms, 3)) * size
+    for frame in range(1, frames):
+        positions[frame] = positions[frame - 1] + rng.normal(scale=step, size=(atoms, 3))
+    return rng.choice([1, 1, 6, 7, 8], atoms), positions, np.eye(3) * size
+
+
+def expected_bonds(traj, frame):
+    return mol.find_bonds(traj.frame(frame), traj.species, traj.table, traj.cell)
+
+
+@pytest.mark.parametrize('periodic', [False, True])
+def test_bonds_match_find_bonds(periodic):
+    species, positions, cell = random_walk()
+    traj = trajectory.Trajectory(species, positions, cell if periodic else None)
+    total = 0
+    for frame in range(traj.frames):
+        bonds = traj.bonds(frame)
+        np.testing.assert_array_equal(bonds, expected_bonds(traj, frame))
+        total += len(bonds)
+    assert total > 0
+    # the list is reused for several frames, but does get rebuilt
+    assert 1 < traj.rebuilds < traj.frames
+
+
+def test_frames_in_any_order():
+    species, positions, cell = random_walk(seed=1)
+    traj = trajectory.Trajectory(species, positions, cell, skin=0.8)
+    order = np.random.default_rng(2).permutation(traj.frames)
+    for frame in np.concatenate((order, order[::-1])):
+        np.testing.assert_array_equal(traj.bonds(frame), expected_bonds(traj, frame))
+
+
+def test_save_and_load(tmp_path):
+    species, positions, cell = random_walk(frames=5, seed=3)
+    trajectory.Trajectory(species, positions, cell).save(str(tmp_path))
+    loaded = trajectory.load(str(tmp_path))
+    assert isinstance(loaded.positions, np.memmap)
+    np.testing.assert_array_equal(loaded.positions, positions)
+    np.testing.assert_array_equal(loaded.cell, cell)
+    for frame in range(loaded.frames):
+        np.testing.assert_array_equal(loaded.bonds(frame), expected_bonds(loaded, frame))
+
+
+def test_from_cubes(tmp_path):
+    paths = []
+    for frame in range(3):
+        paths.append(str(tmp_path / 'frame{}.cube'.format(frame)))
+        write_cube(paths[-1], (4, 4, 4), species=(6, 1, 8))
+    traj = trajectory.from_cubes(paths, str(tmp_path / 'traj'))
+    assert traj.frames == 3
+    assert traj.species.tolist() == [6, 1, 8]
+    write_cube(paths[1], (4, 4, 4), species=(6, 1, 7))
+    with pytest.raises(ValueError):
+        trajectory.from_cubes(paths)
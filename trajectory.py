@@ -0,0 +1,180 @@
+"""TRAJECTORY MODULE
+
+Atom positions of a molecule over the frames of a trajectory (e.g. a time series of cube files), as
+one (frames, atoms, 3) array. Long trajectories are kept in a directory and memory mapped, so only
+the frames in use are read.
+
+Bonds are found frame by frame from a Verlet neighbour list: the pairs within the longest bond
+plus a skin distance. Only those pairs are checked for each frame, and the list is only rebuilt
+once an atom has moved more than half the skin since it was built, as until then no other pair can
+have come within bonding distance.
+
+    traj = trajectory.from_cubes(batch.find_cubes(['run/*.cube']), 'dat/run')
+    for frame in range(traj.frames):
+        bonds = traj.bonds(frame)
+
+Author: Matthew Truscott
+"""
+import os
+import time
+
+import numpy as np
+
+import cube_reader as cr
+import geometry as geo
+import molecule as mol
+
+# distance in bohr added to the longest bond for the neighbour list
+DEFAULT_SKIN = 1.0
+
+
+class Trajectory():
+    """positions of the atoms of a molecule over a series of frames
+
+    Attributes:
+        species {np array} -- atomic numbers
+        positions {np array} -- (frames, atoms, 3) positions in bohr, possibly memory mapped
+        cell {np array} -- cell vectors as rows, bonds are periodic if set
+    """
+    def __init__(self, species, positions, cell=None, bond_lengths=None, skin=DEFAULT_SKIN):
+        self.species = np.asarray(species, dtype=int)
+        self.positions = positions
+        self.cell = None if cell is None else np.asarray(cell, dtype=float)[0:3, 0:3]
+        self.table = mol.bond_table(mol.BOND_LENGTHS if bond_lengths is None else bond_lengths)
+        self.skin = skin
+        # the neighbour list and the positions it was built from
+        self.neighbours = None
+        self.reference = None
+        self.rebuilds = 0
+
+    @property
+    def frames(self):
+        return len(self.positions)
+
+    @property
+    def atomcount(self):
+        return len(self.species)
+
+    def frame(self, frame):
+        """positions of a frame, read into memory
+        """
+        return np.asarray(self.positions[frame], dtype=float)
+
+    def displacement(self, positions):
+        """largest distance an atom has moved since the neighbour list was built, nearest image
+        if periodic
+        """
+        delta = positions - self.reference
+        if self.cell is not None:
+            delta = delta.dot(np.linalg.inv(self.cell))
+            delta -= np.round(delta)
+            delta = delta.dot(self.cell)
+        return np.sqrt(np.max(np.sum(delta * delta, axis=1)))
+
+    def bonds(self, frame):
+        """bonds of a frame, see molecule.find_bonds. Frames can be asked for in any order, the
+        neighbour list is rebuilt whenever the atoms have moved too far from where it was built.
+
+        Arguments:
+            frame {int} -- index of the frame
+
+        Returns:
+            np array -- (bondcount, 2) atom indices i < j, sorted
+        """
+        positions = self.frame(frame)
+        if self.reference is None or self.displacement(positions) > self.skin / 2.0:
+            self.neighbours, _ = mol.neighbour_pairs(
+                positions, mol.max_bond_length(self.table) + self.skin, self.cell)
+            self.reference = positions
+            self.rebuilds += 1
+        distances = mol.pair_distances(positions, self.neighbours, self.cell)
+        return self.neighbours[mol.bonded(self.species, self.neighbours, distances, self.table)]
+
+    def molecule(self, frame):
+        """a Molecule of a single frame, with its bonds
+        """
+        molecule = mol.Molecule()
+        molecule.load_empty(self.atomcount)
+        molecule.a_species[:] = self.species
+        molecule.m_positions[:] = self.frame(frame)
+        molecule.bondlist = [(int(i), int(j)) for i, j in self.bonds(frame)]
+        return molecule
+
+    def cylinders(self, frame, bond_width=0.24):
+        """placement of the half cylinders of the bonds of a frame, see geometry.cylinder_instances
+        """
+        return geo.cylinder_instances(self.frame(frame), self.bonds(frame), self.species,
+                                      bond_width)
+
+    def save(self, directory):
+        """saves the trajectory to a directory, see load
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'species.npy'), self.species)
+        if self.cell is not None:
+            np.save(os.path.join(directory, 'cell.npy'), self.cell)
+        path = os.path.join(directory, 'positions.npy')
+        if getattr(self.positions, 'filename', None) != os.path.abspath(path):
+            np.save(path, self.positions)
+
+
+def load(directory, **kwargs):
+    """a trajectory saved in a directory, the positions are memory mapped
+
+    Arguments:
+        directory {string} -- directory written by Trajectory.save or from_cubes
+        kwargs -- passed on to Trajectory, e.g. skin
+
+    Returns:
+        Trajectory -- the trajectory
+    """
+    species = np.load(os.path.join(directory, 'species.npy'))
+    positions = np.load(os.path.join(directory, 'positions.npy'), mmap_mode='r')
+    cellpath = os.path.join(directory, 'cell.npy')
+    cell = np.load(cellpath) if os.path.isfile(cellpath) else None
+    return Trajectory(species, positions, cell, **kwargs)
+
+
+def from_cubes(files, directory=None, periodic=False, **kwargs):
+    """a trajectory from the atoms of a series of cube files, one frame per file. Only the headers
+    are read.
+
+    Arguments:
+        files {list} -- paths of the cube files, in frame order
+
+    Keyword Arguments:
+        directory {string} -- write the positions frame by frame to a memory mapped file in this
+        directory, see load (default: {None, keep them in memory})
+        periodic {bool} -- find bonds across the cell boundaries, the cell is taken from the first
+        file (default: {False})
+        kwargs -- passed on to Trajectory, e.g. skin
+
+    Returns:
+        Trajectory -- the trajectory
+    """
+    start = time.time()
+    cube = cr.Cube()
+    cube.load_header(files[0])
+    species = cube.molecule.a_species.copy()
+    shape = (len(files), len(species), 3)
+    if directory is None:
+        positions = np.empty(shape)
+    else:
+        os.makedirs(directory, exist_ok=True)
+        positions = np.lib.format.open_memmap(os.path.join(directory, 'positions.npy'), 'w+',
+                                              float, shape)
+    cell = cube.field.transform[0:3, 0:3].copy() if periodic else None
+    for frame, path in enumerate(files):
+        if frame:
+            cube = cr.Cube()
+            cube.load_header(path)
+        if not np.array_equal(cube.molecule.a_species, species):
+            raise ValueError('{} does not have the atoms of {}'.format(path, files[0]))
+        positions[frame] = cube.molecule.m_positions
+    trajectory = Trajectory(species, positions, cell, **kwargs)
+    if directory is not None:
+        positions.flush()
+        trajectory.save(directory)
+    end = time.time()
+    print('trajectory of {} frames read, time elapsed = {}s'.format(len(files), end-start))
+    return trajectory
@@ -0,0 +1,144 @@
+"""TRANSFER MODULE
+
+Transfer functions that turn field values into emission voxel values. The field is clipped,
+normalized to the clipped range of the full field and flipped (so that low values emit), then
+handed to a modifier. Modifiers work in place on a chunk of the output, new ones are added with the
+register decorator:
+
+    @transfer.register('STEP')
+    def step(vox, max_emission=0.5, **options):
+        vox[...] = np.where(vox > 0.5, max_emission, 0.0)
+
+Modifiers registered with gradient=True are also given the gradient magnitude of the field,
+normalized to its largest value, see Cube.emission_slabs.
+
+Evaluation runs over fixed-size chunks of the field into a single output buffer, so the field is
+never modified and no full-size temporaries are made.
+
+Author: Matthew Truscott
+"""
+import numpy as np
+
+# about 1M values per chunk, small enough to stay in cache for the in place passes
+CHUNKSIZE = 1 << 20
+
+MODIFIERS = {}
+
+
+def register(name, gradient=False):
+    """decorator that adds a modifier under a name, modifiers are called as
+    modifier(vox, gradient=..., max_emission=..., tol=..., **options) and change vox in place
+
+    Arguments:
+        name {str} -- name of the modifier, case insensitive
+
+    Keyword Arguments:
+        gradient {bool} -- the modifier needs the gradient magnitude (default: {False})
+    """
+    def decorator(func):
+        func.uses_gradient = gradient
+        MODIFIERS[name.upper()] = func
+        return func
+    return decorator
+
+
+def get_modifier(name):
+    """the modifier registered under a name, or None if there is none
+    """
+    return MODIFIERS.get(name.upper())
+
+
+def uses_gradient(name):
+    """True if the modifier registered under a name needs the gradient magnitude
+    """
+    return getattr(get_modifier(name), 'uses_gradient', False)
+
+
+@register('SIGMOID')
+def sigmoid(vox, max_emission=0.5, tol=0.1, **options):
+    # steep sigmoid around the middle of the range, weak emission is cut off
+    vox -= 0.5
+    vox *= -8.0
+    np.exp(vox, out=vox)
+    vox += 1.0
+    np.reciprocal(vox, out=vox)
+    np.clip(vox, 0, max_emission, out=vox)
+    vox[vox < tol] = 0.0
+
+
+@register('CLIP')
+def clip(vox, max_emission=0.5, **options):
+    np.clip(vox, 0, max_emission, out=vox)
+
+
+@register('GRADIENT', gradient=True)
+def gradient_magnitude(vox, gradient=None, max_emission=0.5, **options):
+    # emission follows the gradient magnitude, max_emission where the field is steepest
+    np.multiply(gradient, max_emission, out=vox)
+
+
+@register('EDGE', gradient=True)
+def edge(vox, gradient=None, max_emission=0.5, tol=0.1, **options):
+    # edge emphasis, weak gradients are lifted by a square root and those below tol dropped
+    np.sqrt(gradient, out=vox)
+    vox *= max_emission
+    vox[gradient < tol] = 0.0
+
+
+@register('THRESHOLD')
+def threshold(vox, max_emission=0.5, tol=0.1, **options):
+    # constant emission wherever the flipped value reaches tol, nothing elsewhere
+    np.greater_equal(vox, tol, out=vox, casting='unsafe')
+    vox *= max_emission
+
+
+def evaluate(field, field_min, field_max, modifier='SIGMOID', out=None, truncA=-1e20, truncB=1e20,
+             gradient=None, chunksize=CHUNKSIZE, **options):
+    """emission values for part (or all) of a field, given the range of the full field
+
+    Arguments:
+        field {np array} -- field values, e.g. an x-slab, left untouched
+        field_min {float} -- minimum of the full field
+        field_max {float} -- maximum of the full field
+
+    Keyword Arguments:
+        modifier {str} -- name of a registered modifier, or None for the plain normalized values
+        (default: {'SIGMOID'})
+        out {np array} -- buffer of the same shape as field to write into, reused across slabs
+        (default: {None, a new array in the precision of the field, at least single})
+        truncA {float} -- field values are clipped to at least this, and normalized to the
+        clipped range (default: {-1e20})
+        truncB {float} -- field values are clipped to at most this (default: {1e20})
+        gradient {np array} -- normalized gradient magnitude of the same shape as field, for the
+        modifiers that use it (default: {None})
+        chunksize {int} -- number of values evaluated at a time (default: {CHUNKSIZE})
+        options -- passed on to the modifier, e.g. max_emission and tol
+
+    Returns:
+        np array -- the emission values, out if given
+    """
+    if out is None:
+        out = np.empty(field.shape, dtype=np.promote_types(field.dtype, np.float32))
+    func = None
+    if modifier is not None:
+        func = get_modifier(modifier)
+        if func is None:
+            # not recognized, just do nothing and hope for the best...
+            print('warning: modifier option not recognized')
+    # clip, then normalize to what is left of the range, so that clipping stretches the contrast
+    lower = max(field_min, truncA)
+    upper = min(field_max, truncB)
+    scale = 1.0 / (upper - lower) if upper > lower else 0.0
+    # chunks of whole planes (or rows), so that views of field never need copying
+    rows = max(1, chunksize // max(1, int(np.prod(field.shape[1:]))))
+    for idx in range(0, field.shape[0], rows):
+        vox = out[idx:idx+rows]
+        vox[...] = field[idx:idx+rows]
+        np.clip(vox, truncA, truncB, out=vox)
+        # normalize and flip
+        vox -= lower
+        vox *= -scale
+        vox += 1.0
+        if func is not None:
+            func(vox, gradient=None if gradient is None else gradient[idx:idx+rows], **options)
+    return out
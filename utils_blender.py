@@ -8,6 +8,7 @@ import os
 
 import bpy
 import bmesh
+import numpy as np
 from math import sin, cos, pi
 tau = 2.0 * pi
 
@@ -237,6 +238,48 @@ def save(filepath='untitled.blend'):
     bpy.ops.wm.save_as_mainfile(filepath=filepath, relative_remap=False)
 
 
+def linkObject(obj):
+    # link an object into the scene, collections only exist from blender 2.80
+    if hasattr(bpy.context, 'collection'):
+        bpy.context.collection.objects.link(obj)
+    else:
+        bpy.context.scene.objects.link(obj)
+
+
+def meshData(vertices, indices, sizes, name='Mesh'):
+    """builds mesh data (without an object) from a vertex array and polygons given as one flat
+    array of vertex indices with the number of vertices of each polygon, in bulk rather than one
+    element at a time
+    """
+    vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+    indices = np.ascontiguousarray(indices, dtype=np.int32)
+    sizes = np.ascontiguousarray(sizes, dtype=np.int32)
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set('co', vertices.ravel())
+    mesh.loops.add(len(indices))
+    mesh.loops.foreach_set('vertex_index', indices)
+    mesh.polygons.add(len(sizes))
+    mesh.polygons.foreach_set('loop_start', (np.cumsum(sizes) - sizes).astype(np.int32))
+    mesh.polygons.foreach_set('loop_total', sizes)
+    mesh.update(calc_edges=True)
+    mesh.validate()
+    return mesh
+
+
+def meshFromArrays(vertices, triangles, name='Object'):
+    """builds a mesh object straight from vertex and triangle arrays, in bulk rather than one
+    element at a time
+    """
+    triangles = np.asarray(triangles)
+    mesh = meshData(vertices, triangles.ravel(), np.full(len(triangles), 3), name+'Mesh')
+
+    obj = bpy.data.objects.new(name, mesh)
+    linkObject(obj)
+
+    return obj
+
+
 def bmeshToObject(bm, name='Object'):
     mesh = bpy.data.meshes.new(name+'Mesh')
     bm.to_mesh(mesh)
@@ -1,54 +1,79 @@
+import os
 import bpy
 import molecule
 import json
 import utils_blender as ub
+import geometry as geo
 import numpy as np
 
+# radii from ions.json, read once per session, see CPKData
+RADII = None
+
 class CPKData():
     def __init__(self):
+        global RADII
         self.colors = {
             1: (4, 4, 4, 1),
             6: (0.5, 0.5, 0.5, 1),
             7: (2, 2, 3.56, 1),
             8: (4, 0, 0, 1)
         }
+        self.default_color = (0.8, 0.4, 0.4, 1.0)
 
-        with open('ions.json', 'r') as f:
-            self.radii = json.load(f)
+        if RADII is None:
+            current_dir = os.path.dirname(os.path.realpath(__file__))
+            with open(os.path.join(current_dir, 'ions.json'), 'r') as f:
+                RADII = json.load(f)
+        self.radii = RADII
 
         self.atom_scale = 0.24
         self.bond_width = 0.24
 
+    def color(self, species):
+        return self.colors.get(species, self.default_color)
+
 def edit_atom_material(molecule, specular=0.0):
     # in the future, add routines to selectively add different materials to atoms
     for obj in molecule.rendered:
         main_material = obj.data.materials[0]
         main_material.specular_intensity = specular
 
-def draw_molecule(cube, bonds=False):
+def draw_molecule(cube, bonds=False, segments=64, ring_count=32, bond_segments=32):
+    """ FUNCTION draw_molecule(cube: Cube, bonds: bool, segments: int, ring_count: int,
+                               bond_segments: int)
+    Draws the atoms of the cube as spheres and, optionally, the bonds as two half cylinders each.
+    Each species gets one material and one sphere mesh, which all of its atoms share (an object
+    per atom, so that atoms can still be moved one by one). The bond halves of each species are
+    merged into a single mesh built in bulk. No operators are called, these scale badly with the
+    number of atoms.
+
+    RETURNS:
+    Molecule: the molecule of the cube, with the atom objects in rendered
+    """
+    # atoms were moved along with the field if it was rolled, see Cube.recentre
     molecule = cube.molecule
 
-    # fix positions if the field was rolled
-    if cube.settings.roll:
-        cube.molecule.transform(-1.0 * cube.field.transform)
-
     cpkdata = CPKData()
-    atoms = []
+    materials = {}
+    for species in np.unique(molecule.a_species):
+        materials[species] = ub.simpleMaterial(cpkdata.color(species))
+
+    spheres = geo.sphere_instances(molecule.m_positions, molecule.a_species,
+                                   geo.species_table(cpkdata.radii), cpkdata.atom_scale)
+    sphere = geo.uv_sphere(segments, ring_count)
+    atoms = [None] * len(spheres)
     # draw spheres
     print('drawing atoms...')
-    for i, p in enumerate(molecule.m_positions):
-        bpy.ops.mesh.primitive_uv_sphere_add(location=(p[0], p[1], p[2]), segments=64, ring_count=32)
-        if molecule.a_species[i] in cpkdata.colors:
-            atom_color = cpkdata.colors[molecule.a_species[i]]
-        else:
-            atom_color = (0.8, 0.4, 0.4, 1.0)
-        smat = ub.simpleMaterial(atom_color)
-        sobj = bpy.context.active_object
-        sobj.data.materials.append(smat)
-        # scale accordingly
-        uff = float(cpkdata.radii['{}'.format(molecule.a_species[i])]) * cpkdata.atom_scale
-        sobj.scale = (uff, uff, uff)
-        atoms.append(sobj)
+    for species, material in materials.items():
+        mesh = ub.meshData(*sphere, name='Atom{}Mesh'.format(species))
+        mesh.materials.append(material)
+        for idx in np.flatnonzero(spheres.species == species):
+            sobj = bpy.data.objects.new('Atom{}'.format(idx), mesh)
+            sobj.location = spheres.locations[idx]
+            # scale accordingly
+            sobj.scale = spheres.scales[idx]
+            ub.linkObject(sobj)
+            atoms[idx] = sobj
 
     molecule.add_rendered(atoms)
 
@@ -63,86 +88,71 @@ def draw_molecule(cube, bonds=False):
 
     # draw bonds, split each into two cylinders to match colors and stuff
     print('drawing bonds...')
-    for bond in molecule.bondlist:
-        # first find the midway point, the 'position' of the cylinder
-        pointA = molecule.m_positions[bond[0]]
-        pointB = molecule.m_positions[bond[1]]
-        pointM = (pointA + pointB) / 2.0
-        pointO = [0, 0, 0]
-        vecA = [0, 0, 0]
-
-        for i in range(3):
-            pointO[i] = (pointA[i] + pointM[i]) / 2.0
-            vecA[i] = (pointA[i] - pointM[i])
-
-        # next, get rotation matrix
-        vecA = np.array(vecA)
-        normA = np.linalg.norm(vecA)
-        vecA = vecA / normA
-        vecB = np.array([0, 0, 1])
-        vecC = np.cross(vecA, vecB)
-        dot = np.dot(vecA, vecB)
-        skew = np.array([[0, -vecC[2], vecC[1]],
-                         [vecC[2], 0, -vecC[0]],
-                         [-vecC[1], vecC[0], 0]])
-        rotator = np.identity(3) + skew + (np.matmul(skew, skew) * (1.0 / (1.0 + dot)))
-
-        # convert to 4-matrix
-        rot4 = np.zeros((4, 4), dtype=float)
-        rot4[0:3, 0:3] = rotator
-        rot4[3, 3] = 1
-
-        # now use this rotation matrix to rotate the bond
-        bpy.ops.mesh.primitive_cylinder_add(location=(pointO[0], pointO[1], pointO[2]))
-        sobj1 = bpy.context.active_object
-
-        # scale accordingly
-        scale4 = np.eye(4, dtype=float)
-        scale4[0, 0] = cpkdata.bond_width
-        scale4[1, 1] = cpkdata.bond_width
-        scale4[2, 2] = normA / 2
-
-        # apply these transformations
-        sobj1.data.transform(scale4)
-        sobj1.data.transform(rot4)
-        sobj1.data.update()
-
-        # color accordingly
-        atom1 = molecule.a_species[bond[0]]
-        color1 = cpkdata.colors[atom1]
-        smat1 = ub.simpleMaterial(color1)
-        sobj1.data.materials.append(smat1)
-
-        # second cylinder is exactly the same as above (will skip comments)
-        for i in range(3):
-            pointO[i] = (pointM[i] + pointB[i]) / 2.0
-            vecA[i] = (pointM[i] - pointB[i])
-        vecA = np.array(vecA)
-        normA = np.linalg.norm(vecA)
-        vecA = vecA / normA
-        vecB = np.array([0, 0, 1])
-        vecC = np.cross(vecA, vecB)
-        dot = np.dot(vecA, vecB)
-        skew = np.array([[0, -vecC[2], vecC[1]],
-                         [vecC[2], 0, -vecC[0]],
-                         [-vecC[1], vecC[0], 0]])
-        rotator = np.identity(3) + skew + (np.matmul(skew, skew) * (1.0 / (1.0 + dot)))
-        rot4 = np.zeros((4, 4), dtype=float)
-        rot4[0:3, 0:3] = rotator
-        rot4[3, 3] = 1
-        bpy.ops.mesh.primitive_cylinder_add(location=(pointO[0], pointO[1], pointO[2]))
-        sobj2 = bpy.context.active_object
-        scale4 = np.eye(4, dtype=float)
-        scale4[0, 0] = cpkdata.bond_width
-        scale4[1, 1] = cpkdata.bond_width
-        scale4[2, 2] = normA / 2
-        sobj2.data.transform(scale4)
-        sobj2.data.transform(rot4)
-        sobj2.data.update()
-        atom2 = molecule.a_species[bond[1]]
-        color2 = cpkdata.colors[atom2]
-        smat2 = ub.simpleMaterial(color2)
-        sobj2.data.materials.append(smat2)
+    cylinders = geo.cylinder_instances(molecule.m_positions, molecule.bondlist, molecule.a_species,
+                                       cpkdata.bond_width)
+    cylinder = geo.cylinder(bond_segments)
+    for species in np.unique(cylinders.species):
+        halves = cylinders.subset(cylinders.species == species)
+        mesh = ub.meshData(*geo.instance_polygons(*cylinder, halves),
+                           name='Bonds{}Mesh'.format(species))
+        mesh.materials.append(materials[species])
+        ub.linkObject(bpy.data.objects.new('Bonds{}'.format(species), mesh))
 
     return molecule
 
+def animate_molecule(molecule, trajectory, frame_start=1, frame_step=1, bonds=True,
+                     bond_segments=32):
+    """ FUNCTION animate_molecule(molecule: Molecule, trajectory: Trajectory, frame_start: int,
+                                  frame_step: int, bonds: bool, bond_segments: int)
+    Animates the atoms drawn by draw_molecule (without bonds) along a trajectory of the same
+    atoms. The atom objects are kept, their positions are keyframed in bulk, one keyframe per
+    frame of the trajectory. Bonds change from frame to frame, so they are drawn by a frame change
+    handler, which rebuilds the bond mesh of each species for the current frame.
+
+    RETURNS:
+    function: the frame change handler, remove it from bpy.app.handlers.frame_change_pre to stop
+    updating the bonds
+    """
+    print('keyframing atoms...')
+    frames = frame_start + frame_step * np.arange(trajectory.frames, dtype=np.float32)
+    keyframes = np.empty((trajectory.frames, 2), dtype=np.float32)
+    keyframes[:, 0] = frames
+    for idx, obj in enumerate(molecule.rendered):
+        obj.animation_data_create()
+        obj.animation_data.action = bpy.data.actions.new('{}Action'.format(obj.name))
+        path = trajectory.positions[:, idx, :]
+        for axis in range(3):
+            fcurve = obj.animation_data.action.fcurves.new('location', index=axis)
+            fcurve.keyframe_points.add(trajectory.frames)
+            keyframes[:, 1] = path[:, axis]
+            fcurve.keyframe_points.foreach_set('co', keyframes.ravel())
+            fcurve.update()
+
+    if not bonds:
+        return None
+
+    cpkdata = CPKData()
+    cylinder = geo.cylinder(bond_segments)
+    objects = {}
+    for species in np.unique(trajectory.species):
+        mesh = bpy.data.meshes.new('Bonds{}Mesh'.format(species))
+        mesh.materials.append(ub.simpleMaterial(cpkdata.color(species)))
+        objects[species] = bpy.data.objects.new('Bonds{}'.format(species), mesh)
+        ub.linkObject(objects[species])
+
+    def update_bonds(scene):
+        frame = int((scene.frame_current - frame_start) // frame_step)
+        frame = min(max(frame, 0), trajectory.frames - 1)
+        cylinders = trajectory.cylinders(frame, cpkdata.bond_width)
+        for species, obj in objects.items():
+            halves = cylinders.subset(cylinders.species == species)
+            mesh = ub.meshData(*geo.instance_polygons(*cylinder, halves),
+                               name='Bonds{}Mesh'.format(species))
+            old = obj.data
+            mesh.materials.append(old.materials[0])
+            obj.data = mesh
+            bpy.data.meshes.remove(old)
+
+    bpy.app.handlers.frame_change_pre.append(update_bonds)
+    update_bonds(bpy.context.scene)
+    return update_bonds
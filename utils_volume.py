@@ -1,49 +1,103 @@
 import sys
 import os
 import bpy
+import numpy as np
 import cube_reader as cr
+import mesh_io as mio
+import utils_blender as ub
 from math import pi
 
-def add_isosurface(cube, val, name="", update=False):
-    """ FUNCTION add_isosurface(cube: Cube, name: str, update: bool)
+def add_isosurface(cube, val, name="", update=False, fmt='dae', level=0, cache=True):
+    """ FUNCTION add_isosurface(cube: Cube, name: str, update: bool, fmt: str, level: int,
+                                cache: bool)
     Adds an isosurface object using the marching cubes external package (may want to implement this
     in the future for more freedom, but it works fine for now).
 
     INPUT:
     Cube: cube, the object that contains all the cell data
     float: val, a value between 0 and 1 that will determine the field. TODO absolute val option here too?
+    str: fmt, the mesh file format, 'dae' or the binary 'ply' or 'npz' (much faster for large
+        meshes)
+    int: level, extract from the field downsampled by 2**level along each axis, for quick previews
+    bool: cache, go through a mesh file in the artifact cache. Otherwise the mesh is handed to
+        blender straight from memory, with no file, import or operators involved
 
     RETURNS:
     blender object: the isosurface that represents the field data from the relevant cube file, taken
     at a particular value
     """
+    if not cache:
+        vertices, triangles, _ = cube.isomesh(val, level=level)
+        return isosurface_object(cube, vertices, triangles, name or 'Iso{}'.format(val))
+
     if not name:
-        name = cube.name + '.dae'
+        # unique for each value, so that several isosurfaces of one cube can be added
+        name = cube.isomesh_name(val, fmt=fmt, level=level)
     else:
-        name = name + '.dae'
-    # assume mesh file does not exist, so run external checker. If they indeed do exist, try
-    # loading the relevant cube file referenced by 'name' and create the files on the fly
-    cube.make_isomesh(val, name, update=update)
+        name = name + '.' + fmt
+    # the mesh is looked up in the artifact cache, and only made (loading the relevant cube file
+    # referenced by 'name') if it is missing or was made with other options
+    isodir = cube.make_isomesh(val, name, update=update, level=level)
 
-    # set directories
-    current_dir = os.path.dirname(os.path.realpath(__file__))
-    data_dir = os.path.join(current_dir, 'dat')
-    isodir = os.path.join(data_dir, name)
+    return import_isosurface(cube, isodir)
+
+def add_isosurfaces(cube, vals, name="", update=False, workers=None, fmt='dae', level=0,
+                    cache=True):
+    """ FUNCTION add_isosurfaces(cube: Cube, vals: list, name: str, update: bool, fmt: str,
+                                 level: int, cache: bool)
+    Adds one isosurface object per value. The meshes are made together (see Cube.make_isomeshes),
+    so the field range is only found once and the levels are extracted in parallel. Without the
+    cache they are made one after the other in memory instead (see add_isosurface).
+
+    RETURNS:
+    list: the isosurface objects, in the order of vals
+    """
+    if not cache:
+        return [add_isosurface(cube, val, name='{}{}'.format(name, val) if name else "",
+                               level=level, cache=False) for val in vals]
+    report = cube.make_isomeshes(vals, name=name, update=update, workers=workers, fmt=fmt,
+                                 level=level)
+    return [import_isosurface(cube, entry['path']) for entry in report]
+
+def import_isosurface(cube, isodir):
+    """ FUNCTION import_isosurface(cube: Cube, isodir: str)
+    Imports an isomesh file made from the cube and places it over the molecule
+    """
+    if mio.mesh_format(isodir) != 'dae':
+        # binary meshes are read straight into arrays
+        vertices, triangles, _ = mio.load_mesh(isodir)
+        return isosurface_object(cube, vertices, triangles, os.path.basename(isodir).split('.')[0])
 
     # cube position needs to be fixed for the mesh
-    cube_position = cube.field.gridsize / 2.0
+    cube_position = cube.field.get_centre()
     cube_position[1] = -cube_position[1]
     print('cubeposition', cube_position)
     bpy.context.scene.cursor_location = cube_position
     bpy.ops.wm.collada_import(filepath=isodir)
     obj = bpy.context.active_object
     bpy.ops.object.origin_set(type='ORIGIN_CURSOR')
+    obj.rotation_euler = (0, 0, 0)
 
     # apply transforms to scale appropriately to the molecule drawing
-    obj.rotation_euler = (0, 0, 0)
     obj.data.transform(cube.field.meshtransform)
     obj.location = [0, 0, 0]
+    surface_material(obj)
+
+    return obj
 
+def isosurface_object(cube, vertices, triangles, name):
+    """ FUNCTION isosurface_object(cube: Cube, vertices: array, triangles: array, name: str)
+    Builds an isosurface object in one go from arrays of grid coordinates. The mesh is centred on
+    the cell and scaled to the molecule drawing in numpy, which is where the collada import in
+    import_isosurface ends up
+    """
+    vertices = (np.asarray(vertices) - cube.field.get_centre()).dot(
+        cube.field.meshtransform[0:3, 0:3].T)
+    obj = ub.meshFromArrays(vertices, triangles, name)
+    surface_material(obj)
+    return obj
+
+def surface_material(obj):
     # default look for the surface..
     mat = bpy.data.materials.new('SurfaceMaterial')
     mat.use_transparency = True
@@ -52,10 +106,8 @@ def add_isosurface(cube, val, name="", update=False):
     obj.data.materials.append(mat)
     obj.data.update()
 
-    return obj
-
-def add_volume(cube, name="", update=False):
-    """ FUNCTION add_volume(cube: Cube, name: str)
+def add_volume(cube, name="", update=False, level=0):
+    """ FUNCTION add_volume(cube: Cube, name: str, level: int)
     Adds a volume object for blender to render, based off the voxel data from a cube file
     Requires the existence of these voxel files, which are handled by another function (see
     cube_reader.py)
@@ -64,17 +116,21 @@ def add_volume(cube, name="", update=False):
     Cube: cube, the object that contains all the cell data
     str: name, the name of the cube/voxel file to be read (these should have the same name, but if not,
         reference the voxel file name(s, as a list)
+    int: level, use voxels of the field downsampled by 2**level along each axis, for quick previews
 
     RETURNS:
     blender object: the cube that represents the field data from the relevant cube file, referenced by
     the name given.
     """
+    # set directories
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    data_dir = os.path.join(current_dir, 'dat')
+
     if not name:
-        # default expectation
-        name0 = cube.name + '_color.bvox'
-        name1 = cube.name + '_emission.bvox'
-        cube.make_color_voxel(update=update)
-        cube.make_emission_voxel(update=update, modifier='GRADIENT', max_emission=0.05)
+        # default expectation, both voxels from one read of the field (the gradient maximum takes
+        # one more pass the first time, see Cube.gradient_max)
+        path0, path1 = cube.make_volume_voxels(update=update, modifier='GRADIENT',
+                                               max_emission=0.05, level=level)
     elif isinstance(name, (list,)):
         if len(name) != 2:
             print("name parameter expects 2-list or string")
@@ -89,18 +145,14 @@ def add_volume(cube, name="", update=False):
                 name1 = name[1]
             else:
                 name1 = name[1] + '.bvox'
+            path0 = os.path.join(data_dir, name0)
+            path1 = os.path.join(data_dir, name1)
     else:
         # assume names are appended with color and emission
-        name0 = name + '_color.bvox'
-        name1 = name + '_emission.bvox'
-        # assume voxel files do not exist, so run external checker. If they indeed do not exist, 
-        # try loading the relevant cube file referenced by 'name' and create the files on the fly.
-        cube.make_color_voxel(name, update=update)
-        cube.make_emission_voxel(name, update=update, modifier='GRADIENT', max_emission=0.2)
-
-    # set directories
-    current_dir = os.path.dirname(os.path.realpath(__file__))
-    data_dir = os.path.join(current_dir, 'dat')
+        # the voxels are looked up in the artifact cache. If they do not exist, try loading the
+        # relevant cube file referenced by 'name' and create the files on the fly.
+        path0, path1 = cube.make_volume_voxels(name, update=update, modifier='GRADIENT',
+                                               max_emission=0.2, level=level)
 
     # add primitive cube and set as main object for convenient manipulation
     bpy.ops.mesh.primitive_cube_add(location=(0, 0, 0))
@@ -108,7 +160,8 @@ def add_volume(cube, name="", update=False):
 
     # set references to useful objects in cube
     cellsize = cube.field.gridsize
-    cellt = cube.field.transform
+    # a downsampled level covers a slightly larger cell along axes that were padded
+    cellt = cube.field.level_transform(level)
 
     # fortran stores field in inverse order such that x and z are flipped when read directly by
     # blender, the following two transformations fixes this, along with a rescaling since the blender
@@ -117,6 +170,10 @@ def add_volume(cube, name="", update=False):
     obj.rotation_euler = (0, pi / 2.0, 0)
     obj.data.transform(cellt)
     obj.data.update()
+    # keep the padded cell over the same grid points as the full one, and a region of a larger
+    # field where it sits in that field
+    obj.location = cube.field.meshtransform[0:3, 0:3].dot(
+        cube.field.level_offset(level) + cube.field.gridsize / 2.0 - cube.field.get_centre())
 
     # create material based off volume
     mat = bpy.data.materials.new('VolumeMaterial')
@@ -127,14 +184,14 @@ def add_volume(cube, name="", update=False):
     # texture 0 sets the color of the material, based off values of voxel data
     tex0 = bpy.data.textures.new('VoxelTexture', 'VOXEL_DATA')
     tex0.voxel_data.file_format = 'BLENDER_VOXEL'
-    tex0.voxel_data.filepath = os.path.join(data_dir, name0)
+    tex0.voxel_data.filepath = path0
     tex0.use_color_ramp = True
 
     # texture 1 sets the emission of the material, based off a scaled dataset, for a more defined visible
     # volume
     tex1 = bpy.data.textures.new('VoxelTexture', 'VOXEL_DATA')
     tex1.voxel_data.file_format = 'BLENDER_VOXEL'
-    tex1.voxel_data.filepath = os.path.join(data_dir, name1)
+    tex1.voxel_data.filepath = path1
 
     # add texture 0 to the material
     slot0 = mat.texture_slots.add()